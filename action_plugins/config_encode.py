@@ -0,0 +1,163 @@
+"""
+Action plugin writing data encoded by the Config Encoder Filters into a file
+
+The data is encoded directly on the controller without passing through the
+Jinja2 templating and without writing any local temporary file. The file is
+transferred to the managed host only if its checksum differs from the
+checksum of the encoded data.
+
+Example:
+
+    - config_encode:
+        format: nginx
+        data: "{{ nginx_config }}"
+        options:
+          block_semicolon: yes
+        dest: /etc/nginx/nginx.conf
+        mode: "0644"
+"""
+
+from __future__ import (absolute_import, division, print_function)
+from ansible import errors
+from ansible.module_utils._text import to_text
+from ansible.module_utils.basic import FILE_COMMON_ARGUMENTS
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.action import ActionBase
+from ansible.utils.hashing import checksum_s
+import os
+import sys
+
+try:
+    from cef_loader import encoders
+except ImportError:
+    # The loader is shared with the cef_encode Jinja2 extension
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+        'jinja2_extensions'))
+
+    from cef_loader import encoders
+
+
+# Arguments not passed to the copy and file modules
+ARGS = ('data', 'format', 'options')
+# Arguments setting the attributes of the file
+FILE_ARGS = frozenset(FILE_COMMON_ARGUMENTS)
+
+
+def _filters():
+    """Return the filters from the filter_plugins directory of the role."""
+
+    return encoders().FilterModule().filters()
+
+
+class ActionModule(ActionBase):
+
+    TRANSFERS_FILES = True
+
+    def run(self, tmp=None, task_vars=None):
+        """Encode the data and write them into the destination file."""
+
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+        result['changed'] = False
+
+        try:
+            return self._run(result, task_vars)
+        finally:
+            self._remove_tmp_path(self._connection._shell.tmpdir)
+
+    def _run(self, result, task_vars):
+        """Compare the checksums and transfer the file if they differ."""
+
+        dest = self._task.args.get('dest')
+        encoder = 'encode_%s' % self._task.args.get('format')
+        options = self._task.args.get('options') or {}
+        follow = boolean(self._task.args.get('follow', False), strict=False)
+        filters = _filters()
+
+        if dest is None or 'data' not in self._task.args:
+            result['failed'] = True
+            result['msg'] = "data and dest are required"
+
+            return result
+        elif encoder not in filters:
+            result['failed'] = True
+            result['msg'] = "Unknown format: %s" % self._task.args.get(
+                'format')
+
+            return result
+
+        try:
+            content = filters[encoder](self._task.args['data'], **options)
+        except errors.AnsibleFilterError as e:
+            result['failed'] = True
+            result['msg'] = to_text(e)
+
+            return result
+
+        dest = self._remote_expand_user(dest)
+        dest_status = self._execute_remote_stat(
+            dest, all_vars=task_vars, follow=follow, checksum=True)
+
+        if dest_status['exists'] and dest_status['isdir']:
+            result['failed'] = True
+            result['msg'] = "dest must be a file: %s" % dest
+
+            return result
+
+        module_args = dict(
+            (key, val) for key, val in self._task.args.items()
+            if key not in ARGS)
+        module_args['dest'] = dest
+        module_args['_original_basename'] = os.path.basename(dest)
+        local_checksum = checksum_s(content)
+
+        if local_checksum == dest_status['checksum']:
+            if not any(key in self._task.args for key in FILE_ARGS):
+                # Nothing to change
+                return result
+
+            # The file module accepts only the attributes of the file
+            file_args = dict(
+                (key, val) for key, val in module_args.items()
+                if key in FILE_ARGS)
+            file_args.update(dict(
+                path=dest, state='file', follow=follow,
+                _original_basename=module_args['_original_basename']))
+            result.update(self._execute_module(
+                module_name='file', module_args=file_args,
+                task_vars=task_vars))
+
+            return result
+
+        if self._task.diff:
+            diff = self._get_diff_data(
+                dest, content, task_vars, source_file=False)
+        else:
+            diff = None
+
+        if self._task.check_mode:
+            result['changed'] = True
+
+            if diff is not None:
+                result['diff'] = diff
+
+            return result
+
+        tmp_src = self._connection._shell.join_path(
+            self._connection._shell.tmpdir, 'source')
+        self._transfer_data(tmp_src, content)
+        self._fixup_perms2((self._connection._shell.tmpdir, tmp_src))
+
+        module_args.update(dict(
+            src=tmp_src, checksum=local_checksum, follow=follow))
+        result.update(self._execute_module(
+            module_name='copy', module_args=module_args,
+            task_vars=task_vars))
+
+        if diff is not None:
+            result['diff'] = diff
+
+        return result
@@ -22,10 +22,83 @@ More information: https://github.com/jtyr/ansible-config_encoder_filters
 """
 
 from __future__ import (absolute_import, division, print_function)
-from ansible.module_utils.six import string_types
+from ansible.module_utils._text import to_bytes, to_text
+from ansible.module_utils.six import string_types, text_type, unichr
+from ansible.module_utils.six.moves import socketserver
 from ansible import errors
+from collections import OrderedDict
 from copy import copy
+from datetime import date, datetime, time
+from decimal import Decimal
+from itertools import count
+import difflib
+import errno
+import hashlib
+import json
+import marshal
+import multiprocessing
+import os
 import re
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import timeit
+
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:
+    # Python 2
+    from inspect import getargspec
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 without the futures backport encodes the batches serially
+    ThreadPoolExecutor = None
+
+try:
+    import fcntl
+except ImportError:
+    # Profiles saved into a file are not locked on Windows
+    fcntl = None
+
+
+def _env_limit(name):
+    """Read the limit from the environment variable."""
+
+    if os.environ.get(name):
+        try:
+            return int(os.environ[name])
+        except ValueError:
+            # Invalid value is reported when the limit is applied
+            return os.environ[name]
+
+    return None
+
+
+# Default location and size of the on-disk render cache
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ansible', 'cef_cache')
+CACHE_SIZE = 100 * 1024 * 1024
+# Maximal number of compiled emission plans kept in memory
+PLAN_CACHE_SIZE = 128
+# Minimal number of sections rendered in parallel
+WORKERS_THRESHOLD = 1000
+# Seconds to wait for the workers before rendering the sections serially
+WORKERS_TIMEOUT = 600
+# Minimal length of the lists of scalars encoded at once
+BULK_THRESHOLD = 16
+# Unix socket of the render server (empty value disables the client)
+SERVER_SOCKET = os.environ.get('CEF_SERVER', '')
+# Maximal size of the results kept in memory by the render server
+SERVER_CACHE_SIZE = 64 * 1024 * 1024
+# Seconds to wait for the response of the render server
+SERVER_TIMEOUT = 30
+# Default limits of the encoded data (None disables the limit)
+MAX_DEPTH = _env_limit('CEF_MAX_DEPTH')
+MAX_NODES = _env_limit('CEF_MAX_NODES')
+MAX_BYTES = _env_limit('CEF_MAX_BYTES')
 
 
 def _str_is_bool(data):
@@ -54,18 +127,243 @@ def _str_is_num(data):
     return _str_is_int(data) or _str_is_float(data)
 
 
-def _is_num(data):
-    """Verify if data is either int or float.
+# Lock guarding the modifications of the module-level registries
+_lock = threading.Lock()
 
-    Could be replaced by:
+# Kinds of the nodes and the handlers converting the value before its
+# classification indexed by the node type
+_types = {
+    bool: ('bool', None),
+    date: ('str', lambda x: x.isoformat()),
+    datetime: ('str', lambda x: x.isoformat()),
+    Decimal: ('num', None),
+    dict: ('dict', None),
+    float: ('num', None),
+    int: ('num', None),
+    list: ('list', None),
+    time: ('str', lambda x: x.isoformat()),
+    type(None): ('null', None),
+}
 
-        from numbers import Number as number
-        isinstance(data, number)
+for _t in string_types:
+    _types[_t] = ('str', None)
 
-    but that requires Python v2.6+.
+if bytes is not str:
+    _types[bytes] = ('str', to_text)
+
+
+def register_type(data_type, kind, convert=None):
+    """Register kind of the data type and optional value conversion.
+
+    The kind is one of bool, dict, list, null, num or str. The convert
+    function gets the value and must return a value of the given kind.
+    """
+
+    if kind not in ('bool', 'dict', 'list', 'null', 'num', 'str'):
+        raise errors.AnsibleFilterError("Unknown kind: %s" % kind)
+
+    with _lock:
+        _types[data_type] = (kind, convert)
+
+        # Forget all types resolved through the MRO
+        for t, val in list(_types.items()):
+            if len(val) > 2:
+                del _types[t]
+
+
+def _node(data):
+    """Return the kind of the data and the data converted to that kind."""
+
+    try:
+        kind, convert = _types[type(data)][:2]
+    except KeyError:
+        kind, convert = 'other', None
+
+        for base in type(data).__mro__[1:]:
+            if base in _types:
+                kind, convert = _types[base][:2]
+                break
+
+        # Cache the type and mark it as resolved through the MRO
+        with _lock:
+            _types[type(data)] = (kind, convert, True)
+
+    if convert is not None:
+        data = convert(data)
+
+    return kind, data
+
+
+class _FrozenDict(dict):
+    """Immutable dict created by cef_normalize with presorted items."""
+
+    def __init__(self, items):
+        dict.__init__(self, items)
+
+        try:
+            self.sorted_items = sorted(dict.items(self))
+        except TypeError:
+            # Keys which can't be sorted are left for the encoder to fail
+            self.sorted_items = None
+
+        self._hash = None
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(dict.items(self)))
+
+        return self._hash
+
+    def __reduce__(self):
+        return (self.__class__, (list(dict.items(self)),))
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Normalized data can't be modified")
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+class _FrozenList(list):
+    """Immutable list created by cef_normalize."""
+
+    def __init__(self, items):
+        list.__init__(self, items)
+        self._hash = None
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(tuple(self))
+
+        return self._hash
+
+    def __reduce__(self):
+        return (self.__class__, (list(self),))
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Normalized data can't be modified")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = extend = insert = pop = remove = reverse = sort = _immutable
+
+
+class _BoolStr(text_type):
+    """String classified by cef_normalize as a boolean."""
+
+
+class _NumStr(text_type):
+    """String classified by cef_normalize as a number."""
+
+
+class _LayeredDict(dict):
+    """Read-only merged view of dicts where the later ones override.
+
+    Values of the same key are merged only if they are all dicts, any other
+    value replaces the values of the previous layers. The merged dicts are
+    never allocated, each level is resolved when it's accessed.
     """
 
-    return isinstance(data, int) or isinstance(data, float)
+    def __init__(self, layers):
+        dict.__init__(self)
+        self.layers = layers
+
+    def __getitem__(self, key):
+        vals = [layer[key] for layer in self.layers if key in layer]
+
+        if not vals:
+            raise KeyError(key)
+
+        return _layered(vals)
+
+    def __contains__(self, key):
+        return any(key in layer for layer in self.layers)
+
+    def __iter__(self):
+        seen = set()
+
+        for layer in self.layers:
+            for key in layer:
+                if key not in seen:
+                    seen.add(key)
+
+                    yield key
+
+    def __len__(self):
+        return len(set().union(*self.layers))
+
+    def __eq__(self, other):
+        if not isinstance(other, dict):
+            return False
+
+        return len(self) == len(other) and all(
+            key in other and self[key] == other[key] for key in self)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return (self.__class__, (self.layers,))
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Layered data can't be modified")
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+def _layered(layers):
+    """Return the merged view of the layers where the later ones override."""
+
+    dicts = []
+
+    for layer in reversed(layers):
+        if not isinstance(layer, dict):
+            if not dicts:
+                return layer
+
+            break
+
+        dicts.append(layer)
+
+    if len(dicts) == 1:
+        return dicts[0]
+
+    return _LayeredDict(dicts[::-1])
+
+
+_types.update({
+    _BoolStr: ('bool', None),
+    _FrozenDict: ('dict', None),
+    _FrozenList: ('list', None),
+    _LayeredDict: ('dict', None),
+    _NumStr: ('num', None),
+})
+
+
+def _sorted_items(data):
+    """Return the dict items sorted by the key."""
+
+    if type(data) is _FrozenDict and data.sorted_items is not None:
+        return data.sorted_items
+
+    return sorted(data.items())
 
 
 def _escape(data, quote='"', format=None):
@@ -91,6 +389,50 @@ def _escape(data, quote='"', format=None):
         return data
 
 
+# Separator of the strings escaped at once
+_bulk_sep = '\x00'
+
+
+def _bulk(
+        data, sep, escape, quote='"', convert=False, distinct_last=False,
+        null=True, prefix=None):
+    """Return the items of a list of strings or numbers joined at once.
+
+    Returns None if the list is short, mixes the kinds or contains strings
+    rendered in a special way (null, prefixed or converted values) and must
+    be encoded item by item.
+    """
+
+    if len(data) < BULK_THRESHOLD:
+        return None
+
+    types = set(map(type, data))
+    kinds = set(_types.get(t, ())[:2] for t in types)
+
+    if distinct_last and data.count(data[-1]) > 1:
+        # Items equal to the last item are rendered as the last item
+        return None
+    elif kinds == set([('num', None)]) and types <= set([float, int]):
+        return sep.join(map(str, data))
+    elif kinds != set([('str', None)]) or convert:
+        return None
+
+    joined = _bulk_sep.join(data)
+    marked = _bulk_sep + joined + _bulk_sep
+
+    if (
+            joined.count(_bulk_sep) != len(data) - 1 or
+            (null and _bulk_sep + 'null' + _bulk_sep in marked) or
+            (prefix is not None and (
+                not prefix or _bulk_sep + prefix in marked))):
+        return None
+
+    return "%s%s%s" % (
+        quote,
+        escape(joined).replace(_bulk_sep, "%s%s%s" % (quote, sep, quote)),
+        quote)
+
+
 def encode_apache(
         data, block_type='sections', convert_bools=False, convert_nums=False,
         indent="  ", level=0, quote_all_nums=False, quote_all_strings=False):
@@ -169,7 +511,7 @@ def encode_apache(
 
     elif block_type == 'options':
         for o in data:
-            for key, val in sorted(o.items()):
+            for key, val in _sorted_items(o):
                 rv += "%s%s " % (indent * (level-1), key)
                 rv += encode_apache(
                     val,
@@ -183,22 +525,15 @@ def encode_apache(
                 rv += "\n"
 
     elif block_type == 'value':
-        if isinstance(data, bool) or convert_bools and _str_is_bool(data):
-            # Value is a boolean
+        kind, data = _node(data)
 
-            rv += str(data).lower()
-
-        elif (
-                _is_num(data) or
-                (convert_nums and _str_is_num(data))):
-            # Value is a number
-
-            if quote_all_nums:
-                rv += '"%s"' % data
-            else:
-                rv += str(data)
+        if kind == 'str':
+            if convert_bools and _str_is_bool(data):
+                kind = 'bool'
+            elif convert_nums and _str_is_num(data):
+                kind = 'num'
 
-        elif isinstance(data, string_types):
+        if kind == 'str':
             # Value is a string
             if (
                     quote_all_strings or
@@ -212,7 +547,20 @@ def encode_apache(
             else:
                 rv += data
 
-        elif isinstance(data, list):
+        elif kind == 'bool':
+            # Value is a boolean
+
+            rv += str(data).lower()
+
+        elif kind == 'num':
+            # Value is a number
+
+            if quote_all_nums:
+                rv += '"%s"' % data
+            else:
+                rv += str(data)
+
+        elif kind == 'list':
             # Value is a list
             for v in data:
                 rv += encode_apache(
@@ -239,13 +587,14 @@ def encode_erlang(
 
     # Return value
     rv = ""
+    kind, data = _node(data)
 
-    if isinstance(data, dict):
+    if kind == 'dict':
         # It's a dict
 
         rv += "\n"
 
-        for key, val in sorted(data.items()):
+        for key, val in _sorted_items(data):
             if key == ordered_tuple_indicator:
                 rv += "%s{" % (indent*level)
 
@@ -278,22 +627,18 @@ def encode_erlang(
                     ordered_tuple_indicator=ordered_tuple_indicator)
 
             rv += "}"
-    elif (
-            data == "null" or
-            _is_num(data) or
-            isinstance(data, bool) or
-            (convert_nums and _str_is_num(data)) or
-            (convert_bools and _str_is_bool(data))):
-        # It's null, number or boolean
-
-        rv += str(data).lower()
-
-    elif isinstance(data, string_types):
+    elif kind == 'str':
         # It's a string
 
         atom_len = len(atom_value_indicator)
 
         if (
+                data == "null" or
+                (convert_nums and _str_is_num(data)) or
+                (convert_bools and _str_is_bool(data))):
+            # It's null, number or boolean
+            rv += data.lower()
+        elif (
                 len(data) > atom_len and
                 data[0:atom_len] == atom_value_indicator):
 
@@ -302,31 +647,42 @@ def encode_erlang(
         else:
             rv += '"%s"' % _escape(data)
 
+    elif kind in ('bool', 'num'):
+        # It's number or boolean
+
+        rv += str(data).lower()
+
     else:
         # It's a list
 
         rv += "["
 
-        for val in data:
-            if (
-                    isinstance(val, string_types) or
-                    _is_num(val)):
-                rv += "\n%s" % (indent*level)
+        bulk = _bulk(
+            data, ",\n%s" % (indent*level), _escape,
+            convert=convert_bools or convert_nums, distinct_last=True,
+            prefix=atom_value_indicator)
 
-            rv += encode_erlang(
-                val,
-                atom_value_indicator=atom_value_indicator,
-                convert_bools=convert_bools,
-                convert_nums=convert_nums,
-                indent=indent,
-                level=level+1,
-                ordered_tuple_indicator=ordered_tuple_indicator)
+        if bulk is not None:
+            rv += "\n%s%s\n" % (indent*level, bulk)
+        else:
+            for val in data:
+                if _node(val)[0] in ('bool', 'num', 'str'):
+                    rv += "\n%s" % (indent*level)
 
-            if data[-1] == val:
-                # Last item of the loop
-                rv += "\n"
-            else:
-                rv += ","
+                rv += encode_erlang(
+                    val,
+                    atom_value_indicator=atom_value_indicator,
+                    convert_bools=convert_bools,
+                    convert_nums=convert_nums,
+                    indent=indent,
+                    level=level+1,
+                    ordered_tuple_indicator=ordered_tuple_indicator)
+
+                if data[-1] == val:
+                    # Last item of the loop
+                    rv += "\n"
+                else:
+                    rv += ","
 
         if len(data) > 0:
             rv += "%s]" % (indent * (level-1))
@@ -380,6 +736,210 @@ def encode_haproxy(data, indent="  "):
     return rv
 
 
+# Criteria of the ACLs and their sample fetches usable with the maps
+_haproxy_fetches = {
+    'base': 'base',
+    'hdr': 'req.hdr',
+    'path': 'path',
+    'req.hdr': 'req.hdr',
+    'url': 'url',
+}
+
+
+def _haproxy_file(files, patterns_dir, name, suffix):
+    """Return unique path of the pattern file."""
+
+    path = os.path.join(
+        patterns_dir, re.sub(r'[^A-Za-z0-9.-]+', '_', name).strip('_'))
+    rv = path + suffix
+    i = 1
+
+    while rv in files:
+        i += 1
+        rv = '%s_%d%s' % (path, i, suffix)
+
+    return rv
+
+
+def _haproxy_acl(line):
+    """Parse the ACL with inline patterns.
+
+    Returns the name, the criterion, the flags and the patterns or None if
+    the ACL can't be moved into a file.
+    """
+
+    tokens = line.split()
+
+    if (
+            len(tokens) < 4 or tokens[0] != 'acl' or
+            '"' in line or "'" in line or '\\' in line):
+        return None
+
+    flags = []
+    i = 3
+
+    while i < len(tokens) and tokens[i].startswith('-'):
+        if tokens[i] in ('-f', '-M', '-u'):
+            # Patterns are already in a file or the ACL has an ID
+            return None
+        elif tokens[i] == '--':
+            i += 1
+            break
+
+        flags.append(tokens[i])
+
+        if tokens[i] == '-m':
+            i += 1
+            flags.extend(tokens[i:i + 1])
+
+        i += 1
+
+    if i >= len(tokens):
+        return None
+
+    return tokens[1], tokens[2], tuple(flags), tokens[i:]
+
+
+def _haproxy_rule(line):
+    """Parse the use_backend rule with single anonymous ACL.
+
+    Returns the sample fetch, the case insensitivity flag, the backend and
+    the patterns or None if the rule can't be moved into a map.
+    """
+
+    tokens = line.split()
+
+    if (
+            len(tokens) < 7 or tokens[0] != 'use_backend' or
+            tokens[2] != 'if' or tokens[3] != '{' or tokens[-1] != '}' or
+            '%[' in tokens[1] or
+            '"' in line or "'" in line or '\\' in line):
+        return None
+
+    backend = tokens[1]
+    name, _, args = tokens[4].partition('(')
+    tokens = tokens[5:-1]
+    icase = False
+
+    if name not in _haproxy_fetches:
+        return None
+
+    while tokens and tokens[0].startswith('-'):
+        if tokens[0] == '-i':
+            icase = True
+            tokens = tokens[1:]
+        elif tokens[:2] == ['-m', 'str']:
+            tokens = tokens[2:]
+        else:
+            return None
+
+    if not tokens:
+        return None
+
+    fetch = _haproxy_fetches[name]
+
+    if args:
+        fetch += '(%s' % args
+
+    return fetch, icase, backend, tokens
+
+
+def _haproxy_patterns(section, lines, patterns_dir, threshold, files):
+    """Move the large lists of patterns of the section into the files."""
+
+    acls = OrderedDict()
+    rules = []
+    rv = list(lines)
+
+    for i, line in enumerate(lines):
+        acl = _haproxy_acl(line)
+
+        if acl is not None:
+            acls.setdefault(acl[:3], []).append((i, acl[3]))
+
+        rule = _haproxy_rule(line)
+
+        if line.split()[:1] == ['use_backend']:
+            # Only the consecutive rules of the same fetch share the map
+            if rule is not None and rules and rules[-1][0] == rule[:2]:
+                rules[-1][1].append((i, rule[2], rule[3]))
+            else:
+                rules.append((
+                    None if rule is None else rule[:2],
+                    [] if rule is None else [(i, rule[2], rule[3])]))
+
+    for (name, criterion, flags), items in acls.items():
+        patterns = list(OrderedDict(
+            (pattern, None) for _, values in items for pattern in values))
+
+        if len(patterns) < threshold:
+            continue
+
+        path = _haproxy_file(
+            files, patterns_dir, '%s_%s_%s' % (section, name, criterion),
+            '.lst')
+        files[path] = ''.join('%s\n' % pattern for pattern in patterns)
+        rv[items[0][0]] = ' '.join(
+            ('acl', name, criterion) + flags + ('-f', path))
+
+        for i, _ in items[1:]:
+            rv[i] = None
+
+    for key, items in rules:
+        entries = OrderedDict()
+
+        for _, backend, patterns in items:
+            for pattern in patterns:
+                # The first matching rule wins
+                entries.setdefault(
+                    pattern.lower() if key[1] else pattern, backend)
+
+        if key is None or len(entries) < threshold:
+            continue
+
+        path = _haproxy_file(
+            files, patterns_dir, '%s_%s' % (section, key[0]), '.map')
+        files[path] = ''.join(
+            '%s %s\n' % entry for entry in entries.items())
+        fetch = '%s%s,map(%s)' % (
+            key[0], ',lower' if key[1] else '', path)
+        rv[items[0][0]] = 'use_backend %%[%s] if { %s -m found }' % (
+            fetch, fetch)
+
+        for i, _, _ in items[1:]:
+            rv[i] = None
+
+    return [line for line in rv if line is not None]
+
+
+def encode_haproxy_files(
+        data, indent="  ", patterns_dir='/etc/haproxy/patterns',
+        patterns_threshold=100):
+    """Convert Python data structure to HAProxy format and pattern files.
+
+    Large lists of the ACL patterns and of the use_backend rules are moved
+    into the pattern and map files. Returns dict with the config and with
+    the content of the files.
+    """
+
+    files = OrderedDict()
+    sections = []
+
+    for section in data:
+        if isinstance(section, dict):
+            name = list(section.keys())[0]
+            section = {name: _haproxy_patterns(
+                name, _haproxy_lines(list(section.values())[0], True),
+                patterns_dir, patterns_threshold, files)}
+
+        sections.append(section)
+
+    return {
+        'config': encode_haproxy(sections, indent=indent),
+        'files': dict(files),
+    }
+
+
 def encode_ini(
         data, comment="#", delimiter="=", indent="", quote="",
         section_is_comment=False, ucase_prop=False):
@@ -389,7 +949,7 @@ def encode_ini(
     rv = ""
 
     # First process all standalone properties
-    for prop, val in sorted(data.items()):
+    for prop, val in _sorted_items(data):
         if ucase_prop:
             prop = prop.upper()
 
@@ -401,13 +961,12 @@ def encode_ini(
             vals = [val]
 
         for item in vals:
-            if (
-                    len(quote) == 0 and
-                    isinstance(item, string_types) and
-                    len(item) == 0):
+            kind, item = _node(item)
+
+            if len(quote) == 0 and kind == 'str' and len(item) == 0:
                 item = '""'
 
-            if item is not None:
+            if kind != 'null':
                 if item == "!!!null":
                     rv += "%s%s\n" % (indent, prop)
                 else:
@@ -416,7 +975,7 @@ def encode_ini(
                         quote)
 
     # Then process all sections
-    for section, props in sorted(data.items()):
+    for section, props in _sorted_items(data):
         if isinstance(props, dict):
             if rv != "":
                 rv += "\n"
@@ -438,14 +997,68 @@ def encode_ini(
     return rv
 
 
+def _compact_json(data, convert_bools=False, convert_nums=False):
+    """Convert Python data structure to compact JSON format."""
+
+    out = []
+    append = out.append
+
+    def emit(data):
+        kind, data = _node(data)
+
+        if kind == 'str':
+            if (
+                    data == "null" or
+                    (convert_nums and _str_is_num(data)) or
+                    (convert_bools and _str_is_bool(data))):
+                append(data.lower())
+            else:
+                append('"%s"' % _escape(_escape(data), format='control'))
+        elif kind in ('bool', 'num'):
+            append(str(data).lower())
+        elif kind == 'dict':
+            sep = '{'
+
+            for key, val in _sorted_items(data):
+                append('%s"%s":' % (sep, key))
+                emit(val)
+                sep = ','
+
+            append('{}' if sep == '{' else '}')
+        elif kind == 'list':
+            sep = '['
+
+            for val in data:
+                append(sep)
+                emit(val)
+                sep = ','
+
+            append('[]' if sep == '[' else ']')
+        else:
+            raise errors.AnsibleFilterError(
+                "Unexpected data type: %s" % (type(data)))
+
+    emit(data)
+
+    if _node(data)[0] == 'dict':
+        append("\n")
+
+    return ''.join(out)
+
+
 def encode_json(
-        data, convert_bools=False, convert_nums=False, indent="  ", level=0):
+        data, convert_bools=False, convert_nums=False, indent="  ", level=0,
+        compact=False):
     """Convert Python data structure to JSON format."""
 
+    if compact:
+        return _compact_json(data, convert_bools, convert_nums)
+
     # Return value
     rv = ""
+    kind, data = _node(data)
 
-    if isinstance(data, dict):
+    if kind == 'dict':
         # It's a dict
 
         rv += "{"
@@ -453,7 +1066,7 @@ def encode_json(
         if len(data) > 0:
             rv += "\n"
 
-        items = sorted(data.items())
+        items = _sorted_items(data)
 
         for key, val in items:
             rv += '%s"%s": ' % (indent * (level+1), key)
@@ -478,19 +1091,22 @@ def encode_json(
         if level == 0:
             rv += "\n"
 
-    elif (
-            data == "null" or
-            _is_num(data) or
-            (convert_nums and _str_is_num(data)) or
-            (convert_bools and _str_is_bool(data))):
-        # It's a number, null or boolean
+    elif kind == 'str':
+        # It's a string
 
-        rv += str(data).lower()
+        if (
+                data == "null" or
+                (convert_nums and _str_is_num(data)) or
+                (convert_bools and _str_is_bool(data))):
+            # It's null, number or boolean
+            rv += data.lower()
+        else:
+            rv += '"%s"' % _escape(_escape(data), format='control')
 
-    elif isinstance(data, string_types):
-        # It's a string
+    elif kind in ('bool', 'num'):
+        # It's a number or boolean
 
-        rv += '"%s"' % _escape(_escape(data), format='control')
+        rv += str(data).lower()
 
     else:
         # It's a list
@@ -500,20 +1116,28 @@ def encode_json(
         if len(data) > 0:
             rv += "\n"
 
-        for val in data:
-            rv += indent * (level+1)
-            rv += encode_json(
-                val,
-                convert_bools=convert_bools,
-                convert_nums=convert_nums,
-                indent=indent,
-                level=level+1)
+        bulk = _bulk(
+            data, ",\n%s" % (indent * (level+1)),
+            lambda x: _escape(_escape(x), format='control'),
+            convert=convert_bools or convert_nums, distinct_last=True)
 
-            # Last item of the loop
-            if data[-1] == val:
-                rv += "\n"
-            else:
-                rv += ",\n"
+        if bulk is not None:
+            rv += "%s%s\n" % (indent * (level+1), bulk)
+        else:
+            for val in data:
+                rv += indent * (level+1)
+                rv += encode_json(
+                    val,
+                    convert_bools=convert_bools,
+                    convert_nums=convert_nums,
+                    indent=indent,
+                    level=level+1)
+
+                # Last item of the loop
+                if data[-1] == val:
+                    rv += "\n"
+                else:
+                    rv += ",\n"
 
         if len(data) > 0:
             rv += "%s]" % (indent * level)
@@ -523,6 +1147,34 @@ def encode_json(
     return rv
 
 
+def encode_jsonl(data, convert_bools=False, convert_nums=False):
+    """Convert list of records to JSON Lines format."""
+
+    return ''.join(encode_jsonl_iter(data, convert_bools, convert_nums))
+
+
+def encode_jsonl_iter(data, convert_bools=False, convert_nums=False):
+    """Generate the lines of the JSON Lines format one record at a time.
+
+    The records are consumed lazily so any iterable can be used as the
+    input without keeping all the records in the memory.
+    """
+
+    kind, data = _node(data)
+
+    if kind in ('bool', 'dict', 'null', 'num', 'str'):
+        raise errors.AnsibleFilterError(
+            "Expected list of records, got: %s" % type(data).__name__)
+
+    for record in data:
+        line = _compact_json(record, convert_bools, convert_nums)
+
+        if line.endswith("\n"):
+            yield line
+        else:
+            yield line + "\n"
+
+
 def encode_logstash(
         data, backslash_ignore_prefix='@@@', convert_bools=False,
         convert_nums=False, indent="  ", level=0, prevtype="",
@@ -531,14 +1183,15 @@ def encode_logstash(
 
     # Return value
     rv = ""
+    kind, data = _node(data)
 
-    if isinstance(data, dict):
+    if kind == 'dict':
         # The item is a dict
 
         if prevtype in ('value', 'value_hash', 'array'):
             rv += "{\n"
 
-        items = sorted(data.items())
+        items = _sorted_items(data)
 
         for key, val in items:
             if key[0] == section_prefix:
@@ -554,9 +1207,7 @@ def encode_logstash(
                 # Last item of the loop
                 if items[-1] == (key, val):
                     if (
-                            isinstance(val, string_types) or
-                            _is_num(val) or
-                            isinstance(val, bool) or (
+                            _node(val)[0] in ('bool', 'num', 'str') or (
                                 isinstance(val, dict) and
                                 val and
                                 list(val.keys())[0][0] != section_prefix)):
@@ -581,10 +1232,8 @@ def encode_logstash(
                         'value_hash' if isinstance(val, dict) else 'value'))
 
             if (
-                    items[-1] != (key, val) and (
-                        isinstance(val, string_types) or
-                        _is_num(val) or
-                        isinstance(val, bool))):
+                    items[-1] != (key, val) and
+                    _node(val)[0] in ('bool', 'num', 'str')):
                 rv += "\n"
 
         if prevtype in ('value', 'value_hash', 'array'):
@@ -593,23 +1242,24 @@ def encode_logstash(
             if prevtype in ('value', 'value_array'):
                 rv += "\n"
 
-    elif (
-            _is_num(data) or
-            isinstance(data, bool) or
-            (convert_nums and _str_is_num(data)) or
-            (convert_bools and _str_is_bool(data))):
-        # It's number or boolean
-
-        rv += str(data).lower()
-
-    elif isinstance(data, string_types):
+    elif kind == 'str':
         # It's a string
 
-        if data.startswith(backslash_ignore_prefix):
+        if (
+                (convert_nums and _str_is_num(data)) or
+                (convert_bools and _str_is_bool(data))):
+            # It's number or boolean
+            rv += data.lower()
+        elif data.startswith(backslash_ignore_prefix):
             rv += "%s" % data[len(backslash_ignore_prefix):]
         else:
             rv += '"%s"' % _escape(data)
 
+    elif kind in ('bool', 'num'):
+        # It's number or boolean
+
+        rv += str(data).lower()
+
     else:
         # It's a list
 
@@ -648,51 +1298,169 @@ def encode_logstash(
     return rv
 
 
+def encode_logstash_pipelines(
+        data, fingerprints=None, pipelines_dir='/etc/logstash/conf.d',
+        **options):
+    """Convert dict of Logstash pipelines to configs and pipelines.yml.
+
+    The value of each pipeline is either its data or dict with the data in
+    the config key and with the settings of the pipeline. Returns dict with
+    the config, the path and the fingerprint of each pipeline, with the
+    pipelines.yml and with the IDs of the pipelines which differ from the
+    given fingerprints.
+    """
+
+    kind, data = _node(data)
+
+    if kind != 'dict':
+        raise errors.AnsibleFilterError(
+            "Unexpected data type: %s" % (type(data)))
+
+    encoder = FilterModule().filters()['encode_logstash']
+    fingerprints = fingerprints or {}
+    pipelines = {}
+    settings = []
+    changed = []
+
+    for pipeline_id, pipeline in _sorted_items(data):
+        if isinstance(pipeline, dict) and 'config' in pipeline:
+            setting = dict(
+                (key, val) for key, val in pipeline.items() if key != 'config')
+            pipeline = pipeline['config']
+        else:
+            setting = {}
+
+        config = encoder(pipeline, **options)
+        fingerprint = hashlib.sha1(to_bytes(config)).hexdigest()
+        path = os.path.join(pipelines_dir, '%s.conf' % pipeline_id)
+        pipelines[pipeline_id] = {
+            'config': config,
+            'fingerprint': fingerprint,
+            'path': path,
+        }
+        setting.update({'path.config': path, 'pipeline.id': pipeline_id})
+        settings.append(setting)
+
+        if fingerprints.get(pipeline_id) != fingerprint:
+            changed.append(pipeline_id)
+
+    return {
+        'changed': changed,
+        'pipelines': pipelines,
+        'pipelines_yml': encode_yaml(settings) if settings else '',
+    }
+
+
+def _compact_lua(
+        data, convert_bools=False, convert_nums=False, sort_keys=True):
+    """Convert Python data structure to compact Lua format."""
+
+    out = []
+    append = out.append
+
+    def emit(data, level):
+        kind, data = _node(data)
+
+        if kind == 'str':
+            if (
+                    (convert_nums and _str_is_num(data)) or
+                    (convert_bools and _str_is_bool(data))):
+                append(data.lower() + ";")
+            elif data == 'null':
+                append("nil;")
+            else:
+                append('"%s";' % _escape(_escape(data), format="control"))
+        elif kind in ('bool', 'num'):
+            append(str(data).lower() + ";")
+        elif kind == 'list':
+            append("{")
+
+            for val in data:
+                emit(val, level + 1)
+
+            append("};" if level > 1 else "}")
+        elif kind == 'dict':
+            if level > 0:
+                append("{")
+
+            for key, val in (
+                    _sorted_items(data) if sort_keys else data.items()):
+                append("%s=" % key)
+                emit(val, level + 1)
+
+                if level == 0:
+                    append("\n")
+
+            if level > 0:
+                append("};" if level > 1 else "}")
+        else:
+            raise errors.AnsibleFilterError(
+                "Unexpected data type: %s" % (type(data)))
+
+    emit(data, 0)
+
+    return ''.join(out)
+
+
 def encode_lua(
         data, convert_bools=False, convert_nums=False,
-        indent='    ', level=0, sort_keys=True):
+        indent='    ', level=0, sort_keys=True, compact=False):
     """Convert Python data structure to Lua format."""
 
+    if compact:
+        return _compact_lua(data, convert_bools, convert_nums, sort_keys)
+
     # Return value
     rv = ""
+    kind, data = _node(data)
 
-    if (
-            _is_num(data) or
-            (convert_nums and _str_is_num(data)) or
-            (convert_bools and _str_is_bool(data))):
-        # It's a number or boolean
-        rv += str(data).lower() + ";"
-
-    elif isinstance(data, string_types):
-        if data == 'null':
+    if kind == 'str':
+        if (
+                (convert_nums and _str_is_num(data)) or
+                (convert_bools and _str_is_bool(data))):
+            # It's a number or boolean
+            rv += data.lower() + ";"
+        elif data == 'null':
             rv += "nil;"
         else:
             rv += '"%s";' % _escape(_escape(data), format="control")
 
-    elif isinstance(data, list):
+    elif kind in ('bool', 'num'):
+        # It's a number or boolean
+        rv += str(data).lower() + ";"
+
+    elif kind == 'list':
         rv += "{\n"
 
-        for val in data:
-            val = encode_lua(
-                val,
-                convert_bools=convert_bools,
-                convert_nums=convert_nums,
-                sort_keys=sort_keys,
-                indent=indent,
-                level=level + 1)
-            rv += "%s%s\n" % (indent*level, val)
+        bulk = _bulk(
+            data, ";\n%s" % (indent*level),
+            lambda x: _escape(_escape(x), format="control"),
+            convert=convert_bools or convert_nums)
+
+        if bulk is not None:
+            rv += "%s%s;\n" % (indent*level, bulk)
+        else:
+            for val in data:
+                val = encode_lua(
+                    val,
+                    convert_bools=convert_bools,
+                    convert_nums=convert_nums,
+                    sort_keys=sort_keys,
+                    indent=indent,
+                    level=level + 1)
+                rv += "%s%s\n" % (indent*level, val)
 
         rv += "%s}" % (indent*(level-1))
 
         if level > 1:
             rv += ";"
 
-    elif isinstance(data, dict):
+    elif kind == 'dict':
         if level > 0:
             rv += "{\n"
 
         if sort_keys:
-            items = sorted(data.items())
+            items = _sorted_items(data)
         else:
             items = data.items()
         for key, val in items:
@@ -717,18 +1485,128 @@ def encode_lua(
     return rv
 
 
+# Hashes of Nginx with their default max_size and bucket_size
+_nginx_hashes = (
+    ('map', 'map_hash', 2048, 64),
+    ('server_name', 'server_names_hash', 512, 64),
+    ('types', 'types_hash', 1024, 64),
+)
+# Map parameters which are not keys of the hash
+_nginx_map_params = ('default', 'hostnames', 'include', 'volatile')
+
+
+def _nginx_tokens(line, semicolon_ignore_postfix):
+    """Return the tokens of the Nginx line without the semicolon."""
+
+    if line.endswith(semicolon_ignore_postfix):
+        line = line[:-len(semicolon_ignore_postfix)]
+
+    return line.rstrip(';').split()
+
+
+def _nginx_keys(data, groups, semicolon_ignore_postfix):
+    """Collect the keys of the hashes of each map and types block."""
+
+    for item in data:
+        kind, item = _node(item)
+
+        if kind == 'dict':
+            name = to_text(list(item.keys())[0]).split()
+            val = list(item.values())[0]
+
+            if name[:1] in (['map'], ['types']) and isinstance(val, list):
+                keys = []
+
+                for line in val:
+                    tokens = _nginx_tokens(
+                        to_text(line), semicolon_ignore_postfix)
+
+                    if name[0] == 'types':
+                        keys.extend(tokens[1:])
+                    elif tokens and tokens[0] not in _nginx_map_params:
+                        keys.append(tokens[0])
+
+                groups[name[0]].append(keys)
+            elif isinstance(val, list):
+                _nginx_keys(val, groups, semicolon_ignore_postfix)
+        elif kind == 'str':
+            tokens = _nginx_tokens(item, semicolon_ignore_postfix)
+
+            if tokens[:1] == ['server_name']:
+                # Names of all virtual servers are counted together
+                groups['server_name'][0].extend(tokens[1:])
+
+
+def _nginx_hash_sizes(data, semicolon_ignore_postfix):
+    """Add the hash sizes fitting the keys into the http blocks."""
+
+    rv = []
+
+    for item in data:
+        if not (
+                isinstance(item, dict) and
+                list(item.keys())[0] == 'http' and
+                isinstance(item['http'], list)):
+            rv.append(item)
+            continue
+
+        http = item['http']
+        groups = {'map': [], 'server_name': [[]], 'types': []}
+        directives = []
+        _nginx_keys(http, groups, semicolon_ignore_postfix)
+        present = set(
+            ' '.join(_nginx_tokens(line, semicolon_ignore_postfix)[:1])
+            for line in http if isinstance(line, string_types))
+
+        for kind, prefix, default_max, default_bucket in _nginx_hashes:
+            # Only the keys which are not regular expressions are hashed
+            hashes = [
+                set(key for key in keys if not key.startswith('~'))
+                for keys in groups[kind]]
+            entries = max([len(keys) for keys in hashes] + [0])
+            longest = max([len(key) for keys in hashes for key in keys] + [0])
+            max_size = 1
+            bucket_size = 32
+
+            while max_size < entries:
+                max_size *= 2
+
+            # Element holds a pointer, the key and its length aligned to
+            # the size of the pointer and the bucket ends with a pointer
+            while bucket_size < (longest + 17) // 8 * 8 + 8:
+                bucket_size *= 2
+
+            for name, size, default in (
+                    ('max_size', max_size, default_max),
+                    ('bucket_size', bucket_size, default_bucket)):
+                directive = '%s_%s' % (prefix, name)
+
+                if size > default and directive not in present:
+                    directives.append('%s %d' % (directive, size))
+
+        rv.append({'http': directives + http} if directives else item)
+
+    return rv
+
+
 def encode_nginx(
         data, block_semicolon=False, indent="  ", level=0, semicolon=';',
-        semicolon_ignore_postfix='!;'):
+        semicolon_ignore_postfix='!;', hash_sizes=False):
     """Convert Python data structure to Nginx format."""
 
     # Return value
     rv = ""
+
+    if hash_sizes:
+        data = _nginx_hash_sizes(data, semicolon_ignore_postfix)
+
     # Indicates the item type [section|line]
     item_type = ""
 
     for item in data:
-        if isinstance(item, dict):
+        kind, item = _node(item)
+
+        if kind == 'dict':
             # Section
             if item_type in ('section', 'line'):
                 rv += "\n"
@@ -745,7 +1623,7 @@ def encode_nginx(
 
             item_type = 'section'
 
-        elif isinstance(item, string_types):
+        elif kind == 'str':
             # Normal line
             if item_type == 'section':
                 rv += "\n"
@@ -781,7 +1659,7 @@ def encode_pam(
     # Remember previous type to make newline between type blocks
     prev_type = None
 
-    for label, rule in sorted(data.items()):
+    for label, rule in _sorted_items(data):
         if separate_types:
             # Add extra newline to separate blocks of the same type
             if prev_type is not None and prev_type != rule['type']:
@@ -829,21 +1707,90 @@ def encode_pam(
     return rv
 
 
+# Keys which don't have to be quoted
+_toml_bare_key_re = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+def _toml_name(key, quote='"'):
+    """Quote the key unless it's a bare key."""
+
+    if _toml_bare_key_re.match(text_type(key)):
+        return key
+
+    return "%s%s%s" % (quote, _escape(key, quote), quote)
+
+
+def _compact_toml(data, convert_bools=False, convert_nums=False, quote='"'):
+    """Convert Python data structure to TOML format with inline tables."""
+
+    out = []
+    append = out.append
+
+    def emit_key(key):
+        append("%s=" % _toml_name(key, quote))
+
+    def emit(data):
+        kind, data = _node(data)
+
+        if kind == 'str':
+            if (
+                    (convert_nums and _str_is_num(data)) or
+                    (convert_bools and _str_is_bool(data))):
+                append(data.lower())
+            else:
+                append("%s%s%s" % (quote, _escape(data, quote), quote))
+        elif kind in ('bool', 'num'):
+            append(str(data).lower())
+        elif kind == 'dict':
+            sep = '{'
+
+            for key, val in _sorted_items(data):
+                append(sep)
+                emit_key(key)
+                emit(val)
+                sep = ','
+
+            append('{}' if sep == '{' else '}')
+        elif kind == 'list':
+            sep = '['
+
+            for val in data:
+                append(sep)
+                emit(val)
+                sep = ','
+
+            append('[]' if sep == '[' else ']')
+
+    if _node(data)[0] == 'dict':
+        for key, val in _sorted_items(_node(data)[1]):
+            emit_key(key)
+            emit(val)
+            append("\n")
+    else:
+        emit(data)
+
+    return ''.join(out)
+
+
 def encode_toml(
         data, convert_bools=False, convert_nums=False, first=True, quote='"',
-        table_name="", table_type=None):
+        table_name="", table_type=None, compact=False):
     """Convert Python data structure to TOML format."""
 
+    if compact:
+        return _compact_toml(data, convert_bools, convert_nums, quote)
+
     # Return value
     rv = ""
+    kind, data = _node(data)
 
-    if isinstance(data, dict):
+    if kind == 'dict':
         # It's a dict
 
         tn = table_name
 
         # First process all keys with elementar value (num/str/bool/array)
-        for k, v in sorted(data.items()):
+        for k, v in _sorted_items(data):
 
             if not (isinstance(v, dict) or isinstance(v, list)):
                 if tn:
@@ -898,7 +1845,7 @@ def encode_toml(
                 rv += "[[%s]]\n" % tn
 
         # Then process tables and arrays of tables
-        for k, v in sorted(data.items()):
+        for k, v in _sorted_items(data):
             tn = table_name
 
             if isinstance(v, dict):
@@ -947,7 +1894,7 @@ def encode_toml(
 
                     first = False
 
-    elif isinstance(data, list):
+    elif kind == 'list':
 
         # Check if all values are elementar (num/str/bool/array)
         def is_elem(a):
@@ -963,7 +1910,13 @@ def encode_toml(
 
             return all_elementar
 
-        if is_elem(data):
+        bulk = _bulk(
+            data, ', ', lambda x: _escape(x, quote), quote=quote,
+            convert=convert_bools or convert_nums, null=False)
+
+        if bulk is not None:
+            rv += "[%s]" % bulk
+        elif is_elem(data):
             v_len = len(data)
 
             array = ''
@@ -981,31 +1934,110 @@ def encode_toml(
 
             rv += "[%s]" % (array)
 
-    elif (
-            _is_num(data) or
-            isinstance(data, bool) or
-            (convert_nums and _str_is_num(data)) or
-            (convert_bools and _str_is_bool(data))):
+    elif kind == 'str':
+        # It's a string
+
+        if (
+                (convert_nums and _str_is_num(data)) or
+                (convert_bools and _str_is_bool(data))):
+            # It's number or boolean
+            rv += data.lower()
+        else:
+            rv += "%s%s%s" % (quote, _escape(data, quote), quote)
+
+    elif kind in ('bool', 'num'):
         # It's number or boolean
 
         rv += str(data).lower()
 
-    elif isinstance(data, string_types):
-        # It's a string
+    return rv
 
-        rv += "%s%s%s" % (quote, _escape(data, quote), quote)
 
-    return rv
+def _xml_text(data, kind, escape_xml, cdata_prefix, raw_prefix):
+    """Return the text node either escaped, as CDATA section or raw."""
+
+    if kind == 'str' and cdata_prefix and data.startswith(cdata_prefix):
+        data = data[len(cdata_prefix):]
+
+        if ']]>' in data:
+            # The end of the section must be split into two sections
+            data = data.replace(']]>', ']]]]><![CDATA[>')
+
+        return "<![CDATA[%s]]>" % data
+    elif kind == 'str' and raw_prefix and data.startswith(raw_prefix):
+        return data[len(raw_prefix):]
+
+    return "%s" % _escape(data, format=('xml' if escape_xml else None))
+
+
+def _compact_xml(
+        data, attribute_sign="^", escape_xml=True, cdata_prefix='%%%',
+        raw_prefix='@@@'):
+    """Convert Python data structure to compact XML format."""
+
+    out = []
+    append = out.append
+
+    def is_attr(item):
+        return (
+            isinstance(item, dict) and
+            list(item.keys())[0].startswith(attribute_sign))
+
+    def emit(data):
+        kind, data = _node(data)
+
+        if kind == 'list':
+            for item in data:
+                if not is_attr(item):
+                    emit(item)
+        elif kind == 'dict':
+            key, val = list(data.items())[0]
+
+            if key.startswith(attribute_sign):
+                append(' %s="%s"' % (key[1:], _escape(_node(val)[1])))
+            else:
+                append("<%s" % key)
+                num_attrs = 0
+
+                if isinstance(val, list):
+                    for item in val:
+                        if is_attr(item):
+                            num_attrs += 1
+                            emit(item)
+
+                if val == '' or (
+                        isinstance(val, list) and num_attrs == len(val)):
+                    append("/>")
+                else:
+                    append(">")
+                    emit(val)
+                    append("</%s>" % key)
+        else:
+            append(_xml_text(
+                data, kind, escape_xml, cdata_prefix, raw_prefix))
+
+    emit(data)
+
+    if out:
+        append("\n")
+
+    return ''.join(out)
 
 
 def encode_xml(
-        data, attribute_sign="^", escape_xml=True, indent="  ", level=0):
+        data, attribute_sign="^", escape_xml=True, indent="  ", level=0,
+        compact=False, cdata_prefix='%%%', raw_prefix='@@@'):
     """Convert Python data structure to XML format."""
 
+    if compact:
+        return _compact_xml(
+            data, attribute_sign, escape_xml, cdata_prefix, raw_prefix)
+
     # Return value
     rv = ""
+    kind, data = _node(data)
 
-    if isinstance(data, list):
+    if kind == 'list':
         # Pocess anything what's not attribute
         for item in data:
             if (
@@ -1017,15 +2049,17 @@ def encode_xml(
                     attribute_sign=attribute_sign,
                     indent=indent,
                     level=level,
-                    escape_xml=escape_xml)
-    elif isinstance(data, dict):
+                    escape_xml=escape_xml,
+                    cdata_prefix=cdata_prefix,
+                    raw_prefix=raw_prefix)
+    elif kind == 'dict':
         # It's eiher an attribute or an element
 
         key, val = list(data.items())[0]
 
         if key.startswith(attribute_sign):
             # Process attribute
-            rv += ' %s="%s"' % (key[1:], _escape(val))
+            rv += ' %s="%s"' % (key[1:], _escape(_node(val)[1]))
         else:
             # Process element
             rv = '%s<%s' % (level*indent, key)
@@ -1074,7 +2108,9 @@ def encode_xml(
                     attribute_sign=attribute_sign,
                     indent=indent,
                     level=level+1,
-                    escape_xml=escape_xml)
+                    escape_xml=escape_xml,
+                    cdata_prefix=cdata_prefix,
+                    raw_prefix=raw_prefix)
 
                 if val_not_text:
                     rv += level*indent
@@ -1083,26 +2119,101 @@ def encode_xml(
     else:
         # It's a string
 
-        rv += "%s" % _escape(data, format=('xml' if escape_xml else None))
+        rv += _xml_text(data, kind, escape_xml, cdata_prefix, raw_prefix)
 
     return rv
 
 
+# Keys which would be misread in the YAML flow style if not quoted
+_yaml_key_re = re.compile(
+    r'^$|^[\s#&*!|>\'"%@`?:-]|[,\[\]{}]|:(\s|$)|\s#|\s$')
+
+
+def _yaml_key(key, quote='"'):
+    """Quote the key if it contains YAML indicators."""
+
+    if isinstance(key, string_types) and _yaml_key_re.search(key):
+        return "%s%s%s" % (quote, _escape(key, quote), quote)
+
+    return key
+
+
+def _compact_yaml(
+        data, block_prefix=';;;', convert_bools=False, convert_nums=False,
+        quote='"'):
+    """Convert Python data structure to YAML flow style."""
+
+    out = []
+    append = out.append
+
+    def emit(data):
+        kind, data = _node(data)
+
+        if kind == 'str':
+            if (
+                    data == "null" or
+                    (convert_bools and _str_is_bool(data))):
+                append(data.lower())
+            elif convert_nums and _str_is_num(data):
+                append(data)
+            elif data.startswith(block_prefix):
+                append(data[len(block_prefix):])
+            else:
+                append("%s%s%s" % (quote, _escape(data, quote), quote))
+        elif kind == 'bool':
+            append(str(data).lower())
+        elif kind == 'num':
+            append(str(data))
+        elif kind == 'null':
+            append("null")
+        elif kind == 'dict':
+            sep = '{'
+
+            for key, val in _sorted_items(data):
+                append("%s%s: " % (sep, _yaml_key(key, quote)))
+                emit(val)
+                sep = ','
+
+            append('{}' if sep == '{' else '}')
+        elif kind == 'list':
+            sep = '['
+
+            for val in data:
+                append(sep)
+                emit(val)
+                sep = ','
+
+            append('[]' if sep == '[' else ']')
+        else:
+            raise errors.AnsibleFilterError(
+                "Unexpected data type: %s" % (type(data)))
+
+    emit(data)
+    append("\n")
+
+    return ''.join(out)
+
+
 def encode_yaml(
         data, block_prefix=';;;', convert_bools=False, convert_nums=False,
-        indent="  ", level=0, quote='"', skip_indent=False):
+        indent="  ", level=0, quote='"', skip_indent=False, compact=False):
     """Convert Python data structure to YAML format."""
 
+    if compact:
+        return _compact_yaml(
+            data, block_prefix, convert_bools, convert_nums, quote)
+
     # Return value
     rv = ""
+    kind, data = _node(data)
 
-    if isinstance(data, dict):
+    if kind == 'dict':
         # It's a dictionary
 
         if len(data.keys()) == 0:
             rv += "{}\n"
         else:
-            for i, (key, val) in enumerate(sorted(data.items())):
+            for i, (key, val) in enumerate(_sorted_items(data)):
                 # Skip indentation only for the first pair
                 rv += "%s%s:" % (
                     "" if i == 0 and skip_indent else level*indent, key)
@@ -1127,11 +2238,18 @@ def encode_yaml(
                         level=level+1,
                         quote=quote)
 
-    elif isinstance(data, list):
+    elif kind == 'list':
         # It's a list
 
+        bulk = _bulk(
+            data, "\n%s- " % (level*indent), lambda x: _escape(x, quote),
+            quote=quote, convert=convert_bools or convert_nums,
+            prefix=block_prefix)
+
         if len(data) == 0:
             rv += "[]\n"
+        elif bulk is not None:
+            rv += "%s- %s\n" % (level*indent, bulk)
         else:
             for item in data:
                 if isinstance(item, list):
@@ -1149,94 +2267,2674 @@ def encode_yaml(
                     quote=quote,
                     skip_indent=True))
 
-    elif (
-            data == "null" or
-            isinstance(data, bool) or
-            (convert_bools and _str_is_bool(data))):
+    elif kind == 'str':
+        # It's a string
+
+        if data == "null" or (convert_bools and _str_is_bool(data)):
+            # It's a boolean
+            rv += "%s\n" % data.lower()
+        elif convert_nums and _str_is_num(data):
+            # It's a number
+            rv += "%s\n" % data
+        elif data.startswith(block_prefix):
+            rv += "%s\n" % data[len(block_prefix):].replace(
+                "\n", "\n%s" % (level*indent))
+        else:
+            rv += "%s%s%s\n" % (quote, _escape(data, quote), quote)
+
+    elif kind == 'bool':
         # It's a boolean
 
         rv += "%s\n" % str(data).lower()
 
-    elif (
-            _is_num(data) or
-            (convert_nums and _str_is_num(data))):
+    elif kind == 'num':
         # It's a number
 
         rv += "%s\n" % str(data)
 
+    elif kind == 'null':
+        # It's a null
+
+        rv += "null\n"
+
     else:
-        # It's a string
+        raise errors.AnsibleFilterError(
+            "Unexpected data type: %s" % (type(data)))
 
-        if data is None:
-            rv += "null\n"
-        elif data.startswith(block_prefix):
-            rv += "%s\n" % data[len(block_prefix):].replace(
-                "\n", "\n%s" % (level*indent))
+    return rv
+
+
+def _lines(data):
+    """Return iterator over the lines of a string or a file."""
+
+    if isinstance(data, string_types):
+        return iter(data.splitlines())
+
+    return (line.rstrip('\r\n') for line in data)
+
+
+def _decode_scalar(data, convert_bools=False, convert_nums=False):
+    """Convert the string into a boolean or a number if requested."""
+
+    if convert_bools and _str_is_bool(data):
+        return data.lower() == 'true'
+    elif convert_nums and _str_is_int(data):
+        return int(data)
+    elif convert_nums and _str_is_float(data):
+        return float(data)
+
+    return data
+
+
+def _unescape(data):
+    """Remove the escaping added by the _escape function."""
+
+    return re.sub(r'\\(.)', r'\1', data)
+
+
+def decode_haproxy(data):
+    """Convert HAProxy format into Python data structure."""
+
+    # Return value
+    rv = []
+    # Parameters of the current section
+    section = None
+
+    for line in _lines(data):
+        if not line.strip():
+            continue
+
+        if line[0] in (' ', '\t'):
+            # It's a parameter
+            if section is None:
+                raise errors.AnsibleFilterError(
+                    "Parameter outside of a section: %s" % line.strip())
+
+            section.append(line.strip())
+        elif line.startswith('#'):
+            # It's a comment
+            rv.append(line.rstrip())
         else:
-            rv += "%s%s%s\n" % (quote, _escape(data, quote), quote)
+            # It's a section
+            section = []
+            rv.append({line.rstrip(): section})
 
     return rv
 
 
-def __eval_replace(match):
-    """Evaluate the real value of the variable specified as a string."""
+def decode_ini(
+        data, comment="#", convert_bools=False, convert_nums=False,
+        delimiter="=", quote="", section_is_comment=False):
+    """Convert INI format into Python data structure."""
 
-    ret = '__item'
-    ret += ''.join(match.groups()[1:])
+    # Return value
+    rv = {}
+    # Properties of the current section
+    section = rv
+    # Delimiter without the padding
+    separator = delimiter.strip() or delimiter
+    # Signs starting the comment lines
+    comments = [comment] if isinstance(comment, string_types) else comment
+
+    for line in _lines(data):
+        line = line.strip()
+
+        if not line:
+            continue
+
+        prefix = [c for c in comments if line.startswith(c)]
+
+        if prefix:
+            if section_is_comment:
+                section = rv.setdefault(line[len(prefix[0]):].strip(), {})
+
+            continue
+        elif line.startswith('[') and line.endswith(']'):
+            section = rv.setdefault(line[1:-1], {})
+            continue
+
+        if separator in line:
+            prop, val = line.split(separator, 1)
+            prop, val = prop.strip(), val.strip()
+        else:
+            # Property without value
+            prop, val = line, "!!!null"
+
+        if len(quote) and val.startswith(quote) and val.endswith(quote):
+            val = _unescape(val[len(quote):-len(quote)])
+        elif not len(quote) and val == '""':
+            val = ""
+        elif val != "!!!null":
+            val = _decode_scalar(val, convert_bools, convert_nums)
+
+        if prop in section:
+            # Repeated property is a list
+            if not isinstance(section[prop], list):
+                section[prop] = [section[prop]]
+
+            section[prop].append(val)
+        else:
+            section[prop] = val
+
+    return rv
+
+
+def _null_to_str(data):
+    """Replace all None values by the "null" string."""
+
+    if isinstance(data, dict):
+        for key, val in data.items():
+            data[key] = _null_to_str(val)
+    elif isinstance(data, list):
+        for i, val in enumerate(data):
+            data[i] = _null_to_str(val)
+    elif data is None:
+        return "null"
+
+    return data
+
+
+def decode_json(data):
+    """Convert JSON format into Python data structure."""
 
-    # Try to evaluate the value of the special string
     try:
-        ret = eval(ret)
-    except Exception:
-        # Return empty string if something went wrong
-        ret = ''
+        if isinstance(data, string_types):
+            rv = json.loads(data)
+        else:
+            rv = json.load(data)
+    except ValueError as e:
+        raise errors.AnsibleFilterError("Unable to parse JSON: %s" % e)
 
-    return str(ret)
+    return _null_to_str(rv)
 
 
-def template_replace(data, replacement):
-    """Replace special template decorated variable with its real value."""
+def decode_nginx(data, semicolon=';', semicolon_ignore_postfix='!;'):
+    """Convert Nginx format into Python data structure."""
 
-    # Make the replacement variable visible for the __eval_replace function
-    global __item
-    __item = replacement
+    # Return value
+    rv = []
+    # Stack of the open sections
+    stack = [rv]
+    # Directive being read
+    buf = ''
+    quote = None
+    # Indentation of the first line of the directive
+    indent = 0
+
+    def add(item, postfix=''):
+        item = item.strip()
+
+        if item:
+            stack[-1].append(item + postfix)
+
+    for line in _lines(data):
+        stripped = line.lstrip()
+
+        if quote is None and buf.strip():
+            if not stripped:
+                continue
+            elif (
+                    len(line) - len(stripped) > indent or
+                    stripped.startswith('{')):
+                # Directive continues on the more indented line
+                buf += "\n"
+            else:
+                # Directive not terminated by the semicolon
+                add(buf, semicolon_ignore_postfix)
+                buf = ''
+
+        if not buf.strip():
+            indent = len(line) - len(stripped)
+
+        i = 0
+
+        while i < len(line):
+            c = line[i]
+
+            if quote is not None:
+                buf += c
+
+                if c == '\\' and i + 1 < len(line):
+                    buf += line[i+1]
+                    i += 1
+                elif c == quote:
+                    quote = None
+            elif c in ('"', "'"):
+                quote = c
+                buf += c
+            elif c == '#' and not buf.strip():
+                # Comment till the end of the line
+                add(line[i:])
+                break
+            elif line.startswith(semicolon, i):
+                add(buf)
+                buf = ''
+                i += len(semicolon)
+                continue
+            elif c == '{':
+                section = []
+                stack[-1].append({buf.strip(): section})
+                stack.append(section)
+                buf = ''
+            elif c == '}':
+                add(buf, semicolon_ignore_postfix)
+                buf = ''
+
+                if len(stack) == 1:
+                    raise errors.AnsibleFilterError(
+                        "Unexpected closing bracket: %s" % line.strip())
+
+                stack.pop()
+            else:
+                buf += c
 
-    # Clone the data to keep the original untouched
-    local_data = copy(data)
+            i += 1
 
-    # Walk through the data structure and try to replace all special strings
-    if isinstance(local_data, list):
-        local_data = map(
-            lambda x: template_replace(x, replacement), local_data)
-    elif isinstance(local_data, dict):
-        for key, val in local_data.items():
-            local_data[key] = template_replace(val, replacement)
-    elif isinstance(local_data, string_types):
-        # Replace the special string by it's evaluated value
-        p = re.compile(r'\{\[\{\s*(\w+)([^}\s]+|)\s*\}\]\}')
-        local_data = p.sub(__eval_replace, local_data)
+        if quote is not None:
+            buf += "\n"
 
-    return local_data
+    if quote is not None:
+        raise errors.AnsibleFilterError("Unterminated string: %s" % buf)
+    elif len(stack) > 1:
+        raise errors.AnsibleFilterError("Unclosed section")
 
+    # Directive not terminated by the semicolon
+    add(buf, semicolon_ignore_postfix)
 
-class FilterModule(object):
-    """Ansible encoder Jinja2 filters."""
+    return rv
 
-    def filters(self):
-        """Expose filters to ansible."""
 
-        return {
-            'encode_apache': encode_apache,
-            'encode_erlang': encode_erlang,
-            'encode_haproxy': encode_haproxy,
-            'encode_ini': encode_ini,
-            'encode_json': encode_json,
-            'encode_logstash': encode_logstash,
-            'encode_lua': encode_lua,
-            'encode_nginx': encode_nginx,
-            'encode_pam': encode_pam,
-            'encode_toml': encode_toml,
-            'encode_xml': encode_xml,
-            'encode_yaml': encode_yaml,
-            'template_replace': template_replace,
-        }
+_toml_escapes = {
+    'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class _TomlIncomplete(Exception):
+    """Raised when the TOML value continues on the next line."""
+
+
+def _toml_string(data, i):
+    """Parse TOML string starting at the position i."""
+
+    quote = data[i]
+    multiline = data.startswith(quote * 3, i)
+    rv = ''
+    i += 3 if multiline else 1
+
+    if multiline and data.startswith('\n', i):
+        # Newline following the opening quotes is trimmed
+        i += 1
+
+    while i < len(data):
+        c = data[i]
+
+        if c == quote and not multiline:
+            return rv, i + 1
+        elif c == quote and data.startswith(quote * 3, i):
+            # Up to two quotes might precede the closing quotes
+            end = i + 3
+
+            while end < len(data) and end < i + 5 and data[end] == quote:
+                end += 1
+
+            return rv + quote * (end - i - 3), end
+        elif c == '\n' and not multiline:
+            break
+        elif (
+                c == '\\' and quote == '"' and multiline and
+                not data[i+1:].split('\n', 1)[0].strip()):
+            # Line ending backslash trims the following whitespaces
+            i += 1
+
+            while i < len(data) and data[i] in ' \t\n':
+                i += 1
+
+            continue
+        elif (
+                c == '\\' and i + 1 < len(data) and
+                not (multiline and quote == "'")):
+            c = data[i+1]
+            i += 2
+
+            if quote == '"' and c in ('u', 'U'):
+                size = 4 if c == 'u' else 8
+                rv += unichr(int(data[i:i+size], 16))
+                i += size
+            elif quote == '"':
+                rv += _toml_escapes.get(c, c)
+            else:
+                rv += c
+
+            continue
+
+        rv += c
+        i += 1
+
+    if multiline:
+        raise _TomlIncomplete()
+
+    raise errors.AnsibleFilterError("Unterminated string: %s" % data)
+
+
+def _toml_skip(data, i):
+    """Skip whitespaces and comments."""
+
+    while i < len(data):
+        if data[i] in ' \t\n':
+            i += 1
+        elif data[i] == '#':
+            while i < len(data) and data[i] != '\n':
+                i += 1
+        else:
+            break
+
+    return i
+
+
+def _toml_key(data, i, end):
+    """Parse dotted TOML key finished by any of the end characters."""
+
+    rv = []
+    key = ''
+
+    while True:
+        i = _toml_skip(data, i)
+
+        if i >= len(data):
+            raise errors.AnsibleFilterError("Unterminated key: %s" % data)
+        elif data[i] in ('"', "'"):
+            key, i = _toml_string(data, i)
+            i = _toml_skip(data, i)
+        else:
+            start = i
+
+            while i < len(data) and data[i] not in '.' + end:
+                i += 1
+
+            key = data[start:i].strip()
+
+        rv.append(key)
+
+        if i < len(data) and data[i] == '.':
+            i += 1
+        else:
+            return rv, i
+
+
+def _toml_value(data, i, convert_bools, convert_nums):
+    """Parse TOML value starting at the position i."""
+
+    i = _toml_skip(data, i)
+
+    if i >= len(data):
+        raise _TomlIncomplete()
+
+    c = data[i]
+
+    if c in ('"', "'"):
+        val, i = _toml_string(data, i)
+
+        return _decode_scalar(val, convert_bools, convert_nums), i
+    elif c in ('[', '{'):
+        rv = [] if c == '[' else {}
+        end = ']' if c == '[' else '}'
+        i += 1
+
+        while True:
+            i = _toml_skip(data, i)
+
+            if i >= len(data):
+                raise _TomlIncomplete()
+            elif data[i] == end:
+                return rv, i + 1
+            elif data[i] == ',':
+                i += 1
+            elif end == ']':
+                val, i = _toml_value(data, i, convert_bools, convert_nums)
+                rv.append(val)
+            else:
+                keys, i = _toml_key(data, i, '=')
+                val, i = _toml_value(
+                    data, i + 1, convert_bools, convert_nums)
+                _toml_table(rv, keys[:-1])[keys[-1]] = val
+
+    start = i
+
+    while i < len(data) and data[i] not in ',]}#\n':
+        i += 1
+
+    val = data[start:i].strip()
+
+    if val in ('true', 'false'):
+        return val == 'true', i
+    elif _str_is_int(val.replace('_', '')):
+        return int(val.replace('_', '')), i
+    elif _str_is_float(val.replace('_', '')):
+        return float(val.replace('_', '')), i
+
+    # Values like dates are kept as strings
+    return _decode_scalar(val, convert_bools, convert_nums), i
+
+
+def _toml_end(data, i, end):
+    """Verify that only a comment follows the end characters."""
+
+    if (
+            not data.startswith(end, i) or
+            _toml_skip(data, i + len(end)) < len(data)):
+        raise errors.AnsibleFilterError("Unsupported syntax: %s" % data)
+
+
+def _toml_table(data, keys):
+    """Return the table addressed by the keys."""
+
+    for key in keys:
+        data = data.setdefault(key, {})
+
+        if isinstance(data, list):
+            data = data[-1]
+
+    return data
+
+
+def decode_toml(data, convert_bools=False, convert_nums=False):
+    """Convert TOML format into Python data structure."""
+
+    # Return value
+    rv = {}
+    # Table of the current section
+    table = rv
+    # Value spreading over multiple lines
+    buf = ''
+
+    for line in _lines(data):
+        if buf:
+            line = "%s\n%s" % (buf, line)
+            buf = ''
+
+        stripped = line.strip()
+
+        if not stripped or stripped.startswith('#'):
+            continue
+        elif stripped.startswith('[['):
+            keys, i = _toml_key(stripped, 2, ']')
+            _toml_end(stripped, i, ']]')
+            table = {}
+            _toml_table(rv, keys[:-1]).setdefault(keys[-1], []).append(table)
+        elif stripped.startswith('['):
+            keys, i = _toml_key(stripped, 1, ']')
+            _toml_end(stripped, i, ']')
+            table = _toml_table(rv, keys)
+        else:
+            keys, i = _toml_key(line, 0, '=')
+
+            if i >= len(line):
+                raise errors.AnsibleFilterError(
+                    "Unsupported syntax: %s" % line)
+
+            try:
+                val, i = _toml_value(
+                    line, i + 1, convert_bools, convert_nums)
+            except _TomlIncomplete:
+                buf = line
+                continue
+
+            _toml_end(line, i, '')
+            _toml_table(table, keys[:-1])[keys[-1]] = val
+
+    if buf:
+        raise errors.AnsibleFilterError("Unterminated value: %s" % buf)
+
+    return rv
+
+
+def cef_normalize(data, convert_bools=False, convert_nums=False):
+    """Create immutable and presorted copy of the data structure."""
+
+    kind, data = _node(data)
+
+    if kind == 'dict':
+        return _FrozenDict(
+            (k, cef_normalize(v, convert_bools, convert_nums))
+            for k, v in data.items())
+    elif kind == 'list':
+        return _FrozenList(
+            cef_normalize(v, convert_bools, convert_nums) for v in data)
+    elif kind == 'str':
+        if convert_bools and _str_is_bool(data):
+            return _BoolStr(data)
+        elif convert_nums and _str_is_num(data):
+            return _NumStr(data)
+
+    return data
+
+
+_template_re = re.compile(r'\{\[\{\s*(\w+)([^}\s]+|)\s*\}\]\}')
+
+
+def __eval_replace(match, replacement):
+    """Evaluate the real value of the variable specified as a string."""
+
+    ret = '__item'
+    ret += ''.join(match.groups()[1:])
+
+    # Try to evaluate the value of the special string
+    try:
+        ret = eval(ret, {}, {'__item': replacement})
+    except Exception:
+        # Return empty string if something went wrong
+        ret = ''
+
+    return str(ret)
+
+
+def template_replace(data, replacement):
+    """Replace special template decorated variable with its real value."""
+
+    # Clone the data to keep the original untouched
+    local_data = copy(data)
+
+    # Walk through the data structure and try to replace all special strings
+    if isinstance(local_data, list):
+        local_data = map(
+            lambda x: template_replace(x, replacement), local_data)
+    elif isinstance(local_data, dict):
+        for key, val in local_data.items():
+            local_data[key] = template_replace(val, replacement)
+    elif isinstance(local_data, string_types):
+        # Replace the special string by it's evaluated value
+        local_data = _template_re.sub(
+            lambda match: __eval_replace(match, replacement), local_data)
+
+    return local_data
+
+
+def _file_digest(path):
+    """Return SHA1 digest of the file content."""
+
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+# Version of the encoders used to invalidate the cached results
+_VERSION = _file_digest(__file__)
+# Estimated size of each cache directory and the writes since its last scan
+_cache_usage = {}
+# Number of writes after which the cache directory is scanned again as
+# other processes write into it as well
+CACHE_SCAN_WRITES = 100
+
+
+def _fingerprint_data(data, parts):
+    """Serialize the data tagging each key and value by its type.
+
+    The values serialized the same way by JSON (e.g. True and 'true' or 1 and
+    1.0) are encoded differently so their fingerprints must differ as well.
+    """
+
+    if isinstance(data, dict):
+        parts.append('{%d' % len(data))
+
+        for key, val in data.items():
+            _fingerprint_data(key, parts)
+            _fingerprint_data(val, parts)
+    elif isinstance(data, (list, tuple)):
+        parts.append('%s[%d' % (type(data).__name__, len(data)))
+
+        for val in data:
+            _fingerprint_data(val, parts)
+    else:
+        text = text_type(data) if isinstance(
+            data, string_types) else repr(data)
+        parts.append('%s:%d:%s' % (type(data).__name__, len(text), text))
+
+
+def _fingerprint(name, data, options):
+    """Return the cache key of the encoder call."""
+
+    parts = [_VERSION, name]
+    _fingerprint_data(sorted(options.items()), parts)
+    _fingerprint_data(data, parts)
+
+    return hashlib.sha1(to_bytes('\0'.join(parts))).hexdigest()
+
+
+def _cache_read(path):
+    """Read cached result and mark it as recently used."""
+
+    try:
+        with open(path, 'rb') as f:
+            rv = f.read()
+
+        os.utime(path, None)
+    except (IOError, OSError):
+        return None
+
+    return to_text(rv)
+
+
+def _cache_write(cache_dir, path, rv, cache_size):
+    """Atomically write the result into the cache and evict old results."""
+
+    try:
+        os.makedirs(cache_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            return
+
+    try:
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix='.tmp')
+
+        with os.fdopen(fd, 'wb') as f:
+            f.write(to_bytes(rv))
+
+        # Rename is atomic so concurrent forks never see a partial file
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        return
+
+    with _lock:
+        usage = _cache_usage.get(cache_dir)
+
+        if usage is not None:
+            usage[0] += len(to_bytes(rv))
+            usage[1] += 1
+
+            if usage[0] <= cache_size and usage[1] < CACHE_SCAN_WRITES:
+                return
+
+    # The directory is scanned only if it might exceed the cache size
+    total = _cache_evict(cache_dir, cache_size)
+
+    with _lock:
+        _cache_usage[cache_dir] = [total, 0]
+
+
+def _cache_evict(cache_dir, cache_size):
+    """Remove the least recently used results above the cache size.
+
+    Returns the size of the results left in the cache.
+    """
+
+    entries = []
+    total = 0
+
+    for name in os.listdir(cache_dir):
+        if name.startswith('.'):
+            continue
+
+        try:
+            st = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+
+        entries.append((st.st_mtime, st.st_size, name))
+        total += st.st_size
+
+    for _, size, name in sorted(entries):
+        if total <= cache_size:
+            break
+
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            pass
+
+        total -= size
+
+    return total
+
+
+class _Slot(int):
+    """Placeholder of a scalar value used to compile an emission plan.
+
+    The encoders render it as a number whose string representation is
+    a unique token which marks the position of the value in the output.
+    """
+
+    def __new__(cls, value, token):
+        obj = int.__new__(cls, value)
+        obj.token = token
+
+        return obj
+
+    def __str__(self):
+        return self.token
+
+    __repr__ = __str__
+
+
+def _plan_str_json(data, options):
+    """Render plain string the same way like encode_json."""
+
+    return '"%s"' % _escape(_escape(data), format='control')
+
+
+def _plan_str_lua(data, options):
+    """Render plain string the same way like encode_lua."""
+
+    return '"%s"' % _escape(_escape(data), format="control")
+
+
+def _plan_str_toml(data, options):
+    """Render plain string the same way like encode_toml."""
+
+    quote = options.get('quote', '"')
+
+    return "%s%s%s" % (quote, _escape(data, quote), quote)
+
+
+def _plan_str_yaml(data, options):
+    """Render plain string the same way like encode_yaml."""
+
+    quote = options.get('quote', '"')
+
+    return "%s%s%s" % (quote, _escape(data, quote), quote)
+
+
+def _plan_literal_yaml(data, options):
+    """Verify if the string is a block which depends on the indentation."""
+
+    return data.startswith(options.get('block_prefix', ';;;'))
+
+
+# Encoders supporting the emission plans. The values define whether the
+# output depends on the equality of the values, how many trailing characters
+# of the rendered scalar are not part of the slot, how to render a plain
+# string and which strings can't be rendered without the context.
+_PLAN_ENCODERS = {
+    'encode_json': (True, 0, _plan_str_json, None),
+    'encode_lua': (False, 1, _plan_str_lua, None),
+    'encode_toml': (False, 0, _plan_str_toml, None),
+    'encode_yaml': (False, 1, _plan_str_yaml, _plan_literal_yaml),
+}
+
+# Cache of the compiled emission plans
+_plans = OrderedDict()
+
+_slot_re = re.compile('\x00([0-9]+)\x00')
+
+
+def _plan_is_slot(data, literal, options):
+    """Verify if the scalar value can be rendered into a slot."""
+
+    if isinstance(data, string_types):
+        return literal is None or not literal(data, options)
+
+    return isinstance(data, (int, float))
+
+
+def _plan_shape(data, leaves, classes, literal, options):
+    """Return the shape signature of the data and collect its leaves."""
+
+    add = leaves.append
+
+    def shape(data):
+        t = type(data)
+
+        if t is str:
+            if literal is not None and literal(data, options):
+                # Value which is part of the plan
+                return ('v', data)
+        elif t in (bool, float, int):
+            pass
+        elif isinstance(data, dict):
+            return ('d', tuple([(k, shape(v)) for k, v in data.items()]))
+        elif isinstance(data, list):
+            return ('l', tuple([shape(v) for v in data]))
+        elif not _plan_is_slot(data, literal, options):
+            return ('v', data)
+
+        add(data)
+
+        if classes is None:
+            return 0
+
+        # Equal values must get equal slots
+        return classes.setdefault(data, len(classes))
+
+    return shape(data)
+
+
+def _plan_template(data, counter, classes, literal, options):
+    """Replace all leaves of the data by slots."""
+
+    if isinstance(data, dict):
+        return dict(
+            (k, _plan_template(v, counter, classes, literal, options))
+            for k, v in data.items())
+    elif isinstance(data, list):
+        return [
+            _plan_template(v, counter, classes, literal, options)
+            for v in data]
+    elif not _plan_is_slot(data, literal, options):
+        return data
+
+    i = next(counter)
+
+    return _Slot(classes[data] if classes is not None else i, '\x00%d\x00' % i)
+
+
+def _plan_render(name, encoder, data, options):
+    """Render the data by filling the slots of the compiled plan."""
+
+    eq_sensitive, suffix, plain_str, literal = _PLAN_ENCODERS[name]
+    leaves = []
+    classes = {} if eq_sensitive else None
+
+    try:
+        key = (
+            name,
+            tuple(sorted(options.items())),
+            _plan_shape(data, leaves, classes, literal, options))
+
+        with _lock:
+            # Move the plan to the end of the LRU order
+            plan = _plans.pop(key, None)
+
+            if plan is not None:
+                _plans[key] = plan
+    except TypeError:
+        # Unhashable data can't be compiled
+        return encoder(data, **options)
+
+    if plan is None:
+        parts = _slot_re.split(encoder(
+            _plan_template(data, count(), classes, literal, options),
+            **options))
+        plan = (parts[0::2], tuple(int(i) for i in parts[1::2]))
+
+        with _lock:
+            _plans[key] = plan
+
+            while len(_plans) > PLAN_CACHE_SIZE:
+                _plans.popitem(last=False)
+
+    fragments, slots = plan
+    rv = [fragments[0]]
+    convert = options.get('convert_bools') or options.get('convert_nums')
+
+    for i, fragment in zip(slots, fragments[1:]):
+        val = leaves[i]
+        t = type(val)
+
+        if t is int or t is float:
+            val = str(val)
+        elif t is str and not convert and val != 'null':
+            val = plain_str(val, options)
+        else:
+            val = encoder(val, **options)
+
+            if suffix:
+                val = val[:-suffix]
+
+        rv.append(val)
+        rv.append(fragment)
+
+    return ''.join(rv)
+
+
+def _split_haproxy(data, options):
+    """Split HAProxy data into the top-level sections."""
+
+    parts = []
+    first = True
+    prev_comment = False
+
+    for section in data:
+        prefix = ''
+
+        if first:
+            first = False
+        elif prev_comment:
+            prev_comment = False
+        else:
+            prefix = "\n"
+
+        if isinstance(section, dict):
+            parts.append((
+                list(section.keys())[0], prefix, encode_haproxy, [section],
+                options, ''))
+        else:
+            parts.append((
+                section, prefix + encode_haproxy([section], **options), None,
+                None, None, ''))
+            prev_comment = True
+
+    return parts
+
+
+def _split_ini(data, options):
+    """Split INI data into the standalone properties and the sections."""
+
+    comment = options.get('comment', '#')
+    section_is_comment = options.get('section_is_comment', False)
+    sub_options = dict((k, v) for k, v in options.items() if k != 'comment')
+    props = dict(
+        (k, v) for k, v in data.items() if not isinstance(v, dict))
+    parts = [('', '', encode_ini, props, options, '')]
+    # Sections are separated by an empty line from any previous content
+    sep = ''
+
+    for val in props.values():
+        if any(
+                _node(item)[0] != 'null'
+                for item in (val if isinstance(val, list) else [val])):
+            sep = "\n"
+            break
+
+    for section, props in _sorted_items(data):
+        if isinstance(props, dict):
+            if section_is_comment:
+                header = "%s %s\n" % (comment, section)
+            else:
+                header = "[%s]\n" % (section)
+
+            parts.append((
+                section, sep + header, encode_ini, props, sub_options, ''))
+            sep = "\n"
+
+    return parts
+
+
+def _split_logstash(data, options):
+    """Split Logstash data into the top-level sections."""
+
+    section_prefix = options.get('section_prefix', ':')
+    sub_options = dict(
+        (k, v) for k, v in options.items()
+        if k in ('convert_bools', 'convert_nums', 'indent', 'level'))
+    sub_options['prevtype'] = 'block'
+    parts = []
+
+    if not isinstance(data, list) or options.get('prevtype'):
+        return None
+
+    for val in data:
+        if not (
+                isinstance(val, dict) and
+                list(val.keys())[0][0] == section_prefix):
+            return None
+
+        parts.append((
+            list(val.keys())[0][1:], '', encode_logstash, val, sub_options,
+            ''))
+
+    return parts
+
+
+def _split_nginx(data, options):
+    """Split Nginx data into the top-level sections and lines."""
+
+    if options.get('hash_sizes'):
+        # Sizes depend on all sections of the http block
+        return None
+
+    level = options.get('level', 0)
+    indent = options.get('indent', "  ")
+    block_semicolon = options.get('block_semicolon', False)
+    sub_options = dict(
+        (k, v) for k, v in options.items()
+        if k in ('block_semicolon', 'semicolon', 'semicolon_ignore_postfix'))
+    sub_options['level'] = level + 1
+    suffix = "%s}%s\n" % (
+        level*indent,
+        options.get('semicolon', ';') if block_semicolon else '')
+    parts = []
+    item_type = ""
+
+    for item in data:
+        kind, item = _node(item)
+
+        if kind == 'dict':
+            prefix = "\n" if item_type in ('section', 'line') else ''
+            name = list(item.keys())[0]
+            parts.append((
+                name, "%s%s%s {\n" % (prefix, level*indent, name),
+                encode_nginx, list(item.values())[0], sub_options, suffix))
+            item_type = 'section'
+        else:
+            prefix = "\n" if item_type == 'section' else ''
+            parts.append((
+                item, prefix + encode_nginx([item], **options), None, None,
+                None, ''))
+            item_type = 'line'
+
+    return parts
+
+
+def _split_toml(data, options):
+    """Split TOML data into the top-level keys and tables."""
+
+    if (
+            not isinstance(data, dict) or
+            options.get('compact') or
+            set(options) & set(('first', 'table_name', 'table_type'))):
+        return None
+
+    quote = options.get('quote', '"')
+    # Keys with elementar value (num/str/bool/array)
+    keys = dict(
+        (k, v) for k, v in data.items()
+        if not (
+            isinstance(v, dict) or (
+                isinstance(v, list) and v and isinstance(v[0], dict))))
+    parts = [('', '', encode_toml, keys, options, '')]
+    first = not keys
+
+    for k, v in _sorted_items(data):
+        is_table = isinstance(v, dict)
+
+        if not is_table and not (
+                isinstance(v, list) and (not v or isinstance(v[0], dict))):
+            continue
+
+        tk = k
+
+        if '.' in k:
+            tk = "%s%s%s" % (quote, _escape(k, quote), quote)
+
+        if is_table:
+            parts.append((k, '', encode_toml, v, dict(
+                options, first=first, table_name=tk, table_type='table'), ''))
+            first = False
+        else:
+            # Array of tables
+            for i, t in enumerate(v):
+                parts.append(("%s[%d]" % (k, i), '', encode_toml, t, dict(
+                    options, first=first, table_name=tk,
+                    table_type='table_array'), ''))
+                first = False
+
+    return parts
+
+
+# Functions splitting the data into the top-level parts of the document
+_SPLITTERS = {
+    'encode_haproxy': _split_haproxy,
+    'encode_ini': _split_ini,
+    'encode_logstash': _split_logstash,
+    'encode_nginx': _split_nginx,
+    'encode_toml': _split_toml,
+}
+
+
+def _render_part(job):
+    """Render single part of the document."""
+
+    func, data, options = job
+
+    return func(data, **options)
+
+
+def _render_parts(parts, workers=0, max_bytes=None):
+    """Render all parts of the document and join them in order."""
+
+    jobs = [p[2:5] for p in parts if p[2] is not None]
+    texts = None
+
+    if workers > 1 and len(jobs) > 1:
+        if hasattr(multiprocessing, 'get_context'):
+            ctx = multiprocessing.get_context('fork')
+        else:
+            ctx = multiprocessing
+
+        try:
+            pool = ctx.Pool(workers)
+        except (AssertionError, OSError):
+            # Daemonic processes are not allowed to have children
+            pool = None
+
+        if pool is not None:
+            try:
+                texts = pool.map_async(
+                    _render_part, jobs, len(jobs) // (workers * 4) + 1).get(
+                        WORKERS_TIMEOUT)
+            except Exception:
+                # Jobs which fail to (un)pickle are lost by the workers and
+                # errors of the encoders are raised by the serial rendering
+                pool.terminate()
+            else:
+                pool.close()
+            finally:
+                pool.join()
+
+    if texts is None:
+        # The serial rendering stops at the first part exceeding the limit
+        texts = (_render_part(job) for job in jobs)
+
+    texts = iter(texts)
+
+    def chunks():
+        for _, prefix, func, _, _, suffix in parts:
+            yield prefix
+
+            if func is not None:
+                yield next(texts)
+
+            yield suffix
+
+    return ''.join(_budget(chunks(), max_bytes))
+
+
+# Options handled by the filters and not by the encoders
+_FILTER_OPTIONS = (
+    'cache', 'cache_size', 'layers', 'max_bytes', 'max_depth', 'max_nodes',
+    'only', 'plan', 'profile', 'workers', 'workers_threshold')
+
+
+def _chunks(parts):
+    """Generate the rendered parts of the document one by one.
+
+    Parts split into more parts are rendered recursively so no large part
+    of the document is ever held in memory.
+    """
+
+    for _, prefix, func, data, options, suffix in parts:
+        if prefix:
+            yield prefix
+
+        if func is not None:
+            sub_parts = None
+
+            if func.__name__ in _SPLITTERS:
+                sub_parts = _SPLITTERS[func.__name__](data, options)
+
+            if sub_parts is not None and len(sub_parts) > 1:
+                for chunk in _chunks(sub_parts):
+                    yield chunk
+            else:
+                yield func(data, **options)
+
+        if suffix:
+            yield suffix
+
+
+def _budget(chunks, max_bytes=None):
+    """Generate the chunks until their total size exceeds the limit."""
+
+    size = 0
+
+    for chunk in chunks:
+        if max_bytes is not None:
+            size += len(to_bytes(chunk))
+
+            if size > max_bytes:
+                raise errors.AnsibleFilterError(
+                    "Limit max_bytes=%d exceeded by the output of at least "
+                    "%d bytes" % (max_bytes, size))
+
+        yield chunk
+
+
+def _encode_chunks(name, data, options):
+    """Generate the encoded document in chunks.
+
+    The data of encoders without a splitter and the data requiring any of
+    the options common to all filters except max_bytes are encoded as a
+    single chunk.
+    """
+
+    parts = None
+
+    if (
+            name in _SPLITTERS and
+            not set(options) & set(_FILTER_OPTIONS) - set(['max_bytes']) and
+            MAX_DEPTH is None and MAX_NODES is None):
+        max_bytes = _limit(
+            'max_bytes', options.get('max_bytes', MAX_BYTES))
+        encoder_options = dict(
+            (k, v) for k, v in options.items() if k != 'max_bytes')
+
+        if max_bytes is not None:
+            _guard(data, max_bytes=max_bytes)
+
+        parts = _SPLITTERS[name](data, encoder_options)
+
+    if parts is None:
+        yield FilterModule().filters()[name](data, **options)
+    else:
+        for chunk in _budget(_chunks(parts), max_bytes):
+            yield chunk
+
+
+def _path(path):
+    """Format the path of the node."""
+
+    rv = ''
+
+    for key in path:
+        if isinstance(key, int):
+            rv += '[%d]' % key
+        elif rv:
+            rv += '.%s' % key
+        else:
+            rv = to_text(key)
+
+    return rv or '(root)'
+
+
+def _guard(data, max_depth=None, max_nodes=None, max_bytes=None):
+    """Verify the data structure doesn't exceed the limits."""
+
+    # Number of the visited nodes
+    nodes = 0
+    # Minimal size of the output
+    size = 0
+    stack = [(data, (), 1)]
+
+    while stack:
+        node, path, depth = stack.pop()
+        nodes += 1
+        children = None
+
+        if isinstance(node, dict):
+            children = [
+                (val, path + (key,), depth + 1)
+                for key, val in node.items()]
+
+            if max_bytes is not None:
+                size += sum(len(to_bytes(key)) for key in node)
+        elif isinstance(node, (list, tuple)):
+            children = [
+                (val, path + (i,), depth + 1)
+                for i, val in enumerate(node)]
+        elif max_bytes is not None:
+            size += len(to_bytes(node))
+
+        if (
+                children is not None and
+                max_depth is not None and
+                depth > max_depth):
+            limit = 'max_depth=%d' % max_depth
+        elif max_nodes is not None and nodes > max_nodes:
+            limit = 'max_nodes=%d' % max_nodes
+        elif max_bytes is not None and size > max_bytes:
+            limit = 'max_bytes=%d' % max_bytes
+        else:
+            limit = None
+
+        if limit is not None:
+            raise errors.AnsibleFilterError(
+                "Limit %s exceeded at %s" % (limit, _path(path)))
+
+        if children:
+            stack.extend(reversed(children))
+
+
+def _guard_output(data, max_bytes=None):
+    """Verify the encoded data doesn't exceed the limit."""
+
+    # UTF-8 encodes each character into at most 4 bytes
+    if max_bytes is not None and len(data) * 4 > max_bytes:
+        size = len(to_bytes(data))
+
+        if size > max_bytes:
+            raise errors.AnsibleFilterError(
+                "Limit max_bytes=%d exceeded by the output of %d bytes" % (
+                    max_bytes, size))
+
+    return data
+
+
+def _limit(name, value):
+    """Return the value of the limit as a number."""
+
+    if value is None:
+        return None
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise errors.AnsibleFilterError(
+            "Invalid value of the %s limit: %s" % (name, value))
+
+
+# Value marking the position of the rendered subtree
+_only_marker = 'cef0only0marker'
+_only_re = re.compile(r'([^.\[\]]+)|\[(-?[0-9]+)\]')
+# Encoders with single-key dicts in lists rendered as named blocks
+_ONLY_BLOCKS = (
+    'encode_apache', 'encode_haproxy', 'encode_logstash', 'encode_nginx')
+
+
+def _only_path(path):
+    """Return the path as a list of keys and indexes."""
+
+    if not isinstance(path, string_types):
+        return list(path)
+
+    return [
+        int(index) if index else key
+        for key, index in _only_re.findall(path)]
+
+
+def _only_block(item, options):
+    """Check whether the item is a Logstash block."""
+
+    return (
+        isinstance(item, dict) and len(item) == 1 and
+        list(item)[0].startswith(options.get('section_prefix', ':')))
+
+
+def _only_leaf(name, key, item, options, marker=_only_marker):
+    """Return the marker taking the place of the subtree.
+
+    The marker must be accepted by the encoder at the position of the
+    subtree and the first and the last line of its output must contain the
+    marker.
+    """
+
+    if name == 'encode_apache':
+        option = {marker: marker}
+        section = {
+            'name': marker, 'param': marker,
+            'content': [{'options': [option]}]}
+
+        if key == 'content':
+            return [{'options': [option]}]
+        elif key == 'sections':
+            return [section]
+        elif key == 'options':
+            return [option]
+        elif not isinstance(item, dict):
+            # Values of the options and of the sections are inline
+            return None if key in (
+                None, 'name', 'operator', 'param') or isinstance(
+                    key, int) else marker
+        elif 'content' in item:
+            return section
+        elif 'options' in item or 'sections' in item:
+            return {'options': [option]}
+
+        return option
+    elif name == 'encode_xml':
+        sign = options.get('attribute_sign', '^')
+
+        if isinstance(key, string_types) and key.startswith(sign):
+            return None
+        elif isinstance(key, int):
+            if isinstance(item, dict) and any(
+                    isinstance(k, string_types) and k.startswith(sign)
+                    for k in item):
+                # Attributes are rendered in the tag of the parent
+                return None
+
+            return {marker: ''}
+    elif name == 'encode_logstash' and _only_block(item, options):
+        # The closing bracket of a block can't contain the marker
+        return None
+
+    return marker
+
+
+def _only_prune(name, data, path, options, in_list=False, leaf=None):
+    """Return data containing only the path to the subtree.
+
+    Returns the data with the marker and with the subtree and the subtree
+    itself. The leaf returns the marker of the subtree addressed exactly by
+    the path, the keys of the blocks and of the list items aren't resolved
+    then.
+    """
+
+    kind, data = _node(data)
+    key = path[0]
+    keep = {}
+
+    if (
+            leaf is None and name in _ONLY_BLOCKS and in_list and
+            len(path) == 1 and
+            kind == 'dict' and len(data) == 1 and key in data):
+        # Key of the block addresses the whole block
+        return _only_leaf(name, None, data, options), data, data
+    elif kind == 'dict' and key in data:
+        item = data[key]
+
+        if name == 'encode_yaml' and in_list and min(data) != key:
+            # The first key of a list item is rendered after the dash
+            keep[min(data)] = _only_marker[::-1]
+        elif name == 'encode_apache' and 'content' in data:
+            # Name and parameter of the section
+            keep = dict(
+                (k, v) for k, v in data.items()
+                if k in ('name', 'operator', 'param'))
+    elif kind == 'list' and isinstance(key, int) and -len(data) <= key < len(
+            data):
+        item = data[key]
+    elif kind == 'list' and leaf is None:
+        # Item of the list addressed by its key
+        for item in data:
+            if isinstance(item, dict) and key in item:
+                break
+        else:
+            raise errors.AnsibleFilterError(
+                "Path not found: %s" % _path(path))
+
+        key = None
+        path = [None] + path
+    else:
+        raise errors.AnsibleFilterError("Path not found: %s" % _path(path))
+
+    if len(path) == 1 and leaf is not None:
+        marked = leaf(key, item, kind == 'list')
+        real = subtree = item
+    elif len(path) == 1:
+        marked = _only_leaf(name, key, item, options)
+        real = subtree = item
+    else:
+        marked, real, subtree = _only_prune(
+            name, item, path[1:], options, kind == 'list', leaf)
+
+    if marked is None:
+        return None, real, subtree
+    elif kind == 'list':
+        return [marked], [real], subtree
+
+    marked_dict = dict(keep)
+    marked_dict[key] = marked
+    real_dict = dict(keep)
+    real_dict[key] = real
+
+    return marked_dict, real_dict, subtree
+
+
+def _only_toml(data, path, options):
+    """Render the TOML table addressed by the path.
+
+    Returns None if the path doesn't address a table or an array of tables.
+    """
+
+    names = []
+    table_type = 'table'
+
+    for key in path:
+        kind, data = _node(data)
+
+        if kind == 'list' and isinstance(key, int):
+            if not -len(data) <= key < len(data):
+                raise errors.AnsibleFilterError(
+                    "Path not found: %s" % _path(path))
+            elif not all(isinstance(item, dict) for item in data):
+                # Items of the inline arrays share the line
+                raise errors.AnsibleFilterError(
+                    "Path can't be rendered separately: %s" % _path(path))
+
+            data = data[key]
+            table_type = 'table_array'
+
+            continue
+        elif kind != 'dict' or key not in data:
+            raise errors.AnsibleFilterError(
+                "Path not found: %s" % _path(path))
+
+        quote = options.get('quote', '"')
+        names.append(
+            "%s%s%s" % (quote, _escape(key, quote), quote) if '.' in key
+            else key)
+        data = data[key]
+        table_type = 'table'
+
+    if isinstance(data, list) and data and isinstance(data[0], dict):
+        # Array of tables
+        return ''.join(
+            encode_toml(
+                t, first=i == 0, table_name='.'.join(names),
+                table_type='table_array', **options)
+            for i, t in enumerate(data))
+    elif isinstance(data, dict):
+        return encode_toml(
+            data, table_name='.'.join(names), table_type=table_type,
+            **options)
+
+    return None
+
+
+def _only_render(name, encoder, data, path, options):
+    """Render only the subtree addressed by the path.
+
+    The document is pruned to the ancestors of the subtree. It's rendered
+    once with a marker instead of the subtree to find the lines of the
+    ancestors and then with the subtree which is cut out of them.
+    """
+
+    path = _only_path(path)
+
+    if not path:
+        return encoder(data, **options)
+    elif name == 'encode_pam':
+        # Rules have no context
+        if len(path) > 1 or path[0] not in data:
+            raise errors.AnsibleFilterError(
+                "Path not found: %s" % _path(path))
+
+        return encoder({path[0]: data[path[0]]}, **options)
+    elif name == 'encode_toml':
+        rv = _only_toml(data, path, options)
+
+        if rv is not None:
+            return rv
+
+    marked, real, subtree = _only_prune(name, data, path, options)
+
+    if marked is None and name == 'encode_logstash':
+        # Blocks are rendered directly on the level given by their parents
+        prefix = options.get('section_prefix', ':')
+        blocks = [
+            key for key in path
+            if isinstance(key, string_types) and key.startswith(prefix)]
+        options = dict(options, prevtype='block')
+        options['level'] = options.get('level', 0) + len(blocks) - (
+            path[-1] in subtree)
+
+        return encoder(subtree, **options)
+
+    found = []
+
+    if marked is not None:
+        lines = encoder(marked, **options).splitlines(True)
+        found = [i for i, line in enumerate(lines) if _only_marker in line]
+
+    if not found:
+        raise errors.AnsibleFilterError(
+            "Path can't be rendered separately: %s" % _path(path))
+
+    head = found[0]
+    tail = len(lines) - found[-1] - 1
+    lines = encoder(real, **options).splitlines(True)
+
+    return ''.join(lines[head:len(lines) - tail])
+
+
+# Costs of the encoded paths collected by the profile option
+_profile = {}
+
+
+def _profile_frame(key):
+    """Format the key as a frame of the folded stack."""
+
+    if isinstance(key, int) and not isinstance(key, bool):
+        return '[%d]' % key
+
+    return to_text(key).replace(';', ',')
+
+
+def _profile_render(name, encoder, data, args, kwargs):
+    """Render the data and record the costs of each path of the data.
+
+    The time and the output bytes of each recursive call of the encoder are
+    attributed to the path of the dict or list it encodes. Calls encoding
+    scalars are attributed to the path of their parent.
+    """
+
+    paths = {}
+    stack = [(data, (name,))]
+
+    while stack:
+        node, path = stack.pop()
+
+        if isinstance(node, dict):
+            items = node.items()
+        elif isinstance(node, (list, tuple)):
+            items = enumerate(node)
+        else:
+            continue
+
+        paths[id(node)] = ';'.join(path)
+        stack.extend(
+            (val, path + (_profile_frame(key),)) for key, val in items)
+
+    # Recursive encoders (generators are resumed repeatedly)
+    codes = set(
+        func.__code__ for func_name, func in globals().items()
+        if func_name.startswith(('encode_', '_compact_')) and
+        callable(func) and not func.__code__.co_flags & 0x20)
+    timer = timeit.default_timer
+    # Path, start, time and bytes of the nested calls of each active call
+    calls = []
+    stats = {}
+
+    def hook(frame, event, arg):
+        code = frame.f_code
+
+        if code not in codes:
+            return
+        elif event == 'call':
+            node = frame.f_locals.get(code.co_varnames[0])
+            path = paths.get(id(node))
+            own = path is not None
+
+            if not own:
+                path = calls[-1][0] if calls else name
+
+            calls.append([path, own, timer(), 0.0, 0])
+        elif event == 'return' and calls:
+            path, own, start, nested_time, nested_bytes = calls.pop()
+            elapsed = timer() - start
+            size = len(arg) if isinstance(arg, string_types) else 0
+            rec = stats.setdefault(path, [0, 0.0, 0])
+            rec[0] += own
+            rec[1] += elapsed - nested_time
+            rec[2] += size - nested_bytes
+
+            if calls:
+                calls[-1][3] += elapsed
+                calls[-1][4] += size
+
+    profiler = sys.getprofile()
+    sys.setprofile(hook)
+
+    try:
+        rv = encoder(data, *args, **kwargs)
+    finally:
+        sys.setprofile(profiler)
+
+    return rv, stats
+
+
+def _profile_merge(profile, stats):
+    """Add the costs of the paths into the profile."""
+
+    for path, (calls, elapsed, size) in stats.items():
+        rec = profile.setdefault(path, [0, 0.0, 0])
+        rec[0] += calls
+        rec[1] += elapsed
+        rec[2] += size
+
+
+def _profile_save(path, stats):
+    """Add the costs of the paths into the profile file."""
+
+    with open(path, 'a+') as f:
+        if fcntl is not None:
+            # Forked Ansible workers can write the file at the same time
+            fcntl.flock(f, fcntl.LOCK_EX)
+
+        f.seek(0)
+        content = f.read()
+        profile = json.loads(content) if content else {}
+        _profile_merge(profile, stats)
+        f.seek(0)
+        f.truncate()
+        json.dump(profile, f, sort_keys=True)
+
+
+def cef_profile(
+        data=None, format='table', metric='time', top=20, reset=False):
+    """Report the costs collected by the profile option of the encoders.
+
+    The data is the path of the profile file or None for the profile
+    collected in memory. The format is either table (the top paths by their
+    total cost) or folded (the folded stacks for the flame graph tools).
+    """
+
+    if data is None:
+        with _lock:
+            profile = dict((k, list(v)) for k, v in _profile.items())
+
+            if reset:
+                _profile.clear()
+    elif isinstance(data, dict):
+        profile = data
+    else:
+        with open(data) as f:
+            profile = json.load(f)
+
+    if metric not in ('bytes', 'time'):
+        raise errors.AnsibleFilterError("Unknown metric: %s" % metric)
+
+    index = 1 if metric == 'time' else 2
+
+    if format == 'folded':
+        return ''.join(
+            '%s %d\n' % (path, max(
+                round(rec[index] * 1000000) if index == 1 else rec[index],
+                0))
+            for path, rec in sorted(profile.items()))
+    elif format != 'table':
+        raise errors.AnsibleFilterError("Unknown format: %s" % format)
+
+    # Costs including the costs of the nested paths
+    total = dict((path, [0.0, 0]) for path in profile)
+
+    for path, rec in profile.items():
+        frames = path.split(';')
+
+        for i in range(len(frames), 0, -1):
+            prefix = ';'.join(frames[:i])
+
+            if prefix in total:
+                total[prefix][0] += rec[1]
+                total[prefix][1] += rec[2]
+
+    rows = sorted(
+        profile, key=lambda path: (-total[path][index - 1], path))[:top]
+    rv = "%-48s %8s %11s %11s %11s %11s\n" % (
+        'path', 'calls', 'total [ms]', 'self [ms]', 'total [B]', 'self [B]')
+
+    for path in rows:
+        frames = path.split(';')
+        label = ''
+
+        for frame in frames[1:]:
+            label += frame if frame.startswith('[') or not label else (
+                '.%s' % frame)
+
+        rv += "%-48s %8d %11.3f %11.3f %11d %11d\n" % (
+            '%s %s' % (frames[0], label or '(root)'), profile[path][0],
+            total[path][0] * 1000, profile[path][1] * 1000, total[path][1],
+            profile[path][2])
+
+    return rv
+
+
+# Length of the messages exchanged with the render server
+_server_header = struct.Struct('>I')
+# Indicates that this process is the render server
+_serving = False
+# Connection of each thread to the render server
+_client = threading.local()
+# Results rendered by the render server and their total size
+_results = OrderedDict()
+_results_size = [0]
+
+
+def _plain(data):
+    """Return copy of the data consisting only of the marshallable types."""
+
+    kind, data = _node(data)
+
+    if kind == 'dict':
+        return dict((_plain(key), _plain(val)) for key, val in data.items())
+    elif kind == 'list':
+        return [_plain(val) for val in data]
+    elif kind == 'str':
+        return text_type(data)
+    elif kind == 'null' or type(data) in (bool, float, int):
+        return data
+
+    raise TypeError("Can't be sent to the render server: %s" % type(data))
+
+
+def _send(sock, data):
+    """Send the data serialized by marshal."""
+
+    payload = marshal.dumps(data)
+
+    sock.sendall(_server_header.pack(len(payload)))
+    sock.sendall(payload)
+
+
+def _recv_exactly(sock, size):
+    """Receive exactly the given number of bytes."""
+
+    rv = bytearray(size)
+    view = memoryview(rv)
+    pos = 0
+
+    while pos < size:
+        n = sock.recv_into(view[pos:], size - pos)
+
+        if not n:
+            raise EOFError("Connection closed")
+
+        pos += n
+
+    return bytes(rv)
+
+
+def _recv(sock):
+    """Receive the serialized data and return them as bytes."""
+
+    size, = _server_header.unpack(_recv_exactly(sock, _server_header.size))
+
+    return _recv_exactly(sock, size)
+
+
+def _server_render(name, data, args, kwargs):
+    """Render the data by the render server.
+
+    Returns None if the server isn't running or if the data can't be sent
+    to it so the caller can render them itself.
+    """
+
+    # The limits of this process apply also on the server
+    kwargs = dict(kwargs)
+    kwargs.setdefault('max_depth', MAX_DEPTH)
+    kwargs.setdefault('max_nodes', MAX_NODES)
+    kwargs.setdefault('max_bytes', MAX_BYTES)
+    request = (name, data, args, kwargs)
+
+    try:
+        marshal.dumps(request)
+    except ValueError:
+        try:
+            request = (name, _plain(data), _plain(list(args)), _plain(kwargs))
+        except TypeError:
+            return None
+
+    conn = getattr(_client, 'conn', None)
+    key = (os.getpid(), SERVER_SOCKET)
+
+    if conn is not None and conn[0] != key:
+        # Connection inherited from the parent process or to other server
+        conn[1].close()
+        conn = None
+
+    # Connection kept from the previous call might be closed by the server
+    for reuse in ((True, False) if conn is not None else (False,)):
+        try:
+            if not reuse:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                conn = (key, sock)
+                sock.settimeout(SERVER_TIMEOUT)
+                sock.connect(SERVER_SOCKET)
+
+            _send(conn[1], request)
+            ok, rv = marshal.loads(_recv(conn[1]))
+        except socket.timeout:
+            # The server might still be rendering the request
+            conn[1].close()
+            conn = None
+            break
+        except (EOFError, ValueError, socket.error):
+            conn[1].close()
+            conn = None
+        else:
+            break
+
+    _client.conn = conn
+
+    if conn is None:
+        return None
+
+    if not ok:
+        raise errors.AnsibleFilterError(rv)
+
+    return rv
+
+
+class _ServerHandler(socketserver.BaseRequestHandler):
+    """Render the requests of a single client until it disconnects."""
+
+    def handle(self):
+        filters = FilterModule().filters()
+
+        while True:
+            try:
+                payload = _recv(self.request)
+            except (EOFError, socket.error):
+                return
+
+            # Results are cached under the fingerprint of the request
+            key = hashlib.sha1(payload).digest()
+
+            with _lock:
+                rv = _results.pop(key, None)
+
+                if rv is not None:
+                    _results[key] = rv
+
+            if rv is None:
+                try:
+                    name, data, args, kwargs = marshal.loads(payload)
+                    rv = (True, filters[name](data, *args, **kwargs))
+                except errors.AnsibleFilterError as e:
+                    rv = (False, to_text(e))
+                except Exception as e:
+                    rv = (False, "%s: %s" % (e.__class__.__name__, e))
+
+            if rv[0]:
+                with _lock:
+                    if key not in _results:
+                        _results[key] = rv
+                        _results_size[0] += len(rv[1])
+
+                    while _results_size[0] > SERVER_CACHE_SIZE:
+                        _results_size[0] -= len(
+                            _results.popitem(last=False)[1][1])
+
+            _send(self.request, rv)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path=None):
+    """Run the render server on the Unix socket until it's interrupted.
+
+    The encoders, the compiled emission plans and the rendered results
+    stay in the memory of the server between the Ansible tasks and forks.
+    The filters use the server whenever its socket is set by the CEF_SERVER
+    environment variable and exists.
+    """
+
+    global _serving
+
+    path = path or SERVER_SOCKET
+
+    if not path:
+        raise errors.AnsibleFilterError(
+            "Path of the render server socket is not set")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(path)
+    except socket.error:
+        # Remove socket left by a server which is not running anymore
+        if os.path.exists(path):
+            os.unlink(path)
+    else:
+        raise errors.AnsibleFilterError(
+            "Render server is already running: %s" % path)
+    finally:
+        sock.close()
+
+    _serving = True
+    umask = os.umask(0o177)
+
+    try:
+        server = _Server(path, _ServerHandler)
+    finally:
+        os.umask(umask)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def _filter(name, encoder):
+    """Wrap the encoder with the options common to all filters."""
+
+    # Parameters of the encoder which can be passed positionally
+    params = getargspec(encoder).args[1:]
+
+    def wrapper(data, *args, **kwargs):
+        if len(args) > len(params):
+            raise errors.AnsibleFilterError(
+                "Filter %s takes at most %d positional parameters" % (
+                    name, len(params)))
+
+        for key, val in zip(params, args):
+            # The options common to all filters apply also to the
+            # parameters passed positionally
+            if key in kwargs:
+                raise errors.AnsibleFilterError(
+                    "Parameter %s of the filter %s given twice" % (key, name))
+
+            kwargs[key] = val
+
+        args = ()
+
+        if (
+                SERVER_SOCKET and not _serving and
+                not kwargs.get('profile') and
+                os.path.exists(SERVER_SOCKET)):
+            rv = _server_render(name, data, args, kwargs)
+
+            if rv is not None:
+                return rv
+
+        cache = kwargs.pop('cache', None)
+        cache_size = kwargs.pop('cache_size', CACHE_SIZE)
+        plan = kwargs.pop('plan', False)
+        workers = kwargs.pop('workers', 0)
+        workers_threshold = kwargs.pop('workers_threshold', WORKERS_THRESHOLD)
+        max_depth = _limit('max_depth', kwargs.pop('max_depth', MAX_DEPTH))
+        max_nodes = _limit('max_nodes', kwargs.pop('max_nodes', MAX_NODES))
+        max_bytes = _limit('max_bytes', kwargs.pop('max_bytes', MAX_BYTES))
+        only = kwargs.pop('only', None)
+        layers = kwargs.pop('layers', None)
+        profile = kwargs.pop('profile', False)
+        raw = data
+
+        if profile and only is not None:
+            raise errors.AnsibleFilterError(
+                "Parameter profile can't be combined with only")
+
+        if layers is not None:
+            raw = [data] + list(layers)
+            data = _layered(raw)
+
+        if (
+                max_depth is not None or
+                max_nodes is not None or
+                max_bytes is not None):
+            _guard(data, max_depth, max_nodes, max_bytes)
+
+        if profile:
+            rv, stats = _profile_render(name, encoder, data, args, kwargs)
+
+            with _lock:
+                _profile_merge(_profile, stats)
+
+            if profile is not True:
+                _profile_save(profile, stats)
+
+            return _guard_output(rv, max_bytes)
+        elif only is not None:
+            return _guard_output(
+                _only_render(name, encoder, data, only, kwargs), max_bytes)
+
+        def render():
+            rv = None
+
+            if plan and name in _PLAN_ENCODERS:
+                rv = _plan_render(name, encoder, data, kwargs)
+            elif workers and name in _SPLITTERS:
+                parts = _SPLITTERS[name](data, kwargs)
+
+                if parts is not None and len(parts) >= workers_threshold:
+                    rv = _render_parts(parts, workers, max_bytes)
+            elif max_bytes is not None and name in _SPLITTERS:
+                # The rendering stops at the first part exceeding the limit
+                parts = _SPLITTERS[name](data, kwargs)
+
+                if parts is not None:
+                    rv = ''.join(_budget(_chunks(parts), max_bytes))
+
+            if rv is None:
+                rv = encoder(data, **kwargs)
+
+            return _guard_output(rv, max_bytes)
+
+        if not cache:
+            return render()
+
+        cache_dir = CACHE_DIR if cache is True else cache
+
+        try:
+            if layers is None:
+                key = _fingerprint(name, data, kwargs)
+            else:
+                # The layers are fingerprinted as they are
+                key = _fingerprint(
+                    name, raw, dict(kwargs, layers=len(raw)))
+        except (TypeError, ValueError):
+            # Data which can't be fingerprinted are not cached
+            return render()
+
+        path = os.path.join(cache_dir, key)
+        rv = _cache_read(path)
+
+        if rv is None:
+            rv = render()
+            _cache_write(cache_dir, path, rv, cache_size)
+
+        return rv
+
+    wrapper.__name__ = name
+    wrapper.__doc__ = encoder.__doc__
+
+    return wrapper
+
+
+def _diff_leaf(name, key, item, options, marker, in_list):
+    """Return the marker of the same kind like the subtree.
+
+    Returns None if the subtree can't be replaced by a marker.
+    """
+
+    kind = _node(item)[0]
+
+    if name == 'encode_pam':
+        # Rule keeps its type which separates the blocks of the rules
+        leaf = dict(item, control=marker, path=marker)
+
+        if 'service' in item:
+            leaf['service'] = marker
+
+        return leaf
+    elif name == 'encode_apache' and kind in ('dict', 'list'):
+        # Blank lines between the sections depend on their siblings
+        return None
+    elif (
+            name in _ONLY_BLOCKS and in_list and kind == 'dict' and
+            len(item) == 1):
+        if name == 'encode_logstash' or _only_block(item, options):
+            return None
+
+        # Named block
+        return {marker: [marker]}
+    elif name == 'encode_toml' and kind in ('dict', 'list'):
+        # Tables are not rendered at the position of their keys
+        return None
+
+    leaf = _only_leaf(name, key, item, options, marker)
+
+    if kind in ('dict', 'list') and _node(leaf)[0] != kind:
+        return None
+
+    return leaf
+
+
+def _diff_units(name, old, new, options, path=(), in_list=False):
+    """Return the paths of the smallest subtrees which differ.
+
+    The subtrees differing in their kind or in their keys or length are
+    not walked into. Empty path means the whole documents differ.
+    """
+
+    old_kind, old = _node(old)
+    new_kind, new = _node(new)
+
+    if name == 'encode_pam' and path:
+        # Rules are rendered on a single line
+        return [path] if old.get('type') == new.get('type') else [()]
+    elif old_kind == new_kind == 'dict' and set(old) == set(new):
+        keys = [key for key, _ in _sorted_items(new)]
+    elif old_kind == new_kind == 'list' and len(old) == len(new):
+        keys = range(len(new))
+    else:
+        return [path]
+
+    rv = []
+
+    for key in keys:
+        if old[key] == new[key]:
+            continue
+        elif new_kind == 'list' and any(
+                i != key and (old[i] == old[key] or new[i] == new[key])
+                for i in keys):
+            # Separators of the items depend on their equality to the last
+            # item
+            return [path]
+
+        units = _diff_units(
+            name, old[key], new[key], options, path + (key,),
+            new_kind == 'list')
+
+        if path + (key,) in units and (
+                _node(old[key])[0] != _node(new[key])[0] or any(
+                    _diff_leaf(
+                        name, key, item, options, _only_marker,
+                        new_kind == 'list') is None
+                    for item in (old[key], new[key]))):
+            # Subtree can't be rendered on its own
+            return [path]
+
+        rv.extend(units)
+
+    return rv
+
+
+def _diff_mark(name, data, units, options, path=(), in_list=False):
+    """Return the data with the numbered markers instead of the units."""
+
+    for i, unit in enumerate(units):
+        if unit == path:
+            return _diff_leaf(
+                name, path[-1], data, options, "%s%dz" % (_only_marker, i),
+                in_list)
+
+    kind, data = _node(data)
+
+    if not any(unit[:len(path)] == path for unit in units):
+        return data
+    elif kind == 'dict':
+        return dict(
+            (key, _diff_mark(name, val, units, options, path + (key,)))
+            for key, val in data.items())
+
+    return [
+        _diff_mark(name, val, units, options, path + (i,), True)
+        for i, val in enumerate(data)]
+
+
+def _diff_range(start, stop):
+    """Format the range of lines of the unified diff."""
+
+    if stop - start == 1:
+        return '%d' % (start + 1)
+
+    return '%d,%d' % (start if start == stop else start + 1, stop - start)
+
+
+def _diff_block(name, encoder, data, unit, options, first, last, marker):
+    """Return the lines of the subtree as they are in the whole document.
+
+    The subtree is rendered like by the only option. The text around the
+    marker in the first and the last line of the whole document rendered
+    with the markers is applied on the lines of the subtree as it might
+    depend on the siblings of the subtree (e.g. separators of the items).
+    Returns None if the lines can't be determined.
+    """
+
+    if name == 'encode_pam':
+        lines = encoder({unit[0]: data[unit[0]]}, **options).splitlines()
+
+        # Label isn't part of the rule
+        lines = lines[1:] if options.get('print_label') else lines
+
+        # Only the rules rendered on a single line are found by the marker
+        return lines if len(lines) == 1 else None
+
+    def leaf(key, item, in_list):
+        return _diff_leaf(name, key, item, options, _only_marker, in_list)
+
+    marked, real, _ = _only_prune(name, data, list(unit), options, leaf=leaf)
+    lines = encoder(marked, **options).splitlines()
+    found = [i for i, line in enumerate(lines) if _only_marker in line]
+    head = lines[found[0]]
+    tail = lines[found[-1]]
+    prefix = head[:head.index(_only_marker)]
+    suffix = tail[tail.rindex(_only_marker) + len(_only_marker):]
+    block = encoder(real, **options).splitlines()[
+        found[0]:found[-1] - len(lines) + 1 or None]
+    first = first[:first.index(marker)]
+    last = last[last.rindex(marker) + len(marker):]
+
+    if (prefix, suffix) == (first, last):
+        return block
+    elif not block or not (
+            block[0].startswith(prefix) and block[-1].endswith(suffix)):
+        return None
+
+    block[0] = first + block[0][len(prefix):]
+    block[-1] = block[-1][:len(block[-1]) - len(suffix)] + last
+
+    return block
+
+
+def _diff_codes(name, encoder, old, new, options):
+    """Return the lines of both documents and the opcodes of their diff.
+
+    Only the subtrees which differ are rendered for both documents. The
+    rest of the document is rendered once with markers instead of the
+    subtrees to find the lines which are common to both documents. Returns
+    None if the whole documents must be compared.
+    """
+
+    if options.get('hash_sizes'):
+        # The sizes depend on the whole document
+        return None
+
+    units = _diff_units(name, old, new, options)
+
+    if () in units:
+        return None
+
+    skeleton = encoder(_diff_mark(name, new, units, options), **options)
+    lines = skeleton.splitlines()
+    ranges = []
+
+    for i, unit in enumerate(units):
+        marker = "%s%dz" % (_only_marker, i)
+        found = [j for j, line in enumerate(lines) if marker in line]
+
+        if not found:
+            return None
+
+        ranges.append((found[0], found[-1] + 1, unit, marker))
+
+    old_lines = []
+    new_lines = []
+    codes = []
+    labels = []
+    pos = 0
+
+    def add(tag, i1, i2, j1, j2):
+        if i1 == i2 and j1 == j2:
+            return
+        elif tag == 'equal' and codes and codes[-1][0] == 'equal':
+            # Lines between the subtrees are equal
+            codes[-1] = ('equal', codes[-1][1], i2, codes[-1][3], j2)
+        else:
+            codes.append((tag, i1, i2, j1, j2))
+
+    def extend(old_block, new_block):
+        matcher = difflib.SequenceMatcher(
+            None, old_block, new_block, autojunk=False)
+
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            add(
+                tag, len(old_lines) + i1, len(old_lines) + i2,
+                len(new_lines) + j1, len(new_lines) + j2)
+
+        old_lines.extend(old_block)
+        new_lines.extend(new_block)
+
+    for start, stop, unit, marker in sorted(ranges):
+        if start < pos:
+            # Subtrees sharing a line
+            return None
+
+        blocks = [
+            _diff_block(
+                name, encoder, data, unit, options, lines[start],
+                lines[stop - 1], marker)
+            for data in (old, new)]
+
+        if None in blocks:
+            return None
+
+        extend(lines[pos:start], lines[pos:start])
+        labels.append((len(old_lines), _path(unit)))
+        extend(*blocks)
+        pos = stop
+
+    extend(lines[pos:], lines[pos:])
+
+    return old_lines, new_lines, codes, labels
+
+
+def cef_diff(old, new, encoder, context=3, **options):
+    """Return unified diff of the old and new data in the encoder format.
+
+    Both data structures are walked together and only the subtrees which
+    differ are encoded for both of them. The hunks are labelled by the path
+    of the subtree.
+    """
+
+    name = encoder if encoder.startswith('encode_') else 'encode_' + encoder
+
+    if name not in FilterModule().filters():
+        raise errors.AnsibleFilterError("Unknown encoder: %s" % encoder)
+
+    # The common options of the filters aren't accepted by the encoders
+    options = dict(
+        (key, val) for key, val in options.items()
+        if key not in _FILTER_OPTIONS)
+    encoder = globals()[name]
+    diff = _diff_codes(name, encoder, old, new, options)
+
+    if diff is None:
+        # The whole documents must be compared
+        old_lines = encoder(old, **options).splitlines()
+        new_lines = encoder(new, **options).splitlines()
+        matcher = difflib.SequenceMatcher(
+            None, old_lines, new_lines, autojunk=False)
+        codes = matcher.get_opcodes()
+        labels = []
+    else:
+        old_lines, new_lines, codes, labels = diff
+        matcher = difflib.SequenceMatcher(None, (), ())
+        matcher.opcodes = codes
+
+    rv = []
+
+    if not any(code[0] != 'equal' for code in codes):
+        return ''
+
+    for group in matcher.get_grouped_opcodes(context):
+        header = "@@ -%s +%s @@" % (
+            _diff_range(group[0][1], group[-1][2]),
+            _diff_range(group[0][3], group[-1][4]))
+        changed = [code[1] for code in group if code[0] != 'equal'][0]
+        label = [text for start, text in labels if start <= changed]
+
+        rv.append("%s %s" % (header, label[-1]) if label else header)
+
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                rv.extend(' ' + line for line in old_lines[i1:i2])
+                continue
+
+            rv.extend('-' + line for line in old_lines[i1:i2])
+            rv.extend('+' + line for line in new_lines[j1:j2])
+
+    return "--- before\n+++ after\n%s\n" % "\n".join(rv)
+
+
+def _haproxy_lines(params, comments=False):
+    """Return the lines of the HAProxy section optionally with comments."""
+
+    rv = []
+
+    for param in params:
+        if isinstance(param, dict):
+            rv.extend(
+                "%s %s" % (list(param.keys())[0], val)
+                for val in list(param.values())[0] if len(val) > 0)
+        elif len(param) > 0:
+            rv.append(param)
+
+    if comments:
+        return rv
+
+    return [line for line in rv if not line.lstrip().startswith('#')]
+
+
+def _haproxy_sections(data):
+    """Return the HAProxy sections as a list of names and lines."""
+
+    return [
+        (list(section.keys())[0], _haproxy_lines(list(section.values())[0]))
+        for section in data if isinstance(section, dict)]
+
+
+def _haproxy_ip(addr):
+    """Check whether the address is an IP address."""
+
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, addr)
+        except (socket.error, ValueError):
+            continue
+
+        return True
+
+    return False
+
+
+def _haproxy_server(line):
+    """Parse the HAProxy server line.
+
+    Returns the name, the address, the port, the weight, the state and the
+    remaining options of the server.
+    """
+
+    tokens = line.split()
+    name = tokens[1] if len(tokens) > 1 else None
+    addr = tokens[2] if len(tokens) > 2 else None
+    port = None
+    weight = None
+    state = 'ready'
+    options = []
+
+    if addr is not None and ':' in addr:
+        host, _, suffix = addr.rpartition(':')
+
+        if suffix.isdigit() and (':' not in host or _haproxy_ip(host)):
+            addr = host
+            port = suffix
+
+    options_tokens = iter(tokens[3:])
+
+    for token in options_tokens:
+        if token == 'weight':
+            weight = next(options_tokens, None)
+        elif token == 'disabled':
+            state = 'maint'
+        elif token != 'enabled':
+            options.append(token)
+
+    return name, addr, port, weight, state, options
+
+
+def _haproxy_split(section, lines):
+    """Split the lines of the HAProxy section into servers and the rest."""
+
+    servers = []
+    others = []
+
+    for line in lines:
+        if (
+                section.split()[:1] in (['backend'], ['listen']) and
+                line.split()[:1] == ['server']):
+            servers.append(_haproxy_server(line))
+        else:
+            others.append(line)
+
+    return servers, others
+
+
+def _haproxy_delta(old, new):
+    """Return the runtime API commands changing old config to the new one.
+
+    Returns None with the reason if the change requires a reload.
+    """
+
+    old_sections = _haproxy_sections(old)
+    new_sections = _haproxy_sections(new)
+    commands = []
+
+    if [s[0] for s in old_sections] != [s[0] for s in new_sections]:
+        return None, "Sections differ"
+
+    for (section, old_lines), (_, new_lines) in zip(
+            old_sections, new_sections):
+        old_servers, old_others = _haproxy_split(section, old_lines)
+        new_servers, new_others = _haproxy_split(section, new_lines)
+
+        if old_others != new_others:
+            return None, "Section %s differs" % section
+        elif [s[0] for s in old_servers] != [s[0] for s in new_servers]:
+            return None, "Servers of section %s differ" % section
+
+        backend = ' '.join(section.split()[1:])
+
+        for old_server, new_server in zip(old_servers, new_servers):
+            name, addr, port, weight, state, options = new_server
+            target = '%s/%s' % (backend, name)
+
+            if (
+                    options != old_server[5] or
+                    addr is None or
+                    port is None and old_server[2] is not None or
+                    weight != old_server[3] and None in (
+                        weight, old_server[3])):
+                # Removed port or weight keeps the current value at runtime
+                return None, "Server %s differs" % target
+            elif (addr, port) != old_server[1:3]:
+                if not _haproxy_ip(addr):
+                    return None, "Server %s address is not an IP" % target
+
+                commands.append('set server %s addr %s%s' % (
+                    target, addr, '' if port is None else ' port %s' % port))
+
+            if weight != old_server[3]:
+                commands.append('set server %s weight %s' % (target, weight))
+
+            if state != old_server[4]:
+                commands.append('set server %s state %s' % (target, state))
+
+    return commands, None
+
+
+def cef_haproxy_delta(old, new, indent="  "):
+    """Classify the change of the HAProxy config.
+
+    Returns dict with the runtime API commands applying the change without
+    a reload or with the full new config if the change requires a reload.
+    """
+
+    commands, reason = _haproxy_delta(old, new)
+
+    if commands is None:
+        return {
+            'commands': [],
+            'config': encode_haproxy(new, indent=indent),
+            'reason': reason,
+            'reload': True,
+        }
+
+    return {
+        'commands': commands,
+        'config': None,
+        'reason': None,
+        'reload': False,
+    }
+
+
+def cef_batch(items, threads=0):
+    """Encode multiple documents in parallel threads.
+
+    Each item is a dict with the format (e.g. json), data and optional
+    options keys. The encoded documents are returned in the same order.
+    """
+
+    filters = FilterModule().filters()
+
+    def render(item):
+        name = 'encode_%s' % item.get('format')
+
+        if name not in filters:
+            raise errors.AnsibleFilterError(
+                "Unknown format: %s" % item.get('format'))
+
+        return filters[name](item.get('data'), **(item.get('options') or {}))
+
+    if threads > 1 and ThreadPoolExecutor is not None:
+        with ThreadPoolExecutor(threads) as pool:
+            return list(pool.map(render, items))
+
+    return [render(item) for item in items]
+
+
+class FilterModule(object):
+    """Ansible encoder Jinja2 filters."""
+
+    # Filters built by the first call and shared by all the callers
+    _filters = None
+
+    def filters(self):
+        """Expose filters to ansible."""
+
+        if FilterModule._filters is None:
+            FilterModule._filters = self._build()
+
+        return FilterModule._filters
+
+    def _build(self):
+        """Wrap the encoders by the options common to all filters."""
+
+        return {
+            'cef_batch': cef_batch,
+            'cef_diff': cef_diff,
+            'cef_haproxy_delta': cef_haproxy_delta,
+            'cef_normalize': cef_normalize,
+            'cef_profile': cef_profile,
+            'decode_haproxy': decode_haproxy,
+            'decode_ini': decode_ini,
+            'decode_json': decode_json,
+            'decode_nginx': decode_nginx,
+            'decode_toml': decode_toml,
+            'encode_apache': _filter('encode_apache', encode_apache),
+            'encode_erlang': _filter('encode_erlang', encode_erlang),
+            'encode_haproxy': _filter('encode_haproxy', encode_haproxy),
+            'encode_haproxy_files': encode_haproxy_files,
+            'encode_ini': _filter('encode_ini', encode_ini),
+            'encode_json': _filter('encode_json', encode_json),
+            'encode_jsonl': _filter('encode_jsonl', encode_jsonl),
+            'encode_jsonl_iter': encode_jsonl_iter,
+            'encode_logstash': _filter('encode_logstash', encode_logstash),
+            'encode_logstash_pipelines': encode_logstash_pipelines,
+            'encode_lua': _filter('encode_lua', encode_lua),
+            'encode_nginx': _filter('encode_nginx', encode_nginx),
+            'encode_pam': _filter('encode_pam', encode_pam),
+            'encode_toml': _filter('encode_toml', encode_toml),
+            'encode_xml': _filter('encode_xml', encode_xml),
+            'encode_yaml': _filter('encode_yaml', encode_yaml),
+            'template_replace': template_replace,
+        }
+
+
+if __name__ == '__main__':
+    import argparse
+    import signal
+
+    parser = argparse.ArgumentParser(
+        description='Render server of the Config Encoder Filters.')
+    parser.add_argument(
+        '--socket', default=SERVER_SOCKET, required=not SERVER_SOCKET,
+        help='path of the Unix socket (default: $CEF_SERVER)')
+
+    # Remove the socket also when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    serve(parser.parse_args().socket)
@@ -0,0 +1,69 @@
+"""
+Jinja2 extension writing data encoded by the Config Encoder Filters directly
+into the output of the template
+
+The cef_encode tag yields the encoded document in chunks (e.g. the top-level
+sections of Nginx) so the templates rendered as a stream never hold the whole
+encoded document as one string. The tag accepts the name of the encoder
+without the encode_ prefix, the data and the parameters of the encoder.
+
+Example:
+
+    {% cef_encode 'nginx', nginx_config, block_semicolon=true %}
+
+The extension is enabled in ansible.cfg together with the path to this
+directory in the PYTHONPATH environment variable:
+
+    [defaults]
+    jinja2_extensions = cef_encode.CefEncodeExtension
+"""
+
+from __future__ import (absolute_import, division, print_function)
+from jinja2 import nodes
+from jinja2.exceptions import TemplateRuntimeError
+from jinja2.ext import Extension
+
+try:
+    from cef_loader import encoders
+except ImportError:
+    # Imported as a package (e.g. by the tests)
+    from jinja2_extensions.cef_loader import encoders
+
+
+class CefEncodeExtension(Extension):
+    """Jinja2 tag yielding the encoded data into the template output."""
+
+    tags = set(['cef_encode'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        kwargs = []
+
+        parser.stream.expect('comma')
+        args.append(parser.parse_expression())
+
+        while parser.stream.skip_if('comma'):
+            key = parser.stream.expect('name')
+            parser.stream.expect('assign')
+            kwargs.append(nodes.Keyword(
+                key.value, parser.parse_expression(), lineno=key.lineno))
+
+        # Each chunk is yielded by the template as a separate output
+        chunk = nodes.Name('cef_encode_chunk', 'store', lineno=lineno)
+
+        return nodes.For(
+            chunk, self.call_method('_chunks', args, kwargs),
+            [nodes.Output(
+                [nodes.Name('cef_encode_chunk', 'load', lineno=lineno)],
+                lineno=lineno)],
+            [], None, False, lineno=lineno)
+
+    def _chunks(self, format, data, **options):
+        module = encoders()
+        name = 'encode_%s' % format
+
+        if name not in module.FilterModule().filters():
+            raise TemplateRuntimeError("Unknown format: %s" % format)
+
+        return module._encode_chunks(name, data, options)
@@ -0,0 +1,55 @@
+"""
+Loader of the Config Encoder Filters shared by the cef_encode Jinja2
+extension and by the config_encode action plugin
+
+Both of them use the module loaded by Ansible as the filter plugin if it's
+already loaded so they share the registered types, the emission plans and the
+profile with the filters. Otherwise the module is loaded from the
+filter_plugins directory of the role under the ENCODERS_MODULE name.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+import os
+import sys
+
+try:
+    from importlib.util import module_from_spec, spec_from_file_location
+except ImportError:
+    from imp import load_source
+else:
+    def load_source(name, path):
+        spec = spec_from_file_location(name, path)
+        module = module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+
+        return module
+
+
+# Name under which the encoders are imported
+ENCODERS_MODULE = 'ansible_config_encoder_filters'
+# Path to the encoders in the filter_plugins directory of the role
+ENCODERS_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    'filter_plugins', 'config_encoders.py')
+
+
+def encoders():
+    """Return the encoders from the filter_plugins directory of the role."""
+
+    # Module loaded by Ansible as the filter plugin shares the registered
+    # types, the emission plans and the profile with the filters
+    for name, module in list(sys.modules.items()):
+        filename = getattr(module, '__file__', None)
+
+        if (
+                name != ENCODERS_MODULE and filename and
+                os.path.basename(filename).startswith('config_encoders.') and
+                os.path.splitext(os.path.realpath(filename))[0] ==
+                os.path.splitext(ENCODERS_PATH)[0]):
+            return module
+
+    if ENCODERS_MODULE not in sys.modules:
+        load_source(ENCODERS_MODULE, ENCODERS_PATH)
+
+    return sys.modules[ENCODERS_MODULE]
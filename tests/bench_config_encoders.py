@@ -0,0 +1,259 @@
+"""
+End-to-end benchmark of the Config Encoder Filters running through Ansible
+
+Generates large variables for each encoder, renders them via the
+bench_config_encoders.yaml playbook and reports the wall time and the
+memory of the main process and of the workers of the controller for each
+task for several sizes of the data.
+
+Usage:
+
+    $ python tests/bench_config_encoders.py --sizes 100,1000,10000
+    $ python tests/bench_config_encoders.py --output old.json
+    $ python tests/bench_config_encoders.py --compare old.json
+"""
+
+from __future__ import (absolute_import, division, print_function)
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+ROOT_PATH = os.path.dirname(DIR_PATH)
+
+
+def gen_apache(size):
+    return {'content': [{'sections': [{
+        'name': 'VirtualHost',
+        'param': '*:%d' % (8000 + i),
+        'content': [{'options': [
+            {'ServerName': 'www%d.example.com' % i},
+            {'DocumentRoot': '/var/www/%d' % i},
+            {'CustomLog': ['/var/log/httpd/%d.log' % i, 'common']},
+        ]}],
+    } for i in range(size)]}]}
+
+
+def gen_dict(size):
+    return dict(('item%d' % i, {
+        'name': 'name %d' % i,
+        'port': i,
+        'enabled': i % 2 == 0,
+        'ratio': i / 7.0,
+        'tags': ['tag%d' % (i % 10), 'common'],
+        'nested': {'path': '/var/lib/%d' % i},
+    }) for i in range(size))
+
+
+def gen_erlang(size):
+    return [dict(('app%d' % i, {
+        'host': 'host%d' % i,
+        'port': i,
+        'enabled': True,
+    }) for i in range(size))]
+
+
+def gen_haproxy(size):
+    return [{'global': ['daemon', 'maxconn 256']}] + [{
+        'backend be%d' % i: [
+            'mode http',
+            'balance roundrobin',
+            'server srv%d 10.0.%d.%d:80 check' % (i, i // 256 % 256, i % 256),
+        ]} for i in range(size)]
+
+
+def gen_ini(size):
+    return dict(('section%d' % i, dict(
+        ('key%d' % j, 'value %d' % j) for j in range(10)))
+        for i in range(size))
+
+
+def gen_logstash(size):
+    return [
+        {':input': [
+            {':file': {'path': '/var/log/app%d.log' % i, 'type': 'app'}}
+            for i in range(size)]},
+        {':filter': [
+            {':grok': {'match': {'message': '%{COMBINEDAPACHELOG}'}}}]},
+        {':output': [{':stdout': {'codec': 'rubydebug'}}]},
+    ]
+
+
+def gen_nginx(size):
+    return [{'http': [{'server': [
+        'listen %d' % (8000 + i),
+        'server_name www%d.example.com' % i,
+        {'location /': ['root /var/www/%d' % i]},
+    ]} for i in range(size)]}]
+
+
+def gen_pam(size):
+    return dict(('rule%06d' % i, {
+        'type': 'auth',
+        'control': 'required',
+        'path': 'pam_unix.so',
+        'args': ['try_first_pass', 'nullok'],
+    }) for i in range(size))
+
+
+def gen_xml(size):
+    return {'root': [{'item': [
+        {'^id': str(i)},
+        {'name': 'name %d' % i},
+        {'value': 'value & %d' % i},
+    ]} for i in range(size)]}
+
+
+GENERATORS = {
+    'encode_apache': gen_apache,
+    'encode_erlang': gen_erlang,
+    'encode_haproxy': gen_haproxy,
+    'encode_ini': gen_ini,
+    'encode_json': gen_dict,
+    'encode_jsonl': lambda size: list(gen_dict(size).values()),
+    'encode_logstash': gen_logstash,
+    'encode_lua': gen_dict,
+    'encode_nginx': gen_nginx,
+    'encode_pam': gen_pam,
+    'encode_toml': gen_dict,
+    'encode_xml': gen_xml,
+    'encode_yaml': gen_dict,
+}
+
+
+def run(encoder, size, params, tmp_dir):
+    """Run the benchmark playbook and return the results of its tasks."""
+
+    vars_path = os.path.join(tmp_dir, 'vars.json')
+    output_path = os.path.join(tmp_dir, 'output.json')
+
+    with open(vars_path, 'w') as f:
+        json.dump({
+            'bench_data': GENERATORS[encoder](size),
+            'bench_dest': tmp_dir,
+            'bench_encoder': encoder,
+            'bench_params': params,
+        }, f)
+
+    env = dict(
+        os.environ,
+        ANSIBLE_ACTION_PLUGINS=os.path.join(ROOT_PATH, 'action_plugins'),
+        ANSIBLE_CALLBACK_PLUGINS=os.path.join(DIR_PATH, 'callback_plugins'),
+        ANSIBLE_CALLBACKS_ENABLED='cef_bench',
+        ANSIBLE_CALLBACK_WHITELIST='cef_bench',
+        ANSIBLE_FILTER_PLUGINS=os.path.join(ROOT_PATH, 'filter_plugins'),
+        ANSIBLE_PYTHON_INTERPRETER='auto_silent',
+        ANSIBLE_RETRY_FILES_ENABLED='false',
+        CEF_BENCH_OUTPUT=output_path)
+
+    with open(os.devnull, 'w') as devnull:
+        rc = subprocess.call([
+            'ansible-playbook',
+            '-i', 'localhost,',
+            '-e', '@%s' % vars_path,
+            os.path.join(DIR_PATH, 'bench_config_encoders.yaml'),
+        ], env=env, stdout=devnull)
+
+    if rc != 0 or not os.path.exists(output_path):
+        raise RuntimeError(
+            "Playbook failed for %s with size %d" % (encoder, size))
+
+    with open(output_path) as f:
+        results = json.load(f)
+
+    os.remove(output_path)
+
+    return results
+
+
+def report(rows, baseline=None):
+    """Print the results as a table optionally compared to the baseline."""
+
+    base = {}
+
+    for row in baseline or []:
+        base[(row['encoder'], row['size'], row['task'])] = row
+
+    line = "%-16s %8s %-18s %10s %14s %16s" % (
+        'encoder', 'size', 'task', 'time [s]', 'main rss [kB]',
+        'workers rss [kB]')
+
+    if baseline is not None:
+        line += " %10s %10s %12s" % (
+            'time diff', 'main diff', 'workers diff')
+
+    print(line)
+
+    for row in rows:
+        line = "%-16s %8d %-18s %10.3f %14d %16d" % (
+            row['encoder'], row['size'], row['task'], row['time'],
+            row['maxrss'], row.get('workers_maxrss', 0))
+        old = base.get((row['encoder'], row['size'], row['task']))
+
+        if old is not None:
+            line += " %+9.1f%% %+9.1f%%" % (
+                (row['time'] / old['time'] - 1) * 100,
+                (row['maxrss'] / old['maxrss'] - 1) * 100)
+
+            if old.get('workers_maxrss') and 'workers_maxrss' in row:
+                line += " %+11.1f%%" % (
+                    (row['workers_maxrss'] / old['workers_maxrss'] - 1) *
+                    100)
+
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the encoders through Ansible templating.')
+    parser.add_argument(
+        '--encoders', default=','.join(sorted(GENERATORS)),
+        help='comma separated list of encoders (default: all)')
+    parser.add_argument(
+        '--sizes', default='100,1000,10000',
+        help='comma separated list of data sizes (default: %(default)s)')
+    parser.add_argument(
+        '--params', default='{}',
+        help='JSON with the parameters passed to the encoders')
+    parser.add_argument(
+        '--output', help='write the results as JSON into this file')
+    parser.add_argument(
+        '--compare', help='compare the results with this JSON file')
+    args = parser.parse_args()
+
+    params = json.loads(args.params)
+    rows = []
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        for size in [int(s) for s in args.sizes.split(',')]:
+            for encoder in args.encoders.split(','):
+                if encoder not in GENERATORS:
+                    parser.error("Unknown encoder: %s" % encoder)
+
+                for result in run(encoder, size, params, tmp_dir):
+                    result.update({'encoder': encoder, 'size': size})
+                    rows.append(result)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    baseline = None
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    report(rows, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""
+Benchmark of the per-call latency of the render server
+
+Renders the same document by the filter running inline with cold and warm
+emission plans and through the render server started on a temporary Unix
+socket. The cold run clears the plans before each call as every newly forked
+Ansible worker starts with empty caches.
+
+Usage:
+
+    $ python tests/bench_server.py --sizes 10,100,1000 --format yaml
+"""
+
+from __future__ import (absolute_import, division, print_function)
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(
+    __file__))))
+
+import filter_plugins.config_encoders as CE  # noqa: E402
+
+
+def gen_dict(size):
+    return dict(('item%d' % i, {
+        'name': 'name %d' % i,
+        'port': i,
+        'enabled': i % 2 == 0,
+        'tags': ['tag%d' % (i % 10), 'common'],
+        'nested': {'path': '/var/lib/%d' % i},
+    }) for i in range(size))
+
+
+def start_server(path):
+    """Start the render server and wait until it accepts connections."""
+
+    server = subprocess.Popen([sys.executable, CE.__file__, '--socket', path])
+
+    for _ in range(100):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            sock.connect(path)
+
+            return server
+        except socket.error:
+            time.sleep(0.1)
+        finally:
+            sock.close()
+
+    server.terminate()
+
+    raise RuntimeError("Render server didn't start")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the per-call latency of the render server.')
+    parser.add_argument(
+        '--sizes', default='10,100,1000',
+        help='comma separated list of data sizes (default: %(default)s)')
+    parser.add_argument(
+        '--format', default='yaml',
+        help='format of the documents (default: %(default)s)')
+    parser.add_argument(
+        '--number', type=int, default=200,
+        help='number of calls per measurement (default: %(default)s)')
+    args = parser.parse_args()
+
+    my_filter = CE.FilterModule().filters()['encode_%s' % args.format]
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'cef.sock')
+    server = start_server(path)
+
+    def cold(data):
+        CE._plans.clear()
+        my_filter(data, plan=True)
+
+    def measure(func, data, socket_path):
+        CE.SERVER_SOCKET = socket_path
+        func(data)
+
+        return min(timeit.repeat(
+            lambda: func(data), number=args.number, repeat=3)) / args.number
+
+    print("%8s %14s %14s %14s" % (
+        'size', 'cold [ms]', 'warm [ms]', 'server [ms]'))
+
+    try:
+        for size in [int(s) for s in args.sizes.split(',')]:
+            data = gen_dict(size)
+
+            print("%8d %14.3f %14.3f %14.3f" % (
+                size,
+                measure(cold, data, '') * 1000,
+                measure(lambda d: my_filter(d, plan=True), data, '') * 1000,
+                measure(lambda d: my_filter(d, plan=True), data, path) * 1000))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""
+Benchmark of the encoders running in parallel threads
+
+Encodes a batch of documents through the cef_batch filter with an increasing
+number of threads and reports the speedup against the serial run. The
+encoders scale across the CPU cores only on the free-threaded builds of
+Python (e.g. python3.13t).
+
+Usage:
+
+    $ python tests/bench_threads.py --threads 1,2,4,8 --documents 64
+"""
+
+from __future__ import (absolute_import, division, print_function)
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(
+    __file__))))
+
+import filter_plugins.config_encoders as CE  # noqa: E402
+
+
+def gen_dict(size, seed):
+    return dict(('item%d' % i, {
+        'name': 'name %d' % (i + seed),
+        'port': i + seed,
+        'enabled': i % 2 == 0,
+        'tags': ['tag%d' % (i % 10), 'common'],
+        'nested': {'path': '/var/lib/%d' % i},
+    }) for i in range(size))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the encoders running in parallel threads.')
+    parser.add_argument(
+        '--threads', default='1,2,4,8',
+        help='comma separated list of thread counts (default: %(default)s)')
+    parser.add_argument(
+        '--documents', type=int, default=64,
+        help='number of documents in the batch (default: %(default)s)')
+    parser.add_argument(
+        '--size', type=int, default=1000,
+        help='number of items in each document (default: %(default)s)')
+    parser.add_argument(
+        '--format', default='yaml',
+        help='format of the documents (default: %(default)s)')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='number of repetitions (default: %(default)s)')
+    args = parser.parse_args()
+
+    items = [
+        {'format': args.format, 'data': gen_dict(args.size, i)}
+        for i in range(args.documents)]
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    serial = None
+
+    print("Python %s, GIL %s, %d CPUs" % (
+        sys.version.split()[0], 'enabled' if gil else 'disabled',
+        os.cpu_count() if hasattr(os, 'cpu_count') else 1))
+    print("%8s %10s %8s" % ('threads', 'time [s]', 'speedup'))
+
+    for threads in [int(t) for t in args.threads.split(',')]:
+        elapsed = min(timeit.repeat(
+            lambda: CE.cef_batch(items, threads=threads),
+            number=1, repeat=args.repeat))
+
+        if serial is None:
+            serial = elapsed
+
+        print("%8d %10.3f %7.2fx" % (threads, elapsed, serial / elapsed))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+# (c) 2016, Jiri Tyr <jiri.tyr@gmail.com>
+#
+# This file is part of Config Encoder Filters (CEF)
+#
+# CEF is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CEF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CEF.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Callback recording the wall time and the memory of each task
+
+The memory is recorded separately for the main process of the controller
+and for the forked workers which template the variables and run the action
+plugins. The peak memory of the workers is sampled from /proc while the task
+runs. Other systems report the peak of the workers which already exited
+instead.
+
+The results are written as JSON into the file defined by the
+CEF_BENCH_OUTPUT environment variable.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+from ansible.plugins.callback import CallbackBase
+import json
+import os
+import resource
+import threading
+import time
+
+
+# Seconds between the samples of the memory of the workers
+SAMPLE_INTERVAL = 0.01
+
+
+def _workers_maxrss():
+    """Return the maximal peak resident set size of the workers in kB.
+
+    Returns None if the workers can't be sampled (e.g. without /proc).
+    """
+
+    if not os.path.isdir('/proc/self'):
+        return None
+
+    pid = str(os.getpid())
+    rv = 0
+
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                # The command in the parentheses might contain spaces
+                ppid = f.read().rsplit(')', 1)[1].split()[1]
+
+            if ppid != pid:
+                continue
+
+            with open('/proc/%s/status' % name) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        rv = max(rv, int(line.split()[1]))
+        except (IOError, OSError, IndexError, ValueError):
+            # The worker has exited meanwhile
+            continue
+
+    return rv
+
+
+class CallbackModule(CallbackBase):
+    """Record the wall time and the memory of each task."""
+
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'cef_bench'
+    CALLBACK_NEEDS_WHITELIST = True
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+
+        self._results = []
+        self._task = None
+        self._start = None
+        self._sampler = None
+        self._stop = None
+        self._workers_rss = None
+
+    def _sample(self, stop):
+        """Sample the memory of the workers until the task finishes."""
+
+        while True:
+            rss = _workers_maxrss()
+
+            if rss is not None:
+                self._workers_rss = max(self._workers_rss or 0, rss)
+
+            if stop.wait(SAMPLE_INTERVAL):
+                return
+
+    def _stop_sampler(self):
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def _finish(self, result):
+        if self._task is None:
+            return
+
+        self._stop_sampler()
+        workers_rss = self._workers_rss
+
+        if workers_rss is None:
+            # Peak of the workers which already exited
+            workers_rss = resource.getrusage(
+                resource.RUSAGE_CHILDREN).ru_maxrss
+
+        self._results.append({
+            'task': self._task,
+            'status': result,
+            'time': time.time() - self._start,
+            # Maximal resident set size of the main process in kB
+            'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            # Maximal resident set size of the workers in kB
+            'workers_maxrss': workers_rss,
+        })
+        self._task = None
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._stop_sampler()
+        self._task = task.get_name()
+        self._start = time.time()
+        self._workers_rss = None
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(
+            target=self._sample, args=(self._stop,))
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def v2_runner_on_ok(self, result):
+        self._finish('ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._finish('failed')
+
+    def v2_playbook_on_stats(self, stats):
+        self._stop_sampler()
+        path = os.environ.get('CEF_BENCH_OUTPUT')
+
+        if path:
+            with open(path, 'w') as f:
+                json.dump(self._results, f)
@@ -0,0 +1,106 @@
+from ansible.utils.hashing import checksum_s
+import action_plugins.config_encode as CA
+import filter_plugins.config_encoders as CE
+import jinja2_extensions.cef_encode as CT
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class TestConfigEncode(unittest.TestCase):
+    _content = 'a=1\n'
+
+    def _run(self, checksum=None, check_mode=False, diff=False, **args):
+        task = mock.MagicMock()
+        task.args = dict(format='ini', data={'a': 1}, dest='/etc/app.cfg')
+        task.args.update(args)
+        task.async_val = 0
+        task.check_mode = check_mode
+        task.diff = diff
+        action = CA.ActionModule(
+            task, mock.MagicMock(), mock.MagicMock(), mock.MagicMock(),
+            mock.MagicMock(), mock.MagicMock())
+        self._action = action
+
+        action._remote_expand_user = mock.Mock(side_effect=lambda p: p)
+        action._execute_remote_stat = mock.Mock(return_value={
+            'exists': checksum is not None,
+            'isdir': False,
+            'checksum': checksum})
+        action._execute_module = mock.Mock(return_value={'changed': True})
+        action._get_diff_data = mock.Mock(return_value={'after': 'diff'})
+        action._transfer_data = mock.Mock()
+        action._fixup_perms2 = mock.Mock()
+        action._remove_tmp_path = mock.Mock()
+
+        return action.run(task_vars={})
+
+    def _module(self):
+        self.assertEqual(self._action._execute_module.call_count, 1)
+        kwargs = self._action._execute_module.call_args[1]
+
+        return kwargs['module_name'], kwargs['module_args']
+
+    def test_changed(self):
+        result = self._run(checksum='old', mode='0644', validate='true %s')
+        name, args = self._module()
+
+        self.assertTrue(result['changed'])
+        self.assertEqual(name, 'copy')
+        self.assertEqual(args['checksum'], checksum_s(self._content))
+        self.assertEqual(args['validate'], 'true %s')
+        self.assertEqual(args['mode'], '0644')
+        self.assertEqual(
+            self._action._transfer_data.call_args[0][1], self._content)
+
+    def test_unchanged(self):
+        result = self._run(checksum=checksum_s(self._content))
+
+        self.assertFalse(result['changed'])
+        self.assertEqual(self._action._execute_module.call_count, 0)
+
+    def test_unchanged_attributes(self):
+        self._run(
+            checksum=checksum_s(self._content), mode='0600', owner='root',
+            validate='true %s', backup=True)
+        name, args = self._module()
+
+        self.assertEqual(name, 'file')
+        self.assertEqual(args, {
+            '_original_basename': 'app.cfg',
+            'follow': False,
+            'mode': '0600',
+            'owner': 'root',
+            'path': '/etc/app.cfg',
+            'state': 'file'})
+
+    def test_check_mode(self):
+        result = self._run(checksum='old', check_mode=True)
+
+        self.assertTrue(result['changed'])
+        self.assertNotIn('diff', result)
+        self.assertEqual(self._action._execute_module.call_count, 0)
+
+    def test_diff(self):
+        result = self._run(checksum='old', check_mode=True, diff=True)
+
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['diff'], {'after': 'diff'})
+        self.assertEqual(
+            self._action._get_diff_data.call_args[0][1], self._content)
+
+    def test_errors(self):
+        self.assertTrue(self._run(format='none')['failed'])
+        self.assertTrue(self._run(options={'only': 'b'})['failed'])
+
+    def test_encoders(self):
+        # Action plugin and the Jinja2 tag share the loaded filter plugin
+        self.assertIs(CA.encoders(), CE)
+        self.assertIs(CT.encoders(), CE)
+
+
+if __name__ == '__main__':
+    unittest.main()
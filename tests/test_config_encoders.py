@@ -1,8 +1,39 @@
+import copy
+from datetime import datetime
+from decimal import Decimal
 import filter_plugins.config_encoders as CE
+import jinja2
 import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import yaml
 
+try:
+    from shutil import which
+except ImportError:
+    # Python 2
+    from distutils.spawn import find_executable as which
+
+
+def register_type(test, *args):
+    """Register the type only for the duration of the test."""
+
+    types = dict(CE._types)
+
+    def restore():
+        with CE._lock:
+            CE._types.clear()
+            CE._types.update(types)
+
+    test.addCleanup(restore)
+    CE.register_type(*args)
+
 
 class MyTestCase(unittest.TestCase):
     def _load_file(self, kind, encoder, test):
@@ -94,6 +125,48 @@ class TestErlang(MyTestCase):
         self._test('mixed')
 
 
+class TestHaproxyFiles(unittest.TestCase):
+    def test_patterns(self):
+        my_in = [{'frontend fe': [
+            'bind *:80',
+            {'acl': [
+                'blocked src 10.0.0.1 10.0.0.2',
+                'small hdr(host) a.com',
+                'blocked src 10.0.0.3 10.0.0.1']},
+            'http-request deny if blocked',
+            {'use_backend': [
+                'be1 if { hdr(host) -i A.com b.com }',
+                'be2 if { hdr(host) -i c.com a.com }',
+                'be3 if { path /x }']}]}]
+
+        self.assertEqual(
+            CE.encode_haproxy_files(
+                my_in, patterns_dir='/p', patterns_threshold=3), {
+                'config': (
+                    'frontend fe\n'
+                    '  bind *:80\n'
+                    '  acl blocked src -f /p/frontend_fe_blocked_src.lst\n'
+                    '  acl small hdr(host) a.com\n'
+                    '  http-request deny if blocked\n'
+                    '  use_backend %[req.hdr(host),lower,'
+                    'map(/p/frontend_fe_req.hdr_host.map)] if { '
+                    'req.hdr(host),lower,map(/p/frontend_fe_req.hdr_host.map)'
+                    ' -m found }\n'
+                    '  use_backend be3 if { path /x }\n'),
+                'files': {
+                    '/p/frontend_fe_blocked_src.lst':
+                        '10.0.0.1\n10.0.0.2\n10.0.0.3\n',
+                    '/p/frontend_fe_req.hdr_host.map':
+                        'a.com be1\nb.com be1\nc.com be2\n'}})
+
+    def test_small(self):
+        my_in = [{'frontend fe': [{'acl': ['blocked src 10.0.0.1']}]}]
+
+        self.assertEqual(
+            CE.encode_haproxy_files(my_in),
+            {'config': CE.encode_haproxy(my_in), 'files': {}})
+
+
 class TestIni(MyTestCase):
     _encoder = 'encode_ini'
 
@@ -152,6 +225,65 @@ class TestJson(MyTestCase):
     def test_dict(self):
         self._test('dict')
 
+    def test_dict_compact(self):
+        self._test(['dict', 'dict_compact'], compact=True)
+
+
+class TestJsonl(MyTestCase):
+    _encoder = 'encode_jsonl'
+
+    def test_records(self):
+        self._test('records')
+
+    def test_records_convert(self):
+        self._test(
+            ['records', 'records_convert'], convert_bools=True,
+            convert_nums=True)
+
+    def test_iter(self):
+        my_in = ({'id': i} for i in range(3))
+        my_iter = CE.encode_jsonl_iter(my_in)
+
+        self.assertEqual(next(my_iter), '{"id":0}\n')
+        self.assertEqual(list(my_iter), ['{"id":1}\n', '{"id":2}\n'])
+        self.assertRaises(
+            CE.errors.AnsibleFilterError, CE.encode_jsonl, {'id': 0})
+
+
+class TestLogstashPipelines(unittest.TestCase):
+    def test_pipelines(self):
+        my_beats = [{':input': [{':beats': {'port': 5044}}]}]
+        my_syslog = [{':input': [{':syslog': {'port': 514}}]}]
+        my_out = CE.encode_logstash_pipelines({
+            'beats': my_beats,
+            'syslog': {'config': my_syslog, 'pipeline.workers': 2},
+        }, pipelines_dir='/p', indent='    ')
+
+        self.assertEqual(my_out['changed'], ['beats', 'syslog'])
+        self.assertEqual(
+            my_out['pipelines']['syslog']['config'],
+            CE.encode_logstash(my_syslog, indent='    '))
+        self.assertEqual(
+            my_out['pipelines_yml'],
+            '- path.config: "/p/beats.conf"\n'
+            '  pipeline.id: "beats"\n'
+            '- path.config: "/p/syslog.conf"\n'
+            '  pipeline.id: "syslog"\n'
+            '  pipeline.workers: 2\n')
+
+    def test_fingerprints(self):
+        my_in = {'a': [{':input': []}], 'b': [{':output': []}]}
+        my_out = CE.encode_logstash_pipelines(my_in)
+        my_in['b'] = [{':output': [{':stdout': {}}]}]
+
+        self.assertEqual(
+            CE.encode_logstash_pipelines(my_in, fingerprints=dict(
+                (k, v['fingerprint'])
+                for k, v in my_out['pipelines'].items()))['changed'],
+            ['b'])
+        self.assertRaises(
+            CE.errors.AnsibleFilterError, CE.encode_logstash_pipelines, [])
+
 
 class TestLua(MyTestCase):
     _encoder = "encode_lua"
@@ -180,10 +312,54 @@ class TestLua(MyTestCase):
     def test_dict(self):
         self._test('dict')
 
+    def test_list_compact(self):
+        self._test(['list', 'list_compact'], compact=True)
+
+
+class TestNginxHash(unittest.TestCase):
+    def test_sizes(self):
+        my_in = [{'http': [
+            'sendfile on',
+            {'map $host $backend': ['default be', 'hostnames'] + [
+                'h%d.example.com be%d' % (i, i) for i in range(3000)]},
+            {'server': ['server_name %s.com ~^regexp$' % ('a' * 60)]},
+            {'types': ['text/html html htm']}]}]
+        my_out = CE.encode_nginx(my_in, hash_sizes=True)
+
+        self.assertEqual(
+            my_out.splitlines()[:4], [
+                'http {',
+                '  map_hash_max_size 4096;',
+                '  server_names_hash_bucket_size 128;',
+                '  sendfile on;'])
+        self.assertEqual(
+            CE.FilterModule().filters()['encode_nginx'](
+                my_in, hash_sizes=True, workers=2, workers_threshold=1),
+            my_out)
+
+    def test_defaults(self):
+        for my_in in (
+                [{'http': [{'server': ['server_name www.example.com']}]}],
+                [{'http': [
+                    'server_names_hash_bucket_size 256',
+                    {'server': ['server_name %s' % ('a' * 60)]}]}]):
+            self.assertEqual(
+                CE.encode_nginx(my_in, hash_sizes=True),
+                CE.encode_nginx(my_in))
+
 
 class TestToml(MyTestCase):
     _encoder = 'encode_toml'
 
+    def test_key(self):
+        # Dotted keys of values stay dotted and only table names are quoted
+        self.assertEqual(
+            CE.encode_toml({'a.b': 1, 'c': {'d.e': {'f': 2}}}),
+            'a.b = 1\n\n[c."d.e"]\nf = 2\n')
+        self.assertEqual(
+            CE.encode_toml({'a.b': 1, 'c d': 2}, compact=True),
+            '"a.b"=1\n"c d"=2\n')
+
     def test_boolean(self):
         self._test('boolean')
 
@@ -214,6 +390,9 @@ class TestToml(MyTestCase):
     def test_table_grafana(self):
         self._test('table_grafana')
 
+    def test_table_array_compact(self):
+        self._test(['table_array', 'table_array_compact'], compact=True)
+
 
 class TestXml(MyTestCase):
     _encoder = 'encode_xml'
@@ -224,6 +403,12 @@ class TestXml(MyTestCase):
     def test_attribute(self):
         self._test('attribute')
 
+    def test_attribute_compact(self):
+        self._test(['attribute', 'attribute_compact'], compact=True)
+
+    def test_cdata(self):
+        self._test('cdata')
+
 
 class TestYaml(MyTestCase):
     _encoder = 'encode_yaml'
@@ -261,6 +446,948 @@ class TestYaml(MyTestCase):
     def test_null(self):
         self._test('null')
 
+    def test_key(self):
+        self._test('key')
+
+    def test_dict_compact(self):
+        self._test(['dict', 'dict_compact'], compact=True)
+
+    def test_key_compact(self):
+        self._test(['key', 'key_compact'], compact=True)
+
+
+class TestCache(MyTestCase):
+    _encoder = 'encode_json'
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._filter = CE.FilterModule().filters()[self._encoder]
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_hit(self):
+        my_in = self._load_input('dict')
+        my_out = self._load_output('dict')
+
+        self.assertEqual(self._filter(my_in, cache=self._dir), my_out)
+        self.assertEqual(len(os.listdir(self._dir)), 1)
+
+        # Corrupt the cached result to prove it's used
+        path = os.path.join(self._dir, os.listdir(self._dir)[0])
+
+        with open(path, 'w') as f:
+            f.write('cached')
+
+        self.assertEqual(self._filter(my_in, cache=self._dir), 'cached')
+
+    def test_options(self):
+        my_in = self._load_input('list')
+
+        self._filter(my_in, cache=self._dir)
+        self.assertEqual(
+            self._filter(my_in, cache=self._dir, indent="    "),
+            self._load_output('list_indent'))
+        self.assertEqual(len(os.listdir(self._dir)), 2)
+
+    def test_positional(self):
+        my_in = self._load_input('list')
+        my_out = self._load_output('list_indent')
+
+        self.assertEqual(
+            self._filter(my_in, False, False, "    ", cache=self._dir), my_out)
+        self.assertEqual(len(os.listdir(self._dir)), 1)
+        self.assertEqual(
+            self._filter(
+                my_in, convert_bools=False, convert_nums=False, indent="    ",
+                cache=self._dir),
+            my_out)
+        self.assertEqual(len(os.listdir(self._dir)), 1)
+
+        for args, kwargs in (
+                ((False, ) * 7, {}),
+                ((False, ), {'convert_bools': True})):
+            self.assertRaises(
+                CE.errors.AnsibleFilterError, self._filter, my_in, *args,
+                **kwargs)
+
+    def test_normalized(self):
+        my_in = {'a': 'true', 'b': '5'}
+        my_norm = CE.cef_normalize(my_in, True, True)
+
+        self.assertEqual(
+            self._filter(my_in, cache=self._dir), CE.encode_json(my_in))
+        self.assertEqual(
+            self._filter(my_norm, cache=self._dir),
+            CE.encode_json(my_in, convert_bools=True, convert_nums=True))
+        self.assertEqual(len(os.listdir(self._dir)), 2)
+
+    def test_types(self):
+        my_filter = CE.FilterModule().filters()['encode_yaml']
+        cache_dir = CE.CACHE_DIR
+        CE.CACHE_DIR = self._dir
+
+        try:
+            # Keys and values serialized the same way by JSON
+            for my_in in (
+                    {True: 1}, {'true': 1}, {None: 1}, {'null': 1}, {1: 1},
+                    {1.0: 1}, {'a': 1}, {'a': 1.0}):
+                self.assertEqual(
+                    my_filter(my_in, cache=True), CE.encode_yaml(my_in))
+        finally:
+            CE.CACHE_DIR = cache_dir
+
+        self.assertEqual(len(os.listdir(self._dir)), 8)
+
+    def test_evict(self):
+        for test in ('boolean', 'dict', 'list', 'number', 'string'):
+            self._filter(
+                self._load_input(test), cache=self._dir, cache_size=1)
+
+        self.assertEqual(len(os.listdir(self._dir)), 0)
+
+    def test_evict_scans(self):
+        my_scans = []
+        cache_evict = CE._cache_evict
+
+        def my_evict(cache_dir, cache_size):
+            my_scans.append(cache_size)
+
+            return cache_evict(cache_dir, cache_size)
+
+        CE._cache_evict = my_evict
+
+        try:
+            # The directory is scanned only when it might exceed the size
+            for test in ('boolean', 'dict', 'list', 'number', 'string'):
+                self._filter(self._load_input(test), cache=self._dir)
+
+            self.assertEqual(len(my_scans), 1)
+
+            for test in ('boolean', 'dict'):
+                self._filter(
+                    self._load_input(test), cache=self._dir, indent=' ',
+                    cache_size=1)
+        finally:
+            CE._cache_evict = cache_evict
+
+        self.assertEqual(len(my_scans), 3)
+        self.assertEqual(len(os.listdir(self._dir)), 0)
+
+
+class TestPlan(MyTestCase):
+    _encoder = 'encode_yaml'
+
+    def _test_plan(self, encoder, test, **params):
+        self._encoder = encoder
+        my_filter = CE.FilterModule().filters()[encoder]
+        my_in = self._load_input(test)
+        my_out = getattr(CE, encoder)(my_in, **params)
+
+        # The first call compiles the plan, the second one uses it
+        for _ in range(2):
+            self.assertEqual(my_filter(my_in, plan=True, **params), my_out)
+
+    def test_files(self):
+        for encoder, test in (
+                ('encode_json', 'dict'),
+                ('encode_json', 'list'),
+                ('encode_lua', 'dict'),
+                ('encode_toml', 'table_grafana'),
+                ('encode_yaml', 'block'),
+                ('encode_yaml', 'dict')):
+            self._test_plan(encoder, test)
+            self._test_plan(encoder, test, convert_bools=True)
+
+    def test_values(self):
+        my_filter = CE.FilterModule().filters()['encode_json']
+
+        for my_in in (
+                {'a': [1, 'x', True], 'b': {'c': 'd'}},
+                {'a': ['y', 'y', 'y'], 'b': {'c': 'null'}},
+                {'a': [2.5, 'z', 'z'], 'b': {'c': 3}}):
+            self.assertEqual(
+                my_filter(my_in, plan=True), CE.encode_json(my_in))
+
+
+class TestNormalize(MyTestCase):
+    _encoder = 'encode_yaml'
+
+    def test_files(self):
+        for encoder, test, params in (
+                ('encode_ini', 'mixed', {}),
+                ('encode_json', 'number', {'convert_nums': True}),
+                ('encode_toml', 'table_grafana', {}),
+                ('encode_yaml', 'boolean', {'convert_bools': True}),
+                ('encode_yaml', 'dict', {})):
+            self._encoder = encoder
+            my_in = self._load_input(test)
+
+            self.assertEqual(
+                getattr(CE, encoder)(CE.cef_normalize(my_in, **params)),
+                getattr(CE, encoder)(my_in, **params))
+
+    def test_unsorted(self):
+        my_in = CE.cef_normalize({'b': 1, 'a': 2})
+
+        self.assertEqual(
+            CE.encode_lua(my_in, sort_keys=False), 'b = 1;\na = 2;\n')
+
+    def test_immutable(self):
+        my_in = CE.cef_normalize({'a': [1, 2], 'b': {'c': 'd'}})
+
+        self.assertRaises(TypeError, my_in.update, {'e': 'f'})
+        self.assertRaises(TypeError, my_in['a'].append, 3)
+        self.assertEqual(
+            hash(my_in),
+            hash(CE.cef_normalize({'b': {'c': 'd'}, 'a': [1, 2]})))
+
+
+class TestWorkers(MyTestCase):
+    _encoder = 'encode_ini'
+
+    def test_files(self):
+        for encoder, test in (
+                ('encode_ini', 'mixed'),
+                ('encode_ini', 'section'),
+                ('encode_toml', 'table_array'),
+                ('encode_toml', 'table_grafana')):
+            self._encoder = encoder
+            my_filter = CE.FilterModule().filters()[encoder]
+            my_in = self._load_input(test)
+
+            self.assertEqual(
+                my_filter(my_in, workers=2, workers_threshold=0),
+                self._load_output(test))
+
+    def test_nginx(self):
+        my_filter = CE.FilterModule().filters()['encode_nginx']
+        my_in = [
+            'user nginx',
+            {'events': ['worker_connections 1024']},
+            '# Comment',
+            {'http': [{'server': ['listen 80', 'server_name x!;']}]},
+            'pid /run/nginx.pid']
+
+        self.assertEqual(
+            my_filter(my_in, workers=2, workers_threshold=0, indent="\t"),
+            CE.encode_nginx(my_in, indent="\t"))
+
+    def test_threshold(self):
+        my_filter = CE.FilterModule().filters()['encode_haproxy']
+        my_in = [{'global': ['daemon']}, '# Comment', {'defaults': []}]
+
+        self.assertEqual(
+            my_filter(my_in, workers=2), CE.encode_haproxy(my_in))
+
+    def test_lost_jobs(self):
+        my_in = {'s1': {'a': _Unpicklable('x')}, 's2': {'b': 'y'}}
+        my_timeout = CE.WORKERS_TIMEOUT
+        CE.WORKERS_TIMEOUT = 1
+
+        try:
+            self.assertEqual(
+                CE._render_parts(CE._split_ini(my_in, {}), workers=2),
+                CE.encode_ini(my_in))
+        finally:
+            CE.WORKERS_TIMEOUT = my_timeout
+
+
+class _Unpicklable(str):
+    """String failing to unpickle in the workers."""
+
+    def __reduce__(self):
+        return (_unpickle_error, ())
+
+
+def _unpickle_error():
+    raise ValueError("Can't be unpickled")
+
+
+class TestDecode(MyTestCase):
+    def _test_decode(self, encoder, test, **params):
+        self._encoder = encoder
+        my_out = self._load_output(test)
+        decoder = getattr(CE, encoder.replace('encode_', 'decode_'))
+
+        self.assertEqual(
+            getattr(CE, encoder)(decoder(my_out), **params), my_out)
+
+    def test_files(self):
+        for encoder, test in (
+                ('encode_ini', 'mixed'),
+                ('encode_ini', 'null'),
+                ('encode_ini', 'section'),
+                ('encode_json', 'dict'),
+                ('encode_toml', 'table_array'),
+                ('encode_toml', 'table_grafana')):
+            self._test_decode(encoder, test)
+
+    def test_handwritten(self):
+        for decoder, params in (
+                ('decode_ini', {'comment': ';'}),
+                ('decode_nginx', {}),
+                ('decode_toml', dict(convert_bools=True, convert_nums=True))):
+            self._encoder = decoder
+
+            self.assertEqual(
+                getattr(CE, decoder)(
+                    self._load_output('handwritten'), **params),
+                self._load_input('handwritten'))
+
+    def test_haproxy(self):
+        my_in = [
+            {'global': ['daemon', 'maxconn 256']},
+            '# Comment',
+            {'backend servers': ['server s1 127.0.0.1:80 maxconn 32']}]
+
+        self.assertEqual(
+            CE.decode_haproxy(CE.encode_haproxy(my_in)), my_in)
+
+    def test_nginx(self):
+        my_in = [
+            {'http': [
+                'sendfile on',
+                {'server': [
+                    'listen 80',
+                    '# Comment',
+                    {'location /': ['root /var/www']},
+                    'if_modified_since off!;']}]},
+            'worker_processes 1']
+
+        for params in ({}, {'block_semicolon': True}):
+            self.assertEqual(
+                CE.decode_nginx(CE.encode_nginx(my_in, **params)), my_in)
+
+    def test_options(self):
+        self._test_decode('encode_ini', 'mixed_delimiter', delimiter=' = ')
+        self._test_decode('encode_toml', 'string_quote', quote="'")
+
+    def test_values(self):
+        self.assertEqual(
+            CE.decode_ini(
+                '[s]\na = 1\na = true\nb="x \\" y"\n', quote='"',
+                convert_bools=True, convert_nums=True),
+            {'s': {'a': [1, True], 'b': 'x " y'}})
+        self.assertEqual(
+            CE.decode_toml(
+                'a = [\n  1, # one\n  "x\\ty",\n]\n'
+                'b = { c = 1, "d.e" = \'f\' }\n'),
+            {'a': [1, 'x\ty'], 'b': {'c': 1, 'd.e': 'f'}})
+        self.assertEqual(
+            CE.decode_nginx('a {\n  b "c;d";  # e\n  f\n}\n'),
+            [{'a': ['b "c;d"', '# e', 'f!;']}])
+        self.assertEqual(
+            CE.decode_ini('; a\n# b\n', comment=['#', ';']), {})
+        self.assertEqual(CE.decode_ini('; a\n'), {'; a': '!!!null'})
+        self.assertEqual(
+            CE.decode_toml(
+                'a = [{ b = "1" }]\nc = { d = ["true"] }\n',
+                convert_bools=True, convert_nums=True),
+            {'a': [{'b': 1}], 'c': {'d': [True]}})
+        self.assertEqual(CE.decode_json('{"a": null}'), {'a': 'null'})
+        self.assertRaises(
+            CE.errors.AnsibleFilterError, CE.decode_nginx, 'a {\n')
+
+    def test_unsupported(self):
+        for decoder, data in (
+                ('decode_nginx', 'a "b;\n'),
+                ('decode_toml', 'a\n'),
+                ('decode_toml', '[a] b = 1\n'),
+                ('decode_toml', 'a = "b" c\n'),
+                ('decode_toml', 'a = """b\n')):
+            self.assertRaises(
+                CE.errors.AnsibleFilterError, getattr(CE, decoder), data)
+
+
+class TestGuard(unittest.TestCase):
+    def _test_limit(self, message, data, encoder='encode_yaml', **params):
+        my_filter = CE.FilterModule().filters()[encoder]
+
+        with self.assertRaises(CE.errors.AnsibleFilterError) as e:
+            my_filter(data, **params)
+
+        self.assertEqual(str(e.exception), message)
+
+    def test_depth(self):
+        my_in = {'a': [1, {'b': {'c': 2}}]}
+
+        self._test_limit(
+            'Limit max_depth=3 exceeded at a[1].b', my_in, max_depth=3)
+        self.assertEqual(
+            CE.FilterModule().filters()['encode_yaml'](my_in, max_depth=4),
+            CE.encode_yaml(my_in))
+
+    def test_nodes(self):
+        self._test_limit(
+            'Limit max_nodes=10 exceeded at b[7]',
+            {'a': 1, 'b': list(range(100))}, max_nodes=10)
+
+    def test_bytes(self):
+        self._test_limit(
+            'Limit max_bytes=10 exceeded at b',
+            {'a': 'x' * 5, 'b': 'y' * 5}, max_bytes=10)
+        self._test_limit(
+            'Limit max_bytes=20 exceeded by the output of 22 bytes',
+            {'a': 'x' * 5, 'b': 'y' * 5}, max_bytes=20)
+
+    def test_bytes_encoded(self):
+        self._test_limit(
+            'Limit max_bytes=15 exceeded at b',
+            {'a': u'\xe9' * 5, 'b': 'y' * 5}, max_bytes=15)
+        self._test_limit(
+            'Limit max_bytes=24 exceeded by the output of 27 bytes',
+            {'a': u'\xe9' * 5, 'b': 'y' * 5}, max_bytes=24)
+
+    def test_bytes_early(self):
+        my_in = [{'http': [{'server': ['listen %d' % i]} for i in range(100)]}]
+        my_env = jinja2.Environment(extensions=[
+            'jinja2_extensions.cef_encode.CefEncodeExtension'])
+        my_template = my_env.from_string(
+            "{% cef_encode 'nginx', data, max_bytes=2000 %}")
+
+        # The rendering stops at the first section exceeding the limit
+        self._test_limit(
+            'Limit max_bytes=2000 exceeded by the output of at least 2007 '
+            'bytes', my_in, max_bytes=2000, encoder='encode_nginx')
+        self.assertLess(2007, len(CE.encode_nginx(my_in)))
+        self.assertRaises(
+            CE.errors.AnsibleFilterError, my_template.render, data=my_in)
+
+    def test_invalid(self):
+        os.environ['CEF_MAX_DEPTH'] = '10k'
+
+        try:
+            limit = CE._env_limit('CEF_MAX_DEPTH')
+        finally:
+            del os.environ['CEF_MAX_DEPTH']
+
+        max_depth = CE.MAX_DEPTH
+        CE.MAX_DEPTH = limit
+
+        try:
+            self._test_limit(
+                'Invalid value of the max_depth limit: 10k', {'a': 1})
+        finally:
+            CE.MAX_DEPTH = max_depth
+
+        self._test_limit(
+            'Invalid value of the max_nodes limit: many', {'a': 1},
+            max_nodes='many')
+
+
+class TestBatch(MyTestCase):
+    def test_files(self):
+        items = []
+
+        for encoder, test in (
+                ('encode_json', 'dict'),
+                ('encode_toml', 'table_grafana'),
+                ('encode_yaml', 'dict')):
+            self._encoder = encoder
+            items.append({
+                'format': encoder.replace('encode_', ''),
+                'data': self._load_input(test),
+                'options': {'plan': True}})
+
+        expected = [
+            getattr(CE, 'encode_%s' % item['format'])(item['data'])
+            for item in items]
+
+        self.assertEqual(CE.cef_batch(items), expected)
+        self.assertEqual(CE.cef_batch(items * 20, threads=4), expected * 20)
+
+    def test_unknown(self):
+        self.assertRaises(
+            CE.errors.AnsibleFilterError, CE.cef_batch,
+            [{'format': 'foo', 'data': {}}])
+
+    def test_filters(self):
+        # The filters are built once for all the calls
+        self.assertIs(CE.FilterModule().filters(), CE.FilterModule().filters())
+
+    def test_template_replace(self):
+        self.assertEqual(
+            CE.template_replace(
+                {'a': 'x {[{ item["b"] }]}', 'c': '{[{ item.d }]}'},
+                {'b': 1}),
+            {'a': 'x 1', 'c': ''})
+
+
+class TestDiff(unittest.TestCase):
+    def test_sections(self):
+        my_old = {'s1': {'a': 1}, 's2': {'a': 2, 'b': 'x'}, 's3': {'a': 3}}
+        my_new = {'s1': {'a': 1}, 's2': {'a': 2, 'b': 'y'}, 's3': {'a': 4}}
+
+        self.assertEqual(
+            CE.cef_diff(my_old, my_new, 'encode_ini', context=0),
+            '--- before\n+++ after\n'
+            '@@ -6 +6 @@ s2.b\n-b=x\n+b=y\n'
+            '@@ -9 +9 @@ s3.a\n-a=3\n+a=4\n')
+
+        # Sections differing in their names are compared as whole documents
+        my_new = {'s1': {'a': 1}, 's2': {'a': 2, 'b': 'x'}, 's4': {'c': 4}}
+
+        self.assertEqual(
+            CE.cef_diff(my_old, my_new, 'encode_ini', context=0),
+            '--- before\n+++ after\n'
+            '@@ -8,2 +8,2 @@\n-[s3]\n-a=3\n+[s4]\n+c=4\n')
+
+    def test_patch(self):
+        my_old = [
+            {'http': [
+                {'server': ['listen 80', 'server_name a.example.com']},
+                {'server': ['listen 80', 'server_name b.example.com']},
+                {'server': ['listen 80', 'server_name c.example.com']}]},
+            {'events': ['worker_connections 1024']}]
+        my_new = copy.deepcopy(my_old)
+        my_new[0]['http'][0]['server'][0] = 'listen 8080'
+        my_new[0]['http'][2]['server'][1] = 'server_name d.example.com'
+        my_new[1]['events'][0] = 'worker_connections 2048'
+        my_diff = CE.cef_diff(my_old, my_new, 'nginx', context=1)
+
+        self.assertEqual(my_diff.count('\n@@ '), 3)
+
+        if which('patch') is None:
+            self.skipTest("The patch command isn't available")
+
+        my_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, my_dir)
+        my_file = os.path.join(my_dir, 'nginx.conf')
+
+        with open(my_file, 'w') as f:
+            f.write(CE.encode_nginx(my_old))
+
+        my_proc = subprocess.Popen(
+            ['patch', my_file], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        my_proc.communicate(my_diff.encode('utf-8'))
+
+        self.assertEqual(my_proc.returncode, 0)
+
+        with open(my_file) as f:
+            self.assertEqual(f.read(), CE.encode_nginx(my_new))
+
+    def test_whole(self):
+        self.assertEqual(
+            CE.cef_diff({'a': [1, 2]}, {'a': [1, 3]}, 'json', context=0),
+            '--- before\n+++ after\n@@ -4 +4 @@ a[1]\n-    2\n+    3\n')
+        # Lists differing in their length are compared as whole documents
+        self.assertEqual(
+            CE.cef_diff({'a': [1, 2]}, {'a': [1, 2, 3]}, 'json', context=0),
+            '--- before\n+++ after\n'
+            '@@ -4 +4,2 @@\n-    2\n+    2,\n+    3\n')
+
+    def test_options(self):
+        my_old = {'s1': {'a': 1}}
+        my_new = {'s1': {'a': 2}}
+
+        for encoder in ('ini', 'json'):
+            self.assertEqual(
+                CE.cef_diff(
+                    my_old, my_new, encoder, plan=True, max_bytes=10),
+                CE.cef_diff(my_old, my_new, encoder))
+
+    def test_unchanged(self):
+        my_in = [{'http': [{'server': ['listen 80']}]}]
+
+        self.assertEqual(CE.cef_diff(my_in, my_in, 'nginx'), '')
+        self.assertRaises(
+            CE.errors.AnsibleFilterError, CE.cef_diff, my_in, my_in, 'foo')
+
+
+class TestHaproxyDelta(unittest.TestCase):
+    _old = [
+        {'global': ['daemon']},
+        {'backend be': [
+            'balance roundrobin',
+            {'server': [
+                's1 10.0.0.1:80 weight 10 check',
+                's2 10.0.0.2:80 check']}]}]
+
+    def _new(self, servers, balance='roundrobin'):
+        return [
+            {'global': ['daemon']},
+            '# Changed',
+            {'backend be': ['balance %s' % balance, {'server': servers}]}]
+
+    def test_runtime(self):
+        my_new = self._new([
+            's1 10.0.0.5:8080 weight 20 check',
+            's2 10.0.0.2:80 check disabled'])
+
+        self.assertEqual(CE.cef_haproxy_delta(self._old, my_new), {
+            'commands': [
+                'set server be/s1 addr 10.0.0.5 port 8080',
+                'set server be/s1 weight 20',
+                'set server be/s2 state maint'],
+            'config': None,
+            'reason': None,
+            'reload': False})
+        self.assertEqual(
+            CE.cef_haproxy_delta(self._old, self._old)['commands'], [])
+
+    def test_reload(self):
+        for my_new, reason in (
+                (self._new(
+                    ['s1 10.0.0.1:80 weight 10 check'], 'leastconn'),
+                 'Section backend be differs'),
+                (self._new(['s1 10.0.0.1:80 weight 10 check']),
+                 'Servers of section backend be differ'),
+                (self._new([
+                    's1 10.0.0.1:80 check',
+                    's2 10.0.0.2:80 check']),
+                 'Server be/s1 differs'),
+                (self._new([
+                    's1 10.0.0.1:80 weight 10 check',
+                    's2 example.com:80 check']),
+                 'Server be/s2 address is not an IP')):
+            my_delta = CE.cef_haproxy_delta(self._old, my_new)
+
+            self.assertEqual(my_delta['reason'], reason)
+            self.assertTrue(my_delta['reload'])
+            self.assertEqual(my_delta['commands'], [])
+            self.assertEqual(my_delta['config'], CE.encode_haproxy(my_new))
+
+
+class TestOnly(unittest.TestCase):
+    def _test(self, encoder, my_in, only, my_out):
+        my_filter = CE.FilterModule().filters()[encoder]
+
+        self.assertEqual(my_filter(my_in, only=only), my_out)
+
+    def test_blocks(self):
+        my_in = [{'http': [
+            {'server': ['listen 80', {'location /': ['root /a']}]},
+            {'server': ['listen 81']}]}]
+
+        self._test(
+            'encode_nginx', my_in, 'http[1]',
+            '  server {\n    listen 81;\n  }\n')
+        self._test(
+            'encode_nginx', my_in, ['http', 'server', 'location /'],
+            '    location / {\n      root /a;\n    }\n')
+        self._test(
+            'encode_logstash', [
+                {':input': [{':file': {'path': '/a'}}]},
+                {':output': [{':stdout': {'codec': 'x'}}]}],
+            ':output.:stdout', '  stdout {\n    codec => "x"\n  }\n')
+
+    def test_sections(self):
+        self._test(
+            'encode_ini', {'a': 1, 's': {'x': 1}, 't': {'y': 2}}, 's',
+            '[s]\nx=1\n')
+        self._test(
+            'encode_toml', {'a': {'b': {'c': 1}}, 'x': 1}, 'a.b',
+            '[a.b]\nc = 1\n')
+        self._test(
+            'encode_pam', {
+                'r1': {'type': 'auth', 'control': 'required', 'path': 'a'},
+                'r2': {'type': 'account', 'control': 'required', 'path': 'b'},
+            }, 'r2', 'account  required  b\n')
+
+    def test_values(self):
+        my_in = {'a': {'b': [{'x': 1, 'y': {'z': 2}}]}}
+
+        self._test(
+            'encode_yaml', my_in, 'a.b[0].y', '      y:\n        z: 2\n')
+        self._test(
+            'encode_json', my_in, 'a.b[0].y',
+            '        "y": {\n          "z": 2\n        }\n')
+        self._test(
+            'encode_xml', {'root': [{'a': 'x'}, {'b': [{'c': 1}]}]}, 'root[1]',
+            '  <b>\n    <c>1</c>\n  </b>\n')
+
+    def test_errors(self):
+        my_filter = CE.FilterModule().filters()['encode_toml']
+
+        self.assertRaises(
+            CE.errors.AnsibleFilterError, my_filter, {'a': 1}, only='b')
+        self.assertRaises(
+            CE.errors.AnsibleFilterError, my_filter, {'a': [1, 2]},
+            only='a[1]')
+
+
+class TestLayers(unittest.TestCase):
+    def test_merge(self):
+        my_filter = CE.FilterModule().filters()['encode_yaml']
+        my_default = {'a': {'b': 1, 'c': [1, 2], 'd': {'e': 1}}, 'f': {'g': 1}}
+        my_group = {'a': {'c': [3], 'd': {'h': 2}}, 'i': 'x'}
+        my_host = {'a': {'d': {'e': 3}}, 'f': 'y'}
+
+        self.assertEqual(
+            my_filter(my_default, layers=[my_group, my_host]),
+            CE.encode_yaml({
+                'a': {'b': 1, 'c': [3], 'd': {'e': 3, 'h': 2}},
+                'f': 'y',
+                'i': 'x'}))
+        self.assertEqual(my_default['a']['d'], {'e': 1})
+
+    def test_workers(self):
+        my_filter = CE.FilterModule().filters()['encode_ini']
+        my_base = {'s%d' % i: {'a': i, 'b': 'x'} for i in range(4)}
+        my_over = {'s1': {'b': 'y'}, 's3': {'c': 3}}
+
+        self.assertEqual(
+            my_filter(
+                my_base, layers=[my_over], workers=2, workers_threshold=0),
+            CE.encode_ini(CE._layered([my_base, my_over])))
+
+    def test_view(self):
+        my_in = CE._layered([{'a': {'b': 1}}, {'a': {'c': 2}}])
+
+        self.assertEqual(my_in, {'a': {'b': 1, 'c': 2}})
+        self.assertEqual(len(my_in['a']), 2)
+        self.assertRaises(TypeError, my_in.update, {'d': 3})
+
+
+class TestProfile(unittest.TestCase):
+    def setUp(self):
+        CE.cef_profile(reset=True)
+
+    def test_paths(self):
+        my_filter = CE.FilterModule().filters()['encode_nginx']
+        my_in = [{'http': ['sendfile on', {'server': ['listen 80']}]}]
+
+        self.assertEqual(
+            my_filter(my_in, profile=True), CE.encode_nginx(my_in))
+
+        my_profile = CE._profile
+
+        self.assertEqual(sorted(my_profile), [
+            'encode_nginx',
+            'encode_nginx;[0];http',
+            'encode_nginx;[0];http;[1];server'])
+        self.assertEqual(
+            sum(rec[2] for rec in my_profile.values()),
+            len(CE.encode_nginx(my_in)))
+        self.assertEqual(
+            CE.cef_profile(format='folded', metric='bytes'),
+            'encode_nginx 9\n'
+            'encode_nginx;[0];http 31\n'
+            'encode_nginx;[0];http;[1];server 15\n')
+
+        table = CE.cef_profile(top=2, reset=True).splitlines()
+
+        self.assertEqual(len(table), 3)
+        self.assertTrue(table[1].startswith('encode_nginx (root) '))
+        self.assertTrue(table[2].startswith('encode_nginx [0].http '))
+        self.assertEqual(CE._profile, {})
+
+    def test_file(self):
+        my_dir = tempfile.mkdtemp()
+        my_path = os.path.join(my_dir, 'profile.json')
+        my_filter = CE.FilterModule().filters()['encode_yaml']
+
+        try:
+            for _ in range(2):
+                my_filter({'a': {'b': [1, 2]}}, profile=my_path)
+
+            my_profile = CE.cef_profile(my_path, format='folded')
+        finally:
+            shutil.rmtree(my_dir)
+
+        self.assertEqual(
+            [line.split(' ')[0] for line in my_profile.splitlines()],
+            ['encode_yaml', 'encode_yaml;a', 'encode_yaml;a;b'])
+        self.assertRaises(
+            CE.errors.AnsibleFilterError, CE.cef_profile, format='svg')
+
+    def test_options(self):
+        my_filter = CE.FilterModule().filters()['encode_yaml']
+
+        self.assertEqual(
+            my_filter({'a': 1}, layers=[{'b': {'c': 2}}], profile=True),
+            CE.encode_yaml({'a': 1, 'b': {'c': 2}}))
+        self.assertEqual(
+            sorted(CE._profile), ['encode_yaml', 'encode_yaml;b'])
+        self.assertRaises(
+            CE.errors.AnsibleFilterError, my_filter, {'a': {'b': 1}},
+            only='a', profile=True)
+
+
+class TestChunks(unittest.TestCase):
+    def setUp(self):
+        self._env = jinja2.Environment(extensions=[
+            'jinja2_extensions.cef_encode.CefEncodeExtension'])
+
+    def test_tag(self):
+        my_in = [
+            {'http': [{'server': ['listen 80']}, {'server': ['listen 81']}]},
+            'user www']
+        my_template = self._env.from_string(
+            "{% cef_encode 'nginx', data, block_semicolon=true %}"
+            "{% cef_encode 'yaml', {'a': 1} %}")
+
+        self.assertEqual(
+            my_template.render(data=my_in),
+            CE.encode_nginx(my_in, block_semicolon=True) +
+            CE.encode_yaml({'a': 1}))
+        # Nested sections are yielded separately
+        self.assertEqual(
+            len(list(my_template.generate(data=my_in))), 10)
+
+    def test_shared(self):
+        class Port(object):
+            def __init__(self, num):
+                self.num = num
+
+        # Types registered in the filter plugin are known to the tag
+        register_type(self, Port, 'num', lambda x: x.num)
+        my_template = self._env.from_string("{% cef_encode 'toml', data %}")
+
+        self.assertEqual(
+            my_template.render(data={'port': Port(80)}), 'port = 80\n')
+
+    def test_errors(self):
+        my_template = self._env.from_string("{% cef_encode 'none', 1 %}")
+
+        self.assertRaises(jinja2.TemplateRuntimeError, my_template.render)
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._socket = CE.SERVER_SOCKET
+        CE.SERVER_SOCKET = os.path.join(self._dir, 'cef.sock')
+        self._start()
+
+    def _start(self, env=None):
+        self._server = subprocess.Popen(
+            [sys.executable, CE.__file__, '--socket', CE.SERVER_SOCKET],
+            env=dict(os.environ, **(env or {})))
+
+        for _ in range(100):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+            try:
+                sock.connect(CE.SERVER_SOCKET)
+                break
+            except socket.error:
+                time.sleep(0.1)
+            finally:
+                sock.close()
+
+    def _stop(self):
+        self._server.terminate()
+        self._server.wait()
+
+    def tearDown(self):
+        self._stop()
+        CE.SERVER_SOCKET = self._socket
+        shutil.rmtree(self._dir)
+
+        if getattr(CE._client, 'conn', None) is not None:
+            CE._client.conn[1].close()
+            CE._client.conn = None
+
+    def test_render(self):
+        my_filter = CE.FilterModule().filters()['encode_yaml']
+        my_in = {'a': [1, 2.5, None, True], 'b': {'c': 'd'}}
+
+        self.assertTrue(os.path.exists(CE.SERVER_SOCKET))
+        self.assertEqual(my_filter(my_in), CE.encode_yaml(my_in))
+        self.assertIsNotNone(CE._client.conn)
+        self.assertEqual(
+            my_filter(my_in, indent='    '),
+            CE.encode_yaml(my_in, indent='    '))
+        # Types unknown to the server are rendered locally
+        self.assertEqual(
+            my_filter({'a': Decimal('1.50')}), 'a: 1.50\n')
+        self.assertRaises(
+            CE.errors.AnsibleFilterError, my_filter, {'a': 1}, only='b')
+
+    def test_fallback(self):
+        my_filter = CE.FilterModule().filters()['encode_json']
+        my_in = {'a': 1}
+
+        self.assertEqual(my_filter(my_in), CE.encode_json(my_in))
+
+        self._stop()
+
+        self.assertEqual(my_filter(my_in), CE.encode_json(my_in))
+        self.assertFalse(os.path.exists(CE.SERVER_SOCKET))
+
+    def test_limits(self):
+        my_filter = CE.FilterModule().filters()['encode_json']
+        my_in = {'a': [1, 2]}
+
+        self._stop()
+        self._start({'CEF_MAX_NODES': '1'})
+
+        # The limits of the client apply
+        self.assertEqual(my_filter(my_in), CE.encode_json(my_in))
+        self.assertRaises(
+            CE.errors.AnsibleFilterError, my_filter, my_in, max_nodes=2)
+
+    def test_timeout(self):
+        my_filter = CE.FilterModule().filters()['encode_json']
+        my_in = {'a': 1}
+        timeout = CE.SERVER_TIMEOUT
+        CE.SERVER_TIMEOUT = 0.5
+
+        self._stop()
+
+        # Server responding only to the first request
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(CE.SERVER_SOCKET)
+        sock.listen(2)
+
+        def respond():
+            conn = sock.accept()[0]
+            conns.append(conn)
+            CE._recv(conn)
+            CE._send(conn, (True, 'x'))
+
+        conns = []
+        thread = threading.Thread(target=respond)
+        thread.start()
+
+        try:
+            self.assertEqual(my_filter(my_in), 'x')
+
+            thread.join()
+
+            # The request isn't sent again after the timeout
+            self.assertEqual(my_filter(my_in), CE.encode_json(my_in))
+
+            sock.settimeout(0.1)
+            self.assertRaises(socket.timeout, sock.accept)
+        finally:
+            CE.SERVER_TIMEOUT = timeout
+            sock.close()
+
+            for conn in conns:
+                conn.close()
+
+
+class TestTypes(unittest.TestCase):
+    def test_subclass(self):
+        class MyStr(str):
+            pass
+
+        self.assertEqual(
+            CE.encode_json({'a': MyStr('b'), 'c': [MyStr('d e')]}),
+            CE.encode_json({'a': 'b', 'c': ['d e']}))
+
+    def test_builtin(self):
+        self.assertEqual(
+            CE.encode_yaml({
+                'a': datetime(2020, 1, 2, 3, 4, 5),
+                'b': Decimal('1.50')}),
+            'a: "2020-01-02T03:04:05"\nb: 1.50\n')
+
+    def test_register(self):
+        class Port(object):
+            def __init__(self, num):
+                self.num = num
+
+        register_type(self, Port, 'num', lambda x: x.num)
+
+        self.assertEqual(
+            CE.encode_toml({'port': Port(80)}), 'port = 80\n')
+        self.assertRaises(
+            CE.errors.AnsibleFilterError, CE.register_type, Port, 'port')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,587 @@
+"""
+Differential tests of the accelerated paths of the Config Encoder Filters
+
+Random data structures following the data model of each encoder are encoded
+by the reference (recursive) encoders and by every accelerated path. Any
+difference is shrunk to a minimal failing input. The number of iterations
+and the seed can be changed by the CEF_DIFF_ITERATIONS and CEF_DIFF_SEED
+environment variables.
+"""
+
+import filter_plugins.config_encoders as CE
+import json
+import os
+import random
+import re
+import unittest
+import xml.etree.ElementTree as ET
+import yaml
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+
+ITERATIONS = int(os.environ.get('CEF_DIFF_ITERATIONS', 100))
+SEED = int(os.environ.get('CEF_DIFF_SEED', 0))
+
+KEYS = [
+    'a', 'b', 'key1', 'Key_2', 'x.y', 'k-3', 'a,b', 'x}', 'k: v', '#c']
+STRINGS = [
+    '', 'a', 'some text', 'null', 'true', 'False', '12', '-3.5', '1e3',
+    'q"uote', "ap'os", 'back\\slash', 'new\nline', 'tab\t', '<&>',
+    '#hash', ':atom', '@@@raw', 'a = b']
+
+
+def gen_key(r):
+    return r.choice(KEYS)
+
+
+def gen_scalar(r, null=True):
+    choice = r.random()
+
+    if choice < 0.5:
+        return r.choice(STRINGS)
+    elif choice < 0.65:
+        return r.randint(-1000, 1000)
+    elif choice < 0.75:
+        return round(r.uniform(-100, 100), r.randint(0, 3))
+    elif choice < 0.9 or not null:
+        return r.choice([True, False])
+
+    return None
+
+
+def gen_tree(r, depth=0, null=True):
+    choice = r.random()
+
+    if depth > 3 or choice < 0.3:
+        return gen_scalar(r, null)
+    elif choice < 0.65:
+        return gen_dict(r, depth, null)
+
+    return [gen_tree(r, depth+1, null) for _ in range(r.randint(0, 4))]
+
+
+def gen_dict(r, depth=0, null=True):
+    return dict(
+        (gen_key(r), gen_tree(r, depth+1, null))
+        for _ in range(r.randint(0, 5)))
+
+
+def gen_apache(r, depth=0):
+    content = []
+
+    for _ in range(r.randint(0, 3)):
+        if r.random() < 0.5 or depth > 2:
+            content.append({'options': [
+                {r.choice(['ServerName', 'Listen', '#']): (
+                    gen_scalar(r, False) if r.random() < 0.7 else
+                    [gen_scalar(r, False) for _ in range(r.randint(1, 3))])}
+                for _ in range(r.randint(0, 3))]})
+        else:
+            content.append({'sections': [{
+                'name': r.choice(['VirtualHost', 'Directory']),
+                'param': r.choice(['*:80', '/var/www']),
+                'content': gen_apache(r, depth+1)['content'],
+            } for _ in range(r.randint(0, 2))]})
+
+    return {'content': content}
+
+
+def gen_erlang(r):
+    return [
+        {gen_key(r): [
+            {gen_key(r): gen_tree(r, 1, False)}
+            for _ in range(r.randint(0, 3))]}
+        for _ in range(r.randint(0, 3))]
+
+
+def gen_haproxy(r):
+    rv = []
+
+    for _ in range(r.randint(0, 4)):
+        if r.random() < 0.2:
+            rv.append('# comment %d' % r.randint(0, 9))
+        else:
+            rv.append({r.choice(['global', 'defaults', 'backend be']): [
+                r.choice(['daemon', 'maxconn 256', 'mode http']) if
+                r.random() < 0.7 else
+                {'option': ['forwardfor', 'http-server-close']}
+                for _ in range(r.randint(0, 3))]})
+
+    return rv
+
+
+def gen_ini(r):
+    rv = {}
+
+    for _ in range(r.randint(0, 5)):
+        if r.random() < 0.4:
+            rv[gen_key(r)] = dict(
+                (gen_key(r), gen_ini_value(r))
+                for _ in range(r.randint(0, 3)))
+        else:
+            rv[gen_key(r)] = gen_ini_value(r)
+
+    return rv
+
+
+def gen_ini_value(r):
+    if r.random() < 0.2:
+        return [gen_scalar(r) for _ in range(r.randint(0, 3))]
+
+    return gen_scalar(r)
+
+
+def gen_logstash(r):
+    return [
+        {':%s' % section: [
+            {':%s' % r.choice(['file', 'grok', 'stdout']): dict(
+                (gen_key(r), gen_tree(r, 2, False))
+                for _ in range(r.randint(0, 3)))}
+            for _ in range(r.randint(0, 3))]}
+        for section in r.sample(['input', 'filter', 'output'], 2)]
+
+
+def gen_nginx(r, depth=0):
+    return [
+        r.choice(['listen 80', 'sendfile on', '# comment', 'off!;']) if
+        r.random() < 0.6 or depth > 2 else
+        {r.choice(['http', 'server', 'location /']): gen_nginx(r, depth+1)}
+        for _ in range(r.randint(0, 4))]
+
+
+def gen_pam(r):
+    return dict(('rule%d' % i, {
+        'type': r.choice(['auth', 'account']),
+        'control': r.choice(['required', [{'success': 'ok'}]]),
+        'path': 'pam_unix.so',
+        'args': r.choice([[], ['nullok', {'retry': 3}]]),
+    }) for i in range(r.randint(0, 4)))
+
+
+def gen_toml(r):
+    rv = gen_dict(r, null=False)
+
+    if r.random() < 0.5:
+        rv[r.choice(KEYS)] = [
+            gen_dict(r, 1, False) for _ in range(r.randint(1, 3))]
+
+    return rv
+
+
+def rekey(data, keys):
+    """Return the data with the keys replaced by a plain key."""
+
+    if isinstance(data, dict):
+        return dict(
+            ('a' if k in keys else k, rekey(v, keys)) for k, v in data.items())
+    elif isinstance(data, list):
+        return [rekey(v, keys) for v in data]
+
+    return data
+
+
+def gen_toml_compact(r):
+    def tables(data):
+        if isinstance(data, dict):
+            return dict((k, tables(v)) for k, v in data.items())
+        elif isinstance(data, list) and data and isinstance(data[0], dict):
+            # The reference encoder writes only the dicts of the array of
+            # tables and their header only before their first value
+            return [
+                dict(tables(item), b=gen_scalar(r, False)) for item in data
+                if isinstance(item, dict)]
+
+        return data
+
+    # The reference encoder writes the keys of the values unquoted
+    return tables(rekey(gen_toml(r), ('x.y', '#c')))
+
+
+def gen_yaml_compact(r):
+    # The reference encoder writes the keys unquoted
+    return rekey(gen_tree(r), ('#c',))
+
+
+def gen_xml(r, depth=0):
+    rv = []
+
+    for _ in range(r.randint(0, 3)):
+        if r.random() < 0.3:
+            rv.append({'^%s' % gen_key(r): gen_scalar(r, False)})
+        elif r.random() < 0.5 or depth > 2:
+            rv.append({'el': r.choice(STRINGS)})
+        else:
+            rv.append({'el': gen_xml(r, depth+1)})
+
+    return {'root': rv}
+
+
+def gen_scalars(r):
+    """Generate list of strings or numbers with the special values."""
+
+    if r.random() < 0.5:
+        rv = [r.choice(STRINGS + ['\x00']) for _ in range(r.randint(0, 6))]
+    else:
+        rv = [
+            r.choice([r.randint(-1000, 1000), round(r.uniform(-9, 9), 2)])
+            for _ in range(r.randint(0, 6))]
+
+    if rv and r.random() < 0.2:
+        # Item equal to the last one
+        rv.insert(r.randrange(len(rv)), rv[-1])
+
+    return rv
+
+
+def gen_bulk(r):
+    return dict((gen_key(r), gen_scalars(r)) for _ in range(r.randint(1, 3)))
+
+
+GENERATORS = {
+    'encode_apache': gen_apache,
+    'encode_erlang': gen_erlang,
+    'encode_haproxy': gen_haproxy,
+    'encode_ini': gen_ini,
+    'encode_json': gen_dict,
+    'encode_jsonl': lambda r: [gen_dict(r) for _ in range(r.randint(0, 4))],
+    'encode_logstash': gen_logstash,
+    'encode_lua': lambda r: gen_dict(r, null=False),
+    'encode_nginx': gen_nginx,
+    'encode_pam': gen_pam,
+    'encode_toml': gen_toml,
+    'encode_xml': gen_xml,
+    'encode_yaml': gen_tree,
+}
+
+# Generators of the homogeneous lists
+BULK_GENERATORS = {
+    'encode_erlang': lambda r: [{gen_key(r): [gen_bulk(r)]}],
+    'encode_json': gen_bulk,
+    'encode_lua': gen_bulk,
+    'encode_toml': gen_bulk,
+    'encode_yaml': gen_bulk,
+}
+
+# Encoders supporting the convert_bools and convert_nums parameters
+CONVERT = (
+    'encode_apache', 'encode_erlang', 'encode_json', 'encode_jsonl',
+    'encode_logstash', 'encode_lua', 'encode_toml', 'encode_yaml')
+
+
+def lua_tokens(text):
+    """Return the Lua code without the whitespace outside of the strings."""
+
+    return ''.join(re.findall(r'"(?:\\.|[^"\\])*"|[^\s"]+', text))
+
+
+def xml_tree(text):
+    """Return the XML document as a tree ignoring the indentation."""
+
+    def walk(el):
+        return (
+            el.tag, sorted(el.attrib.items()), (el.text or '').strip(),
+            [walk(child) for child in el])
+
+    return walk(ET.fromstring(text))
+
+
+def rescalar(r, data):
+    """Return data of the same shape with different scalar values."""
+
+    if isinstance(data, dict):
+        return dict((k, rescalar(r, v)) for k, v in data.items())
+    elif isinstance(data, list):
+        return [rescalar(r, v) for v in data]
+
+    return gen_scalar(r, data is None)
+
+
+def path_plan(name, data):
+    my_filter = CE.FilterModule().filters()[name]
+
+    return my_filter(data, plan=True)
+
+
+def path_split(name, data):
+    parts = CE._SPLITTERS[name](data, {})
+
+    if parts is None:
+        return CE.FilterModule().filters()[name](data)
+
+    return CE._render_parts(parts)
+
+
+def path_chunks(name, data):
+    return ''.join(CE._encode_chunks(name, data, {}))
+
+
+def path_normalize(name, data):
+    return getattr(CE, name)(CE.cef_normalize(data))
+
+
+def path_normalize_convert(name, data):
+    return getattr(CE, name)(CE.cef_normalize(data, True, True))
+
+
+def path_bulk(name, data):
+    threshold = CE.BULK_THRESHOLD
+    CE.BULK_THRESHOLD = 1
+
+    try:
+        return getattr(CE, name)(data)
+    finally:
+        CE.BULK_THRESHOLD = threshold
+
+
+def path_layers(name, data):
+    # Layer of the same shape overridden by the data
+    base = rescalar(random.Random(0), data)
+
+    return CE.FilterModule().filters()[name](base, layers=[{}, data])
+
+
+def mutate(r, data):
+    """Return the data with some of the scalars changed or items removed.
+
+    The changed scalars keep their type.
+    """
+
+    if isinstance(data, dict):
+        return dict((k, mutate(r, v)) for k, v in data.items())
+    elif isinstance(data, list):
+        return [mutate(r, v) for v in data if r.random() > 0.05]
+    elif r.random() > 0.2 or data is None:
+        return data
+    elif isinstance(data, bool):
+        return not data
+    elif isinstance(data, (int, float)):
+        return data + 1
+
+    return r.choice(STRINGS)
+
+
+def patch(text, diff):
+    """Apply the unified diff to the text verifying the context lines."""
+
+    lines = text.splitlines()
+    rv = []
+    pos = 0
+
+    for line in diff.splitlines()[2:]:
+        if line.startswith('@@'):
+            start = int(line.split()[1][1:].split(',')[0])
+
+            if ',0 ' not in line.split('+')[0] + ' ':
+                start -= 1
+
+            if start < pos:
+                raise ValueError("Overlapping hunks")
+
+            rv.extend(lines[pos:start])
+            pos = start
+        elif line[0] in ' -':
+            if lines[pos] != line[1:]:
+                raise ValueError("Context doesn't match: %r" % line)
+
+            if line[0] == ' ':
+                rv.append(line[1:])
+
+            pos += 1
+        else:
+            rv.append(line[1:])
+
+    return rv + lines[pos:]
+
+
+def path_diff(name, data):
+    old = mutate(random.Random(repr(data)), data)
+    encoder = getattr(CE, name)
+
+    try:
+        encoder(old)
+    except CE.errors.AnsibleFilterError:
+        # Only the valid data can be compared
+        return encoder(data)
+
+    return ''.join(
+        line + '\n' for line in patch(
+            encoder(old), CE.cef_diff(old, data, name, context=1)))
+
+
+def reference(name, data, path):
+    if path == 'normalize_convert':
+        return getattr(CE, name)(data, convert_bools=True, convert_nums=True)
+
+    return getattr(CE, name)(data)
+
+
+def candidates(data):
+    """Generate smaller variants of the data."""
+
+    if isinstance(data, dict):
+        for key in data:
+            yield dict((k, v) for k, v in data.items() if k != key)
+
+        for key, val in data.items():
+            for candidate in candidates(val):
+                yield dict(data, **{key: candidate})
+    elif isinstance(data, list):
+        for i in range(len(data)):
+            yield data[:i] + data[i+1:]
+
+        for i, val in enumerate(data):
+            for candidate in candidates(val):
+                yield data[:i] + [candidate] + data[i+1:]
+    elif isinstance(data, bool):
+        if data:
+            yield False
+    elif isinstance(data, (int, float)):
+        if data != 0:
+            yield 0
+    elif isinstance(data, str) and data:
+        yield ''
+
+        if len(data) > 1:
+            yield data[:len(data) // 2]
+            yield data[len(data) // 2:]
+
+
+def shrink(data, fails):
+    """Return minimal variant of the data for which the test fails."""
+
+    changed = True
+
+    while changed:
+        changed = False
+
+        for candidate in candidates(data):
+            if fails(candidate):
+                data = candidate
+                changed = True
+                break
+
+    return data
+
+
+def outcome(func, *args):
+    try:
+        return func(*args)
+    except Exception as e:
+        return e.__class__
+
+
+class TestDifferential(unittest.TestCase):
+    def _test(
+            self, path, func, encoders, compare=None, generators=GENERATORS):
+        r = random.Random('%s-%s' % (SEED, path))
+
+        def fails(name, data):
+            expected = outcome(reference, name, data, path)
+            actual = outcome(func, name, data)
+
+            if not isinstance(expected, str) and not isinstance(actual, str):
+                # Both paths reject the data
+                return False
+            elif compare is not None and isinstance(expected, str):
+                return (
+                    not isinstance(actual, str) or
+                    not compare(expected, actual))
+
+            return expected != actual
+
+        for _ in range(ITERATIONS):
+            for name in encoders:
+                data = generators[name](r)
+
+                for my_in in (data, data, rescalar(r, data)):
+                    if not fails(name, my_in):
+                        continue
+
+                    my_in = shrink(my_in, lambda d: fails(name, d))
+
+                    self.fail(
+                        "%s differs from %s for %r\n"
+                        "reference: %r\n"
+                        "%s: %r" % (
+                            path, name, my_in,
+                            outcome(reference, name, my_in, path),
+                            path, outcome(func, name, my_in)))
+
+    def test_plan(self):
+        self._test('plan', path_plan, sorted(CE._PLAN_ENCODERS))
+
+    def test_split(self):
+        self._test('split', path_split, sorted(CE._SPLITTERS))
+
+    def test_chunks(self):
+        self._test('chunks', path_chunks, sorted(CE._SPLITTERS))
+
+    def test_bulk(self):
+        self._test(
+            'bulk', path_bulk, sorted(BULK_GENERATORS),
+            generators=BULK_GENERATORS)
+
+    def test_layers(self):
+        self._test('layers', path_layers, sorted(GENERATORS))
+
+    def test_normalize(self):
+        self._test('normalize', path_normalize, sorted(GENERATORS))
+
+    def test_normalize_convert(self):
+        self._test(
+            'normalize_convert', path_normalize_convert, sorted(CONVERT))
+
+    def test_diff(self):
+        self._test(
+            'diff', path_diff, sorted(GENERATORS),
+            lambda expected, actual: (
+                expected.splitlines() == actual.splitlines()))
+
+    def test_compact(self):
+        def parse(load):
+            def compare(expected, actual):
+                try:
+                    expected = load(expected)
+                except Exception:
+                    # Only the valid reference documents can be compared
+                    return True
+
+                try:
+                    return expected == load(actual)
+                except Exception:
+                    return False
+
+            return compare
+
+        self._test(
+            'compact_json',
+            lambda name, data: CE.encode_json(data, compact=True),
+            ['encode_json'], parse(json.loads))
+        self._test(
+            'compact_yaml',
+            lambda name, data: CE.encode_yaml(data, compact=True),
+            ['encode_yaml'], parse(yaml.safe_load),
+            {'encode_yaml': gen_yaml_compact})
+        self._test(
+            'compact_lua',
+            lambda name, data: CE.encode_lua(data, compact=True),
+            ['encode_lua'], parse(lua_tokens))
+        self._test(
+            'compact_xml',
+            lambda name, data: CE.encode_xml(data, compact=True),
+            ['encode_xml'], parse(xml_tree))
+
+        if tomllib is not None:
+            self._test(
+                'compact_toml',
+                lambda name, data: CE.encode_toml(data, compact=True),
+                ['encode_toml'], parse(tomllib.loads),
+                {'encode_toml': gen_toml_compact})
+
+
+if __name__ == '__main__':
+    unittest.main()